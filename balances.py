@@ -0,0 +1,60 @@
+from typing import List, Dict, Iterable
+from blockchains import BLOCKCHAIN_MAP
+from entities import Amount, Transaction
+
+
+def fold(transactions: Iterable[Transaction], address: str, amounts: Dict[str, int] = None) -> Dict[str, int]:
+    """
+    Adds the address's transfers to `amounts`, per currency: a transfer from the address is subtracted and one to it
+    added. A transfer from the address to itself is both, so only its other transfers, like the fee, change the
+    balance.
+    """
+    amounts = dict(amounts or {})
+    for txn in transactions:
+        for xfer in txn.embedded.get('transfers', []):
+            if address not in (xfer.from_address, xfer.to_address):
+                continue
+            change = 0
+            if xfer.from_address == address:
+                change -= int(xfer.amount.amount)
+            if xfer.to_address == address:
+                change += int(xfer.amount.amount)
+            amounts[xfer.amount.currency_id] = amounts.get(xfer.amount.currency_id, 0) + change
+    return amounts
+
+
+async def compute_balances(client, blockchain_id: str, addresses: List[str]) -> List[Amount]:
+    """
+    The wallet's balance per currency, the sum of each address's. An address's balance up to the last final height
+    is kept in the address index, so later requests only fold the transactions above it, and whatever is not final
+    yet is added on top without being stored.
+    """
+    blockchain = await client.get_blockchain(blockchain_id)
+    tip_height = blockchain.verified_height
+    confirmations_until_final = BLOCKCHAIN_MAP.get(blockchain_id, {}).get('confirmations_until_final')
+    final_height = tip_height - confirmations_until_final if confirmations_until_final is not None else None
+
+    stored = {address: client.address_index.get_balance(blockchain_id, address) for address in set(addresses)}
+    positions = {address: (balance[0] + 1 if balance is not None else 0, tip_height)
+                 for address, balance in stored.items()}
+    histories: Dict[str, List[Transaction]] = {address: [] for address in stored}
+    # deep histories come back a page at a time, follow each address's continuation until it is complete
+    while positions:
+        pages = await client.get_transactions_by_address(list(positions), blockchain_id, 0, tip_height,
+                                                         positions=positions)
+        positions = {}
+        for address, resp in pages.items():
+            histories[address].extend(resp.contents)
+            positions.update(resp.continuations)
+
+    totals: Dict[str, int] = {}
+    for address, transactions in histories.items():
+        height, amounts = stored[address] or (-1, {})
+        if final_height is not None and final_height > height:
+            amounts = fold((txn for txn in transactions if 0 < txn.block_height <= final_height), address, amounts)
+            client.address_index.set_balance(blockchain_id, address, final_height, amounts)
+            transactions = [txn for txn in transactions if not 0 < txn.block_height <= final_height]
+        for currency_id, amount in fold(transactions, address, amounts).items():
+            totals[currency_id] = totals.get(currency_id, 0) + amount
+    return [Amount.trusted(currency_id=currency_id, amount=str(amount))
+            for currency_id, amount in sorted(totals.items())]
@@ -0,0 +1,248 @@
+"""
+Load test: starts the stub upstreams and `elysium:app` under uvicorn, pointed at the stubs, drives `/blockchains`,
+`/currencies` and `/transactions` and writes a JSON report with the throughput, latency percentiles and upstream
+calls of each scenario and the peak RSS of every server process.
+
+    python -m bench.run --concurrency 32 --requests 2000 --wallet-size 10 --history 200 --output results.json
+
+Each `/transactions` request asks for a wallet of `--wallet-size` addresses drawn from a pool of `--pool-size`
+addresses per chain, a small pool exercises the caches and a large one the upstream path. Peak RSS is read from
+/proc, so it is only reported on Linux.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+from asyncio import run, gather, sleep
+from datetime import datetime, timezone
+from pathlib import Path
+from time import perf_counter
+from typing import Dict, List
+from aiohttp import ClientSession, TCPConnector, ClientError
+from bench.stubs import addresses
+
+ROOT = Path(__file__).resolve().parent.parent
+CHAINS = ['bitcoin-mainnet', 'ethereum-mainnet', 'ripple-mainnet', 'tezos-mainnet']
+LIMITED_PROVIDERS = ['blockchair', 'blockcypher', 'blockbook', 'etherscan', 'ripple', 'tezos']
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def server_env(args, stub_url: str, scratch: str) -> Dict[str, str]:
+    env = {
+        **os.environ,
+        'PYTHONPATH': str(ROOT),
+        'WEB_CONCURRENCY': str(args.workers),
+        'UPSTREAM_MODE': 'live',
+        'BITCOIN_PROVIDERS': 'blockchair',
+        'BLOCKCHAIR_URL': f'{stub_url}/blockchair',
+        'BLOCKCHAIR_TOKEN': 'bench',
+        'ETHERSCAN_TOKEN': 'bench',
+        'BITGO_URL': f'{stub_url}/bitgo',
+        'ETHERSCAN_URL': f'{stub_url}/etherscan/api',
+        'RIPPLE_URL': f'{stub_url}/ripple',
+        'TEZOS_RPC_URL': f'{stub_url}/tezos-rpc',
+        'TEZOS_TABLE_URL': f'{stub_url}/tezos-tables',
+        'SHARED_CACHE_PATH': f'{scratch}/shared.sqlite3',
+        'TRANSACTION_STORE_PATH': f'{scratch}/transactions.sqlite3',
+        'ADDRESS_INDEX_PATH': f'{scratch}/addresses.sqlite3',
+    }
+    env.pop('PROMETHEUS_MULTIPROC_DIR', None)
+    if not args.keep_rate_limits:
+        # the stubs have no quota, measure the service rather than the limiters
+        for name in LIMITED_PROVIDERS:
+            env[f'{name.upper()}_RATE_LIMIT'] = '100000'
+            env[f'{name.upper()}_RATE_BURST'] = '100000'
+    return env
+
+
+def process_tree(pid: int) -> List[int]:
+    pids = [pid]
+    try:
+        children = Path(f'/proc/{pid}/task/{pid}/children').read_text().split()
+    except OSError:
+        return pids
+    for child in children:
+        pids.extend(process_tree(int(child)))
+    return pids
+
+
+def peak_rss(pid: int) -> Dict[str, int]:
+    """VmHWM, the high-water mark of the resident set, in bytes for each process in the tree"""
+    peaks = {}
+    for process in process_tree(pid):
+        try:
+            status = Path(f'/proc/{process}/status').read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith('VmHWM:'):
+                peaks[str(process)] = int(line.split()[1]) * 1024
+    return peaks
+
+
+async def wait_until_ready(session: ClientSession, url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{process.args[0]} exited with {process.returncode}')
+        try:
+            async with session.get(url) as resp:
+                if resp.status == 200:
+                    return
+        except ClientError:
+            pass
+        await sleep(0.2)
+    raise TimeoutError(f'{url} was not ready after {timeout}s')
+
+
+async def drive(session: ClientSession, urls: List[str], concurrency: int) -> dict:
+    latencies = []
+    statuses: Dict[str, int] = {}
+    queue = iter(urls)
+
+    async def worker():
+        for url in queue:
+            started = perf_counter()
+            try:
+                async with session.get(url) as resp:
+                    await resp.read()
+                    status = str(resp.status)
+            except ClientError as e:
+                status = type(e).__name__
+            latencies.append(perf_counter() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    started = perf_counter()
+    await gather(*[worker() for _ in range(concurrency)])
+    elapsed = perf_counter() - started
+    latencies.sort()
+    return {
+        'requests': len(latencies),
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': round(1000 * sum(latencies) / len(latencies), 2) if latencies else 0.0,
+            'p50': round(1000 * percentile(latencies, 0.50), 2),
+            'p95': round(1000 * percentile(latencies, 0.95), 2),
+            'p99': round(1000 * percentile(latencies, 0.99), 2),
+            'max': round(1000 * latencies[-1], 2) if latencies else 0.0,
+        },
+        'statuses': statuses,
+    }
+
+
+def scenarios(args, base_url: str) -> Dict[str, List[str]]:
+    rng = random.Random(args.seed)
+    plans = {
+        'blockchains': [f'{base_url}/blockchains'] * args.requests,
+        'currencies': [f'{base_url}/currencies'] * args.requests,
+    }
+    for chain_id in args.chains:
+        pool = addresses(chain_id, args.pool_size)
+        urls = []
+        for _ in range(args.requests):
+            wallet = rng.sample(pool, min(args.wallet_size, len(pool)))
+            query = '&'.join(f'address={address}' for address in wallet)
+            urls.append(f'{base_url}/transactions?blockchain_id={chain_id}&{query}&max_page_size={args.page_size}'
+                        f'&include_raw={str(args.include_raw).lower()}')
+        plans[f'transactions:{chain_id}'] = urls
+    return plans
+
+
+def upstream_delta(before: Dict[str, int], after: Dict[str, int]) -> Dict[str, int]:
+    delta = {key: count - before.get(key, 0) for key, count in after.items()}
+    return {key: count for key, count in sorted(delta.items()) if count}
+
+
+async def benchmark(args, base_url: str, stub_url: str, server: subprocess.Popen, stubs: subprocess.Popen) -> dict:
+    connector = TCPConnector(limit=args.concurrency)
+    async with ClientSession(connector=connector, headers={'Accept-Encoding': args.accept_encoding}) as session:
+        await wait_until_ready(session, f'{stub_url}/_stats', stubs)
+        await wait_until_ready(session, f'{base_url}/blockchains/{args.chains[0]}', server)
+        results = {}
+        for name, urls in scenarios(args, base_url).items():
+            if args.warmup:
+                await drive(session, urls[:args.warmup], args.concurrency)
+            async with session.get(f'{stub_url}/_stats') as resp:
+                before = await resp.json()
+            results[name] = await drive(session, urls, args.concurrency)
+            async with session.get(f'{stub_url}/_stats') as resp:
+                results[name]['upstream_calls'] = upstream_delta(before, await resp.json())
+            print(f'{name}: {results[name]["throughput"]} req/s, p50 {results[name]["latency_ms"]["p50"]} ms, '
+                  f'p99 {results[name]["latency_ms"]["p99"]} ms', flush=True)
+        return results
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test Elysium against stub upstreams')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight')
+    parser.add_argument('--requests', type=int, default=500, help='requests per scenario')
+    parser.add_argument('--warmup', type=int, default=0, help='unmeasured requests before each scenario')
+    parser.add_argument('--wallet-size', type=int, default=5, help='addresses per /transactions request')
+    parser.add_argument('--pool-size', type=int, default=1000, help='addresses per chain wallets are drawn from')
+    parser.add_argument('--history', type=int, default=100, help='transactions per synthetic address')
+    parser.add_argument('--page-size', type=int, default=50, help='max_page_size of /transactions requests')
+    parser.add_argument('--include-raw', action='store_true', help='ask /transactions for raw transaction bytes')
+    parser.add_argument('--upstream-latency', type=float, default=0.0, help='seconds the stubs wait per response')
+    parser.add_argument('--workers', type=int, default=1, help='uvicorn worker processes')
+    parser.add_argument('--chains', type=lambda value: value.split(','), default=CHAINS)
+    parser.add_argument('--keep-rate-limits', action='store_true', help="keep the providers' upstream quotas")
+    parser.add_argument('--accept-encoding', default='gzip', help='Accept-Encoding header of every request')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench-results.json', help='where the JSON report is written')
+    args = parser.parse_args()
+
+    stub_port, port = free_port(), free_port()
+    stub_url, base_url = f'http://127.0.0.1:{stub_port}', f'http://127.0.0.1:{port}'
+    with tempfile.TemporaryDirectory(prefix='elysium-bench-') as scratch:
+        stubs = subprocess.Popen([sys.executable, '-m', 'bench.stubs', '--port', str(stub_port),
+                                  '--history', str(args.history), '--latency', str(args.upstream_latency)], cwd=ROOT)
+        server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'elysium:app', '--port', str(port),
+                                   '--workers', str(args.workers), '--log-level', 'warning'],
+                                  cwd=ROOT, env=server_env(args, stub_url, scratch))
+        try:
+            started = datetime.now(timezone.utc).isoformat()
+            results = run(benchmark(args, base_url, stub_url, server, stubs))
+            rss = peak_rss(server.pid)
+        finally:
+            for process in (server, stubs):
+                process.terminate()
+                process.wait(timeout=30)
+
+    report = {
+        'started': started,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'scenarios': results,
+        'peak_rss_bytes': {'total': sum(rss.values()), 'processes': rss} if rss else None,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2))
+    print(f'wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""
+Stub upstreams for the benchmark: one aiohttp server imitating the parts of the BlockChair, BitGo, Etherscan, Ripple
+Data API and tzstats APIs the providers use, under `/blockchair`, `/bitgo`, `/etherscan`, `/ripple`, `/tezos-rpc`
+and `/tezos-tables`. Every address has a synthetic history of `history` transactions, generated deterministically
+from the address so the same run always sees the same data. Request counts per provider and endpoint are served from
+`/_stats`.
+
+    python -m bench.stubs --port 9100 --history 200
+"""
+import argparse
+import os
+import re
+from collections import Counter
+from datetime import datetime, timezone
+from functools import lru_cache
+from hashlib import sha256
+from random import Random
+from asyncio import sleep
+from aiohttp import web
+
+TIPS = {
+    'bitcoin-mainnet': 700_000,
+    'bitcoin-testnet': 2_100_000,
+    'bitcoincash-mainnet': 710_000,
+    'litecoin-mainnet': 2_150_000,
+    'dogecoin-mainnet': 3_950_000,
+    'ethereum-mainnet': 13_500_000,
+    'ripple-mainnet': 66_000_000,
+    'tezos-mainnet': 1_850_000,
+}
+BLOCKCHAIR_CHAINS = {
+    'bitcoin': 'bitcoin-mainnet',
+    'bitcoin/testnet': 'bitcoin-testnet',
+    'bitcoin-cash': 'bitcoincash-mainnet',
+    'litecoin': 'litecoin-mainnet',
+    'dogecoin': 'dogecoin-mainnet',
+}
+BLOCKCHAIR_PATH = re.compile(
+    r'^(?P<chain>.+?)/(?P<endpoint>stats|dashboards/address|dashboards/transactions|raw/transaction)(/(?P<arg>.*))?$')
+SPREAD = 50_000  # blocks below the tip the synthetic histories are spread over
+RIPPLE_EPOCH = 946684800  # ledger close times are counted from 2000-01-01
+
+
+def addresses(chain_id: str, count: int):
+    """The synthetic addresses of a chain, the benchmark draws its wallets from these"""
+    if chain_id == 'ethereum-mainnet':
+        return [f'0x{sha256(f"{chain_id}{i}".encode()).hexdigest()[:40]}' for i in range(count)]
+    if chain_id == 'ripple-mainnet':
+        return [f'r{sha256(f"{chain_id}{i}".encode()).hexdigest()[:32]}' for i in range(count)]
+    if chain_id == 'tezos-mainnet':
+        return [f'tz1{sha256(f"{chain_id}{i}".encode()).hexdigest()[:33]}' for i in range(count)]
+    return [f'stub1{sha256(f"{chain_id}{i}".encode()).hexdigest()[:37]}' for i in range(count)]
+
+
+def txhash(*parts) -> str:
+    return sha256(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+class Stubs:
+    def __init__(self, history: int, latency: float):
+        self.history = history
+        self.latency = latency
+        self.calls = Counter()
+
+    @lru_cache(maxsize=100_000)
+    def heights(self, chain_id: str, address: str):
+        """Block heights of the address's transactions, ascending"""
+        rng = Random(f'{chain_id}:{address}')
+        tip = TIPS[chain_id]
+        return sorted(rng.randint(tip - SPREAD, tip) for _ in range(self.history))
+
+    async def hit(self, provider: str, endpoint: str):
+        self.calls[f'{provider} {endpoint}'] += 1
+        if self.latency:
+            await sleep(self.latency)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/_stats', self.stats)
+        app.router.add_get('/blockchair/{path:.*}', self.blockchair)
+        app.router.add_get('/bitgo/{coin}/tx/fee', self.bitgo)
+        app.router.add_get('/etherscan/api', self.etherscan)
+        app.router.add_get('/ripple/ledgers', self.ripple_tip)
+        app.router.add_get('/ripple/ledgers/{ledger}', self.ripple_ledger)
+        app.router.add_get('/ripple/accounts/{address}/transactions', self.ripple_transactions)
+        app.router.add_get('/tezos-rpc/chains/main/blocks/head/header', self.tezos_head)
+        app.router.add_get('/tezos-tables/op', self.tezos_ops)
+        return app
+
+    async def stats(self, request):
+        return web.json_response(dict(self.calls))
+
+    async def blockchair(self, request):
+        match = BLOCKCHAIR_PATH.match(request.match_info['path'])
+        if match is None or match['chain'] not in BLOCKCHAIR_CHAINS:
+            raise web.HTTPNotFound()
+        chain_id = BLOCKCHAIR_CHAINS[match['chain']]
+        endpoint = match['endpoint']
+        await self.hit('blockchair', endpoint)
+        if endpoint == 'stats':
+            return web.json_response({'data': {'best_block_height': TIPS[chain_id],
+                                               'best_block_hash': txhash(chain_id, TIPS[chain_id])}})
+        if endpoint == 'raw/transaction':
+            return web.json_response({'data': {h: {
+                'raw_transaction': txhash(h, 'raw') * 4,
+                'decoded_raw_transaction': {'txid': h, 'hash': h, 'size': 128}
+            } for h in match['arg'].split(',')}})
+        if endpoint == 'dashboards/transactions':
+            return web.json_response({'data': {h: {'transaction': {'hash': h, 'size': 128}}
+                                               for h in match['arg'].split(',')}})
+        address = match['arg']
+        rng = Random(address)
+        transactions = [{
+            'block_id': height,
+            'hash': txhash(chain_id, address, i),
+            'time': '2021-10-01 12:00:00',
+            'balance_change': rng.randint(-50_000, 100_000),
+        } for i, height in enumerate(self.heights(chain_id, address))]
+        transactions.sort(key=lambda txn: -txn['block_id'])
+        return web.json_response({'data': {address: {'transactions': transactions}}})
+
+    async def bitgo(self, request):
+        await self.hit('bitgo', 'tx/fee')
+        return web.json_response({'feePerKb': 20_000, 'numBlocks': 2})
+
+    async def etherscan(self, request):
+        module, action = request.query.get('module'), request.query.get('action')
+        await self.hit('etherscan', f'{module}.{action}')
+        tip = TIPS['ethereum-mainnet']
+        if action == 'eth_blockNumber':
+            return web.json_response({'result': hex(tip)})
+        if action == 'eth_getBlockByNumber':
+            return web.json_response({'result': {'number': request.query['tag'], 'hash': '0x' + txhash(tip)}})
+        if action == 'gasoracle':
+            return web.json_response({'status': '1', 'result': {'SafeGasPrice': '40', 'ProposeGasPrice': '50',
+                                                                'FastGasPrice': '60'}})
+        if action == 'gasestimate':
+            return web.json_response({'status': '1', 'result': '45'})
+        if action not in ('txlist', 'tokentx', 'txlistinternal'):
+            raise web.HTTPNotFound()
+        address = request.query['address']
+        start, end = int(request.query['startblock']), int(request.query['endblock'])
+        rows = []
+        for i, height in enumerate(self.heights('ethereum-mainnet', address)):
+            if not start <= height <= end:
+                continue
+            # every transaction is in txlist, every third also moved a token
+            if action == 'txlistinternal' or (action == 'tokentx' and i % 3):
+                continue
+            row = {
+                'hash': '0x' + txhash('ethereum-mainnet', address, i),
+                'blockNumber': str(height),
+                'blockHash': '0x' + txhash(height),
+                'timeStamp': str(1_600_000_000 + height),
+                'confirmations': str(tip - height),
+                'from': address,
+                'to': '0x' + txhash(i)[:40],
+                'value': str(10 ** 15 * (i + 1)),
+                'gas': '21000',
+                'gasUsed': '21000',
+                'gasPrice': '50000000000',
+                'nonce': str(i),
+                'isError': '0',
+            }
+            if action == 'tokentx':
+                row['contractAddress'] = '0xdac17f958d2ee523a2206206994597c13d831ec7'
+            rows.append(row)
+        rows = rows[:int(request.query.get('offset', '10000'))]
+        return web.json_response({'status': '1' if rows else '0', 'message': 'OK', 'result': rows})
+
+    async def ripple_tip(self, request):
+        await self.hit('ripple', 'ledgers')
+        tip = TIPS['ripple-mainnet']
+        return web.json_response({'ledger': {'ledger_index': tip, 'ledger_hash': txhash(tip).upper()}})
+
+    async def ripple_ledger(self, request):
+        await self.hit('ripple', 'ledgers/ledger')
+        return web.json_response({'ledger': {'close_time': RIPPLE_EPOCH + int(request.match_info['ledger']) * 4}})
+
+    async def ripple_transactions(self, request):
+        await self.hit('ripple', 'accounts/transactions')
+        address = request.match_info['address']
+        heights = list(enumerate(self.heights('ripple-mainnet', address)))
+        if request.query.get('descending') == 'true':
+            heights.reverse()
+        offset = int(request.query.get('marker', '0'))
+        limit = int(request.query.get('limit', '200'))
+        page = heights[offset:offset + limit]
+        transactions = [{
+            'hash': txhash('ripple-mainnet', address, i).upper(),
+            'ledger_index': height,
+            'date': datetime.fromtimestamp(RIPPLE_EPOCH + height * 4, timezone.utc).isoformat(),
+            'tx': {'Account': address, 'Destination': f'r{txhash(i)[:32]}', 'Amount': str(1_000_000 * (i + 1)),
+                   'Fee': '12', 'DestinationTag': i},
+            'meta': {'TransactionResult': 'tesSUCCESS'},
+        } for i, height in page]
+        body = {'transactions': transactions}
+        if offset + limit < len(heights):
+            body['marker'] = str(offset + limit)
+        return web.json_response(body)
+
+    async def tezos_head(self, request):
+        await self.hit('tezos', 'chains/main/blocks/head/header')
+        tip = TIPS['tezos-mainnet']
+        return web.json_response({'level': tip, 'hash': 'B' + txhash(tip)[:50]})
+
+    async def tezos_ops(self, request):
+        await self.hit('tezos', 'tables/op')
+        query = request.query
+        side = 'sender' if 'sender' in query else 'receiver'
+        address = query[side]
+        low, high = int(query.get('height.gte', '0')), int(query.get('height.lte', str(TIPS['tezos-mainnet'])))
+        cursor = int(query.get('cursor', '0'))
+        columns = query['columns'].split(',')
+        rows = []
+        for i, height in enumerate(self.heights('tezos-mainnet', address)):
+            # even operations were sent by the address, odd ones received
+            if (i % 2 == 0) != (side == 'sender') or not low <= height <= high:
+                continue
+            row_id = height * 1000 + i
+            if row_id <= cursor:
+                continue
+            op = {
+                'row_id': row_id,
+                'time': (1_600_000_000 + height * 30) * 1000,
+                'height': height,
+                'hash': 'o' + txhash('tezos-mainnet', address, i)[:50],
+                'type': 'transaction',
+                'status': 'applied',
+                'volume': 1.5 + i,
+                'fee': 0.00142,
+                'burned': 0,
+                'storage_size': 0,
+                'block': 'B' + txhash(height)[:50],
+                'sender': address if side == 'sender' else f'tz1{txhash(i)[:33]}',
+                'receiver': address if side == 'receiver' else f'tz1{txhash(i)[:33]}',
+            }
+            rows.append([op[column] for column in columns])
+        return web.json_response(rows[:int(query.get('limit', '100'))])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stub upstream APIs for the Elysium benchmark')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--history', type=int, default=100, help='transactions per address')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    args = parser.parse_args()
+    print(f'stub upstreams pid={os.getpid()} on {args.host}:{args.port}', flush=True)
+    web.run_app(Stubs(args.history, args.latency).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == '__main__':
+    main()
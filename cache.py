@@ -0,0 +1,227 @@
+import os
+import pickle
+import sqlite3
+from abc import ABC, abstractmethod
+from datetime import datetime
+from functools import wraps
+from pathlib import Path
+from time import time
+from typing import Any, Callable, Dict, Optional, Tuple
+from uuid import uuid4
+from aiohttp import ClientSession
+from memoize.configuration import MutableCacheConfiguration
+from memoize.entry import CacheKey, CacheEntry
+from memoize.key import KeyExtractor
+from memoize.storage import CacheStorage
+from metrics import CACHE_EVENTS
+
+CACHE_DIR = Path(__file__).resolve().parent / '.cache'
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'sqlite')
+SHARED_CACHE_PATH = os.getenv('SHARED_CACHE_PATH', str(CACHE_DIR / 'shared.sqlite3'))
+# seconds a call waits on another worker's write, it blocks the event loop for that long
+SHARED_CACHE_LOCK_TIMEOUT = float(os.getenv('SHARED_CACHE_LOCK_TIMEOUT', '0.05'))
+# identifies this worker when taking leases, unique even when workers share a pid namespace
+WORKER_ID = f'{os.getpid()}-{uuid4().hex[:8]}'
+
+
+class CacheBackend(ABC):
+    """
+    Expiring key/value storage for values that are worth sharing between every worker on a node. Values are
+    pickled, so anything a worker can build can be cached.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float):
+        pass
+
+    @abstractmethod
+    def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    def lease(self, name: str, ttl: float) -> bool:
+        """Takes or renews the named lease for this worker, False while another worker holds it"""
+        pass
+
+    def close(self):
+        pass
+
+
+class MemoryBackend(CacheBackend):
+    """Process-local backend, for a single worker or for tests"""
+
+    def __init__(self):
+        self._values: Dict[str, Tuple[float, Any]] = {}
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self._values.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time():
+            del self._values[key]
+            return None
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float):
+        self._values[key] = (time() + ttl, value)
+
+    def delete(self, key: str):
+        self._values.pop(key, None)
+
+    def lease(self, name: str, ttl: float) -> bool:
+        return True
+
+
+def unless_locked(default: Any = None) -> Callable:
+    """
+    Gives up on a shared cache call that finds the file locked by another worker for longer than the lock timeout,
+    returning `default` instead: a read is a miss, a write is skipped and a lease is not taken.
+    """
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            try:
+                return fn(self, *args, **kwargs)
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e):
+                    raise
+                CACHE_EVENTS.labels('shared_cache', 'locked').inc()
+                return default
+        return wrapper
+    return decorate
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    A WAL-mode SQLite file that every worker on the node opens, so one worker's upstream result is a hit for all of
+    them. Expired rows are skipped on read and purged every `purge_every` writes. Calls run on the event loop, so
+    they wait at most `lock_timeout` seconds for another worker's write before giving up.
+    """
+
+    def __init__(self, path: str = SHARED_CACHE_PATH, purge_every: int = 1000,
+                 lock_timeout: float = SHARED_CACHE_LOCK_TIMEOUT):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # setting up is done once per worker and may wait on the other workers doing the same
+        self._db = sqlite3.connect(path, isolation_level=None, timeout=5)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+                         'expires REAL NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, '
+                         'expires REAL NOT NULL)')
+        self._db.execute(f'PRAGMA busy_timeout = {int(lock_timeout * 1000)}')
+        self.purge_every = purge_every
+        self._writes = 0
+
+    @unless_locked()
+    def get(self, key: str) -> Optional[Any]:
+        row = self._db.execute('SELECT value FROM cache WHERE key = ? AND expires >= ?', (key, time())).fetchone()
+        return pickle.loads(row[0]) if row is not None else None
+
+    @unless_locked()
+    def set(self, key: str, value: Any, ttl: float):
+        self._db.execute('INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)',
+                         (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time() + ttl))
+        self._writes += 1
+        if self._writes % self.purge_every == 0:
+            self._db.execute('DELETE FROM cache WHERE expires < ?', (time(),))
+
+    @unless_locked()
+    def delete(self, key: str):
+        self._db.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    @unless_locked(default=False)
+    def lease(self, name: str, ttl: float) -> bool:
+        now = time()
+        self._db.execute(
+            'INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires '
+            'WHERE leases.owner = excluded.owner OR leases.expires < ?',
+            (name, WORKER_ID, now + ttl, now))
+        row = self._db.execute('SELECT owner FROM leases WHERE name = ?', (name,)).fetchone()
+        return row is not None and row[0] == WORKER_ID
+
+    def close(self):
+        self._db.close()
+
+
+def backend_from_env() -> CacheBackend:
+    if CACHE_BACKEND == 'memory':
+        return MemoryBackend()
+    if CACHE_BACKEND == 'sqlite':
+        return SQLiteBackend()
+    raise ValueError(f'Unknown CACHE_BACKEND: {CACHE_BACKEND}')
+
+
+class LazyBackend(CacheBackend):
+    """Builds its backend on first use, so importing a module that shares `CACHE` opens no files"""
+
+    def __init__(self, factory: Callable[[], CacheBackend]):
+        self._factory = factory
+        self._backend: Optional[CacheBackend] = None
+
+    @property
+    def backend(self) -> CacheBackend:
+        if self._backend is None:
+            self._backend = self._factory()
+        return self._backend
+
+    def get(self, key: str) -> Optional[Any]:
+        return self.backend.get(key)
+
+    def set(self, key: str, value: Any, ttl: float):
+        self.backend.set(key, value, ttl)
+
+    def delete(self, key: str):
+        self.backend.delete(key)
+
+    def lease(self, name: str, ttl: float) -> bool:
+        return self.backend.lease(name, ttl)
+
+    def close(self):
+        if self._backend is not None:
+            self._backend.close()
+            self._backend = None
+
+
+CACHE = LazyBackend(backend_from_env)
+
+
+class SharedCacheStorage(CacheStorage):
+    """Stores the entries of a memoized method in `CACHE` under `name`, instead of in the worker's memory"""
+
+    def __init__(self, name: str, backend: CacheBackend = CACHE):
+        self.name = name
+        self.backend = backend
+
+    async def get(self, key: CacheKey) -> Optional[CacheEntry]:
+        return self.backend.get(f'{self.name}:{key}')
+
+    async def offer(self, key: CacheKey, entry: CacheEntry) -> None:
+        ttl = (entry.expires_after - datetime.now()).total_seconds()
+        if ttl > 0:
+            self.backend.set(f'{self.name}:{key}', entry, ttl)
+
+    async def release(self, key: CacheKey) -> None:
+        self.backend.delete(f'{self.name}:{key}')
+
+
+class SharedKeyExtractor(KeyExtractor):
+    """
+    Keys on the method name and arguments, leaving out `self` and any session, whose reprs differ between workers
+    and would keep every worker from finding the others' entries.
+    """
+
+    def format_key(self, method_reference, call_args, call_kwargs) -> str:
+        args = tuple(arg for arg in call_args[1:] if not isinstance(arg, ClientSession))
+        kwargs = {k: v for k, v in call_kwargs.items() if not isinstance(v, ClientSession)}
+        return str((method_reference.__name__, args, kwargs))
+
+
+def shared(name: str, configuration: MutableCacheConfiguration) -> MutableCacheConfiguration:
+    """Moves a memoize configuration's entries onto the shared cache"""
+    return configuration.set_storage(SharedCacheStorage(name)).set_key_extractor(SharedKeyExtractor())
@@ -0,0 +1,136 @@
+import json
+import os
+import random
+from asyncio import sleep
+from base64 import b64encode, b64decode
+from hashlib import sha256
+from pathlib import Path
+from typing import Optional
+from aiohttp import ClientResponseError, RequestInfo
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+from cache import CACHE_DIR
+from providers.singleflight import SECRET_PARAMS
+
+# live: call upstreams, record: call upstreams and save every response, replay: serve saved responses only
+UPSTREAM_MODE = os.getenv('UPSTREAM_MODE', 'live')
+CASSETTE_DIR = os.getenv('CASSETTE_DIR', str(CACHE_DIR / 'cassettes'))
+REPLAY_LATENCY = float(os.getenv('REPLAY_LATENCY', '0'))  # seconds added to every replayed response
+REPLAY_JITTER = float(os.getenv('REPLAY_JITTER', '0'))  # +/- seconds of uniform noise on top of the latency
+REPLAY_ERROR_RATE = float(os.getenv('REPLAY_ERROR_RATE', '0'))  # share of replayed requests answered with a 503
+REPLAY_SEED = os.getenv('REPLAY_SEED')
+
+
+def request_url(url: str, params: Optional[dict]) -> URL:
+    """The request's URL with its query parameters in order and without credentials, which identifies a cassette"""
+    url = URL(url)
+    query = {**url.query, **{k: str(v) for k, v in (params or {}).items()}}
+    return url.with_query(sorted((k, v) for k, v in query.items() if k not in SECRET_PARAMS))
+
+
+class CassetteLibrary:
+    """
+    One JSON file per distinct upstream request under `directory/<host>/`, holding the status code and the body.
+    Recording wraps the live request; replaying answers from the files with the configured latency and error rate,
+    and fails loudly for requests that were never recorded.
+    """
+
+    def __init__(self, directory: str = CASSETTE_DIR, latency: float = REPLAY_LATENCY, jitter: float = REPLAY_JITTER,
+                 error_rate: float = REPLAY_ERROR_RATE, seed: Optional[str] = REPLAY_SEED):
+        self.directory = Path(directory)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+
+    def path(self, url: URL) -> Path:
+        return self.directory / (url.host or 'unknown') / f'{sha256(str(url).encode()).hexdigest()[:32]}.json'
+
+    def record(self, request, url: str, params: Optional[dict]) -> 'RecordingRequest':
+        return RecordingRequest(self, request, request_url(url, params))
+
+    def replay(self, url: str, params: Optional[dict]) -> 'ReplayedRequest':
+        return ReplayedRequest(self, request_url(url, params))
+
+    def save(self, url: URL, status: int, body: bytes):
+        try:
+            encoded = {'body': body.decode('utf-8')}
+        except UnicodeDecodeError:
+            encoded = {'body_base64': b64encode(body).decode('ascii')}
+        path = self.path(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # written under a temporary name first, a concurrent reader never sees half a cassette
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(json.dumps({'url': str(url), 'status': status, **encoded}, indent=1))
+        tmp.replace(path)
+
+    def load(self, url: URL) -> dict:
+        path = self.path(url)
+        if not path.exists():
+            raise LookupError(f'No cassette recorded for GET {url}')
+        return json.loads(path.read_text())
+
+
+class RecordingRequest:
+    """Passes a live request through and saves its response once the body has been read"""
+
+    def __init__(self, library: CassetteLibrary, request, url: URL):
+        self.library = library
+        self.request = request
+        self.url = url
+
+    async def __aenter__(self):
+        resp = await self.request.__aenter__()
+        # reading the body here caches it on the response, so the caller can still parse it as usual
+        self.library.save(self.url, resp.status, await resp.read())
+        return resp
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return await self.request.__aexit__(exc_type, exc, tb)
+
+
+class ReplayedRequest:
+    def __init__(self, library: CassetteLibrary, url: URL):
+        self.library = library
+        self.url = url
+
+    async def __aenter__(self) -> 'ReplayedResponse':
+        library = self.library
+        delay = library.latency + library.random.uniform(-library.jitter, library.jitter)
+        if delay > 0:
+            await sleep(delay)
+        if library.error_rate and library.random.random() < library.error_rate:
+            return ReplayedResponse(self.url, 503, b'{}')
+        cassette = library.load(self.url)
+        body = cassette['body'].encode('utf-8') if 'body' in cassette else b64decode(cassette['body_base64'])
+        return ReplayedResponse(self.url, cassette['status'], body)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class ReplayedResponse:
+    """The part of `aiohttp.ClientResponse` the providers use"""
+
+    def __init__(self, url: URL, status: int, body: bytes):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.headers = CIMultiDictProxy(CIMultiDict({'Content-Type': 'application/json'}))
+
+    async def read(self) -> bytes:
+        return self.body
+
+    async def text(self) -> str:
+        return self.body.decode('utf-8')
+
+    async def json(self, **kwargs):
+        return json.loads(self.body)
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            request_info = RequestInfo(self.url, 'GET', self.headers, self.url)
+            raise ClientResponseError(request_info, (), status=self.status, message='Replayed error')
+
+    def release(self):
+        pass
@@ -1,92 +1,217 @@
-from datetime import timedelta
-from typing import List, Dict
-from asyncio import gather
-from aiohttp import ClientSession
-from memoize.wrapper import memoize
-from memoize.configuration import MutableCacheConfiguration, DefaultInMemoryCacheConfiguration
-from memoize.key import EncodedMethodNameAndArgsKeyExtractor
+import os
+import sys
+from typing import List, Dict, AsyncIterator, Iterator, Tuple, Optional
+from asyncio import gather, ensure_future, as_completed
+from aiohttp import ClientSession, TCPConnector
+from aiohttp.resolver import AsyncResolver
+from yarl import URL
 from entities import Blockchain, Transaction, HeightPaginatedResponse
-from blockchains import BLOCKCHAINS
+from blockchains import BLOCKCHAINS, BLOCKCHAIN_MAP
+from store import TransactionStore, AddressIndex
+from tips import TIPS
+from cassettes import UPSTREAM_MODE, CassetteLibrary
 from providers.abstract import AbstractProvider
+from providers.ratelimit import CALLER
 from providers.blockchair import BlockChairProvider
+from providers.blockbook import BlockbookProvider
+from providers.blockcypher import BlockCypherProvider
+from providers.routing import RoutingProvider
 from providers.bitgo import BitgoFeeProvider
 from providers.etherscan import EtherscanProvider
 from providers.ripple import RippleProvider
 from providers.tezos import TezosProvider
 
+UPSTREAM_CONNECTION_LIMIT = int(os.getenv('UPSTREAM_CONNECTION_LIMIT', '32'))
+UPSTREAM_KEEPALIVE_TIMEOUT = float(os.getenv('UPSTREAM_KEEPALIVE_TIMEOUT', '60'))
+UPSTREAM_DNS_CACHE_TTL = int(os.getenv('UPSTREAM_DNS_CACHE_TTL', '300'))
+# Bitcoin-family backends in order of preference, later ones take hedged and failed over calls
+BITCOIN_PROVIDERS = os.getenv('BITCOIN_PROVIDERS', 'blockchair,blockcypher,blockbook').split(',')
 
-def blockchain_cache_config():
-    return MutableCacheConfiguration.initialized_with(DefaultInMemoryCacheConfiguration(
-        capacity=1000,
-        method_timeout=timedelta(seconds=60),
-        update_after=timedelta(seconds=10),
-        expire_after=timedelta(seconds=10),
-    )).set_key_extractor(EncodedMethodNameAndArgsKeyExtractor(skip_first_arg_as_self=True))
+
+def transaction_order(txn: Transaction) -> Tuple[int, str]:
+    """
+    Sorts by height then transaction id, with pending transactions (no height yet) after the rest. `index` is not
+    used, providers set it to the position in one address's listing rather than in the block, so it does not order
+    the transactions of different addresses against each other.
+    """
+    return (txn.block_height if txn.block_height > 0 else sys.maxsize), txn.transaction_id
+
+
+def upstream_connector() -> TCPConnector:
+    return TCPConnector(
+        limit=UPSTREAM_CONNECTION_LIMIT,
+        keepalive_timeout=UPSTREAM_KEEPALIVE_TIMEOUT,
+        use_dns_cache=True,
+        ttl_dns_cache=UPSTREAM_DNS_CACHE_TTL,
+        resolver=AsyncResolver(),
+    )
 
 
 class Client(ClientSession):
+    """
+    Long-lived upstream session shared by every request. Each upstream host gets its own session and connector, so
+    keep-alive connections, cached DNS lookups and the connection limit are tracked per host. With `UPSTREAM_MODE`
+    set to `record` or `replay` every upstream response is saved to, or served from, the cassette library.
+    """
     provider_map: Dict[str, AbstractProvider]
+    host_sessions: Dict[str, ClientSession]
+    transaction_store: TransactionStore
+    address_index: AddressIndex
+    cassettes: CassetteLibrary
 
     def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
+        super().__init__(*args, connector=upstream_connector(), **kwargs)
+        self.host_sessions = {}
+        self.transaction_store = TransactionStore()
+        self.address_index = AddressIndex()
+        self.cassettes = CassetteLibrary()
         bitgo = BitgoFeeProvider()
-        blockchair = BlockChairProvider(bitgo)
+        backends = {
+            'blockchair': BlockChairProvider(bitgo, self.transaction_store),
+            'blockcypher': BlockCypherProvider(bitgo),
+            'blockbook': BlockbookProvider(bitgo),
+        }
+        for name in BITCOIN_PROVIDERS:
+            if name not in backends:
+                raise ValueError(f'Unknown provider in BITCOIN_PROVIDERS: {name}')
+        bitcoin = RoutingProvider([(name, backends[name]) for name in BITCOIN_PROVIDERS])
         self.provider_map = {
-            'bitcoin-mainnet': blockchair,
-            'bitcoin-testnet': blockchair,
-            'bitcoincash-mainnet': blockchair,
-            'litecoin-mainnet': blockchair,
-            'dogecoin-mainnet': blockchair,
+            'bitcoin-mainnet': bitcoin,
+            'bitcoin-testnet': bitcoin,
+            'bitcoincash-mainnet': bitcoin,
+            'litecoin-mainnet': bitcoin,
+            'dogecoin-mainnet': bitcoin,
             'ethereum-mainnet': EtherscanProvider(),
             'ripple-mainnet': RippleProvider(),
             'tezos-mainnet': TezosProvider(),
         }
 
+    def get(self, url, **kwargs):
+        if UPSTREAM_MODE == 'replay':
+            return self.cassettes.replay(url, kwargs.get('params'))
+        host = URL(url).host
+        if host not in self.host_sessions:
+            self.host_sessions[host] = ClientSession(connector=upstream_connector())
+        request = self.host_sessions[host].get(url, **kwargs)
+        if UPSTREAM_MODE == 'record':
+            return self.cassettes.record(request, url, kwargs.get('params'))
+        return request
+
+    async def close(self) -> None:
+        sessions = list(self.host_sessions.values())
+        self.host_sessions = {}
+        await gather(*(session.close() for session in sessions))
+        self.transaction_store.close()
+        self.address_index.close()
+        await super().close()
+
     def _get_provider(self, blockchain_id: str) -> AbstractProvider:
         if blockchain_id not in self.provider_map:
             raise ValueError(f'Unsupported chain: {blockchain_id}')
         return self.provider_map[blockchain_id]
 
-    @memoize(configuration=blockchain_cache_config())
     async def get_blockchain(self, chain_id: str) -> Blockchain:
-        print('rendering blockchain')
-        provider = self._get_provider(chain_id)
-        return await provider.get_blockchain_data(self, chain_id)
+        self._get_provider(chain_id)
+        return await TIPS.blockchain(chain_id)
 
-    @memoize(configuration=blockchain_cache_config())
     async def get_blockchains(self, testnet: bool) -> List[Blockchain]:
-        print('rendering blockchains')
-        tasks = []
-        for chain in BLOCKCHAINS:
-            if (testnet and chain['is_mainnet']) or (not testnet and not chain['is_mainnet']):
-                continue
-            provider = self._get_provider(chain['id'])
-            tasks.append(provider.get_blockchain_data(self, chain['id']))
-        results = await gather(*tasks)
-        return list(results)
+        chain_ids = [chain['id'] for chain in BLOCKCHAINS if chain['is_mainnet'] != testnet]
+        return list(await gather(*(self.get_blockchain(chain_id) for chain_id in chain_ids)))
+
+    async def fetch_blockchain(self, chain_id: str) -> Blockchain:
+        """Looks the chain's head up upstream, only called by the tip registry"""
+        provider = self._get_provider(chain_id)
+        return await provider.get_blockchain_data(self, chain_id)
 
     async def get_transactions(self, addresses: List[str], blockchain_id: str, start_height: int, end_height: int,
-                               max_page_size: int, include_raw: bool) -> HeightPaginatedResponse[Transaction]:
+                               max_page_size: int, include_raw: bool,
+                               positions: Optional[Dict[str, Tuple[int, int]]] = None
+                               ) -> HeightPaginatedResponse[Transaction]:
+        """
+        With `positions`, the `{address: (start_height, end_height)}` of a previous page's continuations, each of
+        those addresses resumes from its own position and the other addresses, which were finished, are skipped.
+        """
         provider = self._get_provider(blockchain_id)
+        tip_height = (await self.get_blockchain(blockchain_id)).verified_height
 
-        tasks = [provider.get_address_transactions(session=self, chain_id=blockchain_id,
-                                                   address=addr, start_height=start_height,
-                                                   end_height=end_height) for addr in addresses]
+        # every upstream call made for this request queues behind the rate limiters as one caller
+        caller = object()
+        tasks = [self._get_batch_transactions(provider, blockchain_id, batch, start, end, tip_height, include_raw,
+                                              caller)
+                 for batch, start, end in self.plan(provider, addresses, start_height, end_height, positions)]
         results = await gather(*tasks)
+        return self.combine([resp for batch in results for resp in batch])
+
+    async def get_transactions_by_address(self, addresses: List[str], blockchain_id: str, start_height: int,
+                                          end_height: int, positions: Optional[Dict[str, Tuple[int, int]]] = None,
+                                          include_raw: bool = False
+                                          ) -> Dict[str, HeightPaginatedResponse[Transaction]]:
+        """Like `get_transactions`, but keeps each address's page apart"""
+        provider = self._get_provider(blockchain_id)
+        tip_height = (await self.get_blockchain(blockchain_id)).verified_height
+
+        caller = object()
+        batches = self.plan(provider, addresses, start_height, end_height, positions)
+        results = await gather(*(self._get_batch_transactions(provider, blockchain_id, batch, start, end, tip_height,
+                                                              include_raw, caller) for batch, start, end in batches))
+        return {address: resp for (batch, _, _), batch_results in zip(batches, results)
+                for address, resp in zip(batch, batch_results)}
 
-        all_txns = []
+    async def iter_transactions(self, addresses: List[str], blockchain_id: str, start_height: int, end_height: int,
+                                max_page_size: int, include_raw: bool,
+                                positions: Optional[Dict[str, Tuple[int, int]]] = None
+                                ) -> AsyncIterator[HeightPaginatedResponse[Transaction]]:
+        """Like `get_transactions`, but yields each address's page as soon as its provider call completes"""
+        provider = self._get_provider(blockchain_id)
+        tip_height = (await self.get_blockchain(blockchain_id)).verified_height
+
+        caller = object()
+        tasks = [ensure_future(self._get_batch_transactions(provider, blockchain_id, batch, start, end, tip_height,
+                                                            include_raw, caller))
+                 for batch, start, end in self.plan(provider, addresses, start_height, end_height, positions)]
+        try:
+            for next_done in as_completed(tasks):
+                for resp in await next_done:
+                    yield resp
+        finally:
+            # the client may go away before every address has been fetched
+            for task in tasks:
+                task.cancel()
+
+    @staticmethod
+    def plan(provider: AbstractProvider, addresses: List[str], start_height: int, end_height: int,
+             positions: Optional[Dict[str, Tuple[int, int]]]) -> List[Tuple[List[str], int, int]]:
+        """The `(addresses, start_height, end_height)` of each call, addresses at the same position share calls"""
+        if positions is None:
+            positions = {address: (start_height, end_height) for address in addresses}
+        groups: Dict[Tuple[int, int], List[str]] = {}
+        for address, position in positions.items():
+            groups.setdefault(position, []).append(address)
+        return [(batch, start, end) for (start, end), group in groups.items()
+                for batch in Client.batches(provider, group)]
+
+    @staticmethod
+    def batches(provider: AbstractProvider, addresses: List[str]) -> List[List[str]]:
+        """Groups the addresses into as few calls as the provider's batch size allows"""
+        size = max(provider.max_batch_size, 1)
+        return [addresses[i:i + size] for i in range(0, len(addresses), size)]
+
+    @staticmethod
+    def combine(results: List[HeightPaginatedResponse[Transaction]]) -> HeightPaginatedResponse[Transaction]:
         lowest_next_start_height = None
         highest_next_end_height = None
+        continuations = {}
 
         for resp in results:
+            continuations.update(resp.continuations)
             if resp.has_more:
                 if lowest_next_start_height is None or resp.next_start_height < lowest_next_start_height:
                     lowest_next_start_height = resp.next_start_height
                 if highest_next_end_height is None or resp.next_end_height > highest_next_end_height:
                     highest_next_end_height = resp.next_end_height
-            all_txns.extend(resp.contents)
 
-        resp = HeightPaginatedResponse(contents=all_txns, has_more=False)
+        resp = HeightPaginatedResponse(contents=list(Client.merge(results)), has_more=False,
+                                       continuations=continuations)
 
         if lowest_next_start_height is not None or highest_next_end_height is not None:
             resp.has_more = True
@@ -94,3 +219,117 @@ class Client(ClientSession):
             resp.next_end_height = highest_next_end_height
 
         return resp
+
+    @staticmethod
+    def merge(results: List[HeightPaginatedResponse[Transaction]]) -> Iterator[Transaction]:
+        """
+        Merges the addresses' pages into one sequence in `transaction_order`, pending transactions last. A
+        transaction found through several of the wallet's addresses is yielded once, with the transfers of every view
+        of it. Transactions are bucketed by height, so only the distinct heights and each height's ids are sorted.
+        """
+        heights: Dict[int, Dict[str, Transaction]] = {}
+        for resp in results:
+            for txn in resp.contents:
+                group = heights.setdefault(transaction_order(txn)[0], {})
+                seen = group.get(txn.transaction_id)
+                group[txn.transaction_id] = txn if seen is None else seen.merge(txn)
+        for height in sorted(heights):
+            group = heights[height]
+            yield from (group[txid] for txid in sorted(group))
+
+    @staticmethod
+    def complete_height(resp: HeightPaginatedResponse[Transaction], end_height: int) -> Optional[int]:
+        """
+        The height up to which a response holds every transaction from where its fetch began. A provider paging
+        upwards continues at the top of the range, so everything below its continuation is complete already, while
+        one paging downwards is only complete once it has no continuation left.
+        """
+        if not resp.has_more:
+            return end_height
+        if resp.next_start_height is not None and resp.next_end_height is not None and \
+                resp.next_end_height >= end_height:
+            return resp.next_start_height - 1
+        return None
+
+    async def _get_batch_transactions(self, provider: AbstractProvider, blockchain_id: str, addresses: List[str],
+                                      start_height: int, end_height: int, tip_height: int, include_raw: bool,
+                                      caller: object) -> List[HeightPaginatedResponse[Transaction]]:
+        """
+        Serves whatever part of the range the address index already covers and only asks the provider for the delta
+        above the highest final height scanned so far, then records the newly final transactions in the index. A
+        batch of addresses is fetched with one provider call from the lowest height any of them still needs.
+
+        The index keeps transactions as they were fetched, with or without their raw bytes. Raw bytes are dropped
+        from what it serves unless `include_raw` asks for them, and an address indexed without them is fetched again
+        from `start_height` with them, which also fills them into the index.
+        """
+        # runs in its own task, so this only marks the upstream calls made on behalf of these addresses
+        CALLER.set(caller)
+        histories = {address: self.address_index.get(blockchain_id, address, tip_height, start_height, end_height)
+                     for address in addresses}
+        known = {}
+        fetch_from = {}
+        for address, history in histories.items():
+            known[address] = []
+            fetch_from[address] = start_height
+            if history is not None:
+                known[address] = history.transactions
+                fetch_from[address] = max(start_height, history.scanned_height + 1)
+            if not include_raw:
+                for txn in known[address]:
+                    txn.raw = None
+            elif provider.provides_raw and any(txn.raw is None for txn in known[address]):
+                known[address] = []
+                fetch_from[address] = start_height
+
+        pending = [address for address in addresses if fetch_from[address] <= end_height]
+        if len(pending) > 1:
+            responses = await provider.get_addresses_transactions(
+                session=self, chain_id=blockchain_id, addresses=pending,
+                start_height=min(fetch_from[address] for address in pending), end_height=end_height,
+                include_raw=include_raw)
+        elif pending:
+            address = pending[0]
+            responses = {address: await provider.get_address_transactions(
+                session=self, chain_id=blockchain_id, address=address, start_height=fetch_from[address],
+                end_height=end_height, include_raw=include_raw)}
+        else:
+            responses = {}
+        # an address left out of a batch's answer is unknown, not empty, and must not be served or indexed as empty
+        missing = [address for address in pending if address not in responses]
+        if missing:
+            raise ValueError(f'No transactions returned for {", ".join(missing)} on {blockchain_id}')
+
+        confirmations_until_final = BLOCKCHAIN_MAP.get(blockchain_id, {}).get('confirmations_until_final')
+        results = []
+        for address in addresses:
+            resp = responses.get(address)
+            if resp is None:
+                results.append(HeightPaginatedResponse(contents=known[address], has_more=False))
+                continue
+            history = histories[address]
+            # not every provider can filter by height upstream, and a batch starts at its lowest height, so drop
+            # anything below where this address's fetch began
+            resp.contents = [txn for txn in resp.contents if not 0 < txn.block_height < fetch_from[address]]
+
+            # the index only ever describes a contiguous scan starting at the beginning of the address's history
+            contiguous = start_height == 0 if history is None else start_height <= history.scanned_height + 1
+            complete_height = Client.complete_height(resp, end_height)
+            if contiguous and complete_height is not None and confirmations_until_final is not None:
+                final_height = min(complete_height, tip_height - confirmations_until_final)
+                refetched = history is not None and fetch_from[address] <= history.scanned_height
+                if history is None or final_height > history.scanned_height or refetched:
+                    final = [txn for txn in resp.contents if 0 < txn.block_height <= final_height]
+                    # a refetch for raw bytes replaces indexed transactions, it never shrinks the scanned range
+                    scanned_height = final_height if history is None else max(final_height, history.scanned_height)
+                    self.address_index.extend(blockchain_id, address, final, tip_height=tip_height,
+                                              scanned_height=scanned_height)
+
+            continuations = {}
+            if resp.has_more:
+                continuations[address] = (resp.next_start_height, resp.next_end_height)
+            results.append(HeightPaginatedResponse(contents=known[address] + resp.contents, has_more=resp.has_more,
+                                                   next_start_height=resp.next_start_height,
+                                                   next_end_height=resp.next_end_height,
+                                                   continuations=continuations))
+        return results
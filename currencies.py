@@ -0,0 +1,93 @@
+import gzip
+import json
+from functools import lru_cache
+from hashlib import sha256
+from pathlib import Path
+from typing import Dict, List, Optional
+import brotli
+
+CURRENCIES_PATH = Path(__file__).resolve().parent / 'resources' / 'currencies.json'
+
+
+class EncodedBody:
+    """A JSON document serialized once, with its gzip and brotli variants and their strong ETags"""
+
+    def __init__(self, document: dict):
+        identity = json.dumps(document, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+        digest = sha256(identity).hexdigest()[:32]
+        self.variants = {
+            'br': brotli.compress(identity),
+            'gzip': gzip.compress(identity, mtime=0),
+            'identity': identity,
+        }
+        # each encoding is a different representation, so each gets its own strong validator
+        self.etags = {encoding: f'"{digest}-{encoding}"' for encoding in self.variants}
+
+    def negotiate(self, accept_encoding: str) -> str:
+        accepted = set()
+        for token in accept_encoding.split(','):
+            coding, *params = token.split(';')
+            quality = 1.0
+            for param in params:
+                name, _, value = param.strip().partition('=')
+                if name == 'q':
+                    try:
+                        quality = float(value)
+                    except ValueError:
+                        quality = 0.0
+            if quality > 0:
+                accepted.add(coding.strip().lower())
+        for encoding in ('br', 'gzip'):
+            if encoding in accepted or '*' in accepted:
+                return encoding
+        return 'identity'
+
+    def matches(self, if_none_match: str) -> bool:
+        tags = {tag.strip() for tag in if_none_match.split(',')}
+        return '*' in tags or any(etag in tags or f'W/{etag}' in tags for etag in self.etags.values())
+
+
+class CurrencyCatalog:
+    """
+    The currency catalog, parsed once and indexed by `blockchain_id` and `currency_id`. Encoded responses are
+    computed ahead of time for the whole catalog and for each blockchain, other filters are encoded on first use.
+    """
+
+    def __init__(self, document: dict):
+        self.links = document.get('_links', {})
+        self.currencies: List[dict] = document['_embedded']['currencies']
+        self.by_currency_id: Dict[str, dict] = {c['currency_id']: c for c in self.currencies}
+        self.by_blockchain_id: Dict[str, List[dict]] = {}
+        for currency in self.currencies:
+            self.by_blockchain_id.setdefault(currency['blockchain_id'], []).append(currency)
+        self.encoded(None, None, None)
+        for blockchain_id in self.by_blockchain_id:
+            self.encoded(blockchain_id, None, None)
+
+    @classmethod
+    def load(cls, path: Path = CURRENCIES_PATH) -> 'CurrencyCatalog':
+        with path.open('r') as f:
+            return cls(json.load(f))
+
+    def select(self, blockchain_id: Optional[str], currency_id: Optional[str],
+               verified: Optional[bool]) -> List[dict]:
+        if currency_id is not None:
+            currency = self.by_currency_id.get(currency_id)
+            selected = [currency] if currency is not None else []
+        elif blockchain_id is not None:
+            selected = self.by_blockchain_id.get(blockchain_id, [])
+        else:
+            selected = self.currencies
+        return [c for c in selected
+                if (blockchain_id is None or c['blockchain_id'] == blockchain_id)
+                and (verified is None or c['verified'] == verified)]
+
+    @lru_cache(maxsize=256)
+    def encoded(self, blockchain_id: Optional[str], currency_id: Optional[str],
+                verified: Optional[bool]) -> EncodedBody:
+        return EncodedBody({
+            '_embedded': {
+                'currencies': self.select(blockchain_id, currency_id, verified)
+            },
+            '_links': self.links
+        })
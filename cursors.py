@@ -0,0 +1,71 @@
+import hmac
+import json
+import os
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from binascii import Error as DecodeError
+from functools import lru_cache
+from hashlib import sha256
+from pathlib import Path
+from secrets import token_hex
+from typing import Dict, Tuple, Optional
+from cache import CACHE_DIR
+
+CURSOR_SECRET_PATH = CACHE_DIR / 'cursor_secret'
+
+
+@lru_cache(maxsize=None)
+def cursor_secret() -> bytes:
+    """
+    Read from `CURSOR_SECRET`, which has to be shared by every node behind one address. Without it the first worker
+    on the node generates one under `.cache/` when the first cursor is signed or checked, which every other worker
+    reads, so cursors are only valid on the node that issued them.
+    """
+    if os.getenv('CURSOR_SECRET'):
+        return os.getenv('CURSOR_SECRET').encode()
+    path = Path(CURSOR_SECRET_PATH)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        tmp.write_text(token_hex(32))
+        try:
+            # linking fails if another worker got there first, then its secret is the one everyone uses
+            os.link(tmp, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp.unlink()
+    return path.read_bytes()
+
+
+def _signature(payload: bytes) -> str:
+    digest = hmac.new(cursor_secret(), payload, sha256).digest()[:16]
+    return urlsafe_b64encode(digest).decode('ascii').rstrip('=')
+
+
+def encode_cursor(blockchain_id: str, positions: Dict[str, Tuple[int, int]]) -> str:
+    """
+    An opaque token holding the `(next_start_height, next_end_height)` of every address that still has
+    transactions to page through, signed so clients can't point it at other addresses or heights.
+    """
+    body = json.dumps({'c': blockchain_id, 'p': positions}, separators=(',', ':')).encode('utf-8')
+    payload = urlsafe_b64encode(body).decode('ascii').rstrip('=')
+    return f'{payload}.{_signature(payload.encode("ascii"))}'
+
+
+def decode_cursor(cursor: str, blockchain_id: str) -> Optional[Dict[str, Tuple[int, int]]]:
+    """
+    The positions `encode_cursor` was given. None for a cursor signed with another secret, like one issued by another
+    node without a shared `CURSOR_SECRET` or before a restart that changed it, raises ValueError for one that can't
+    be used for this chain.
+    """
+    payload, _, signature = cursor.partition('.')
+    expected = _signature(payload.encode('utf-8'))
+    if not hmac.compare_digest(signature.encode('utf-8'), expected.encode('ascii')):
+        return None
+    try:
+        body = json.loads(urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+    except (DecodeError, ValueError):
+        raise ValueError('Invalid cursor')
+    if body.get('c') != blockchain_id:
+        raise ValueError(f'Cursor was issued for {body.get("c")}, not {blockchain_id}')
+    return {address: (start, end) for address, (start, end) in body['p'].items()}
@@ -0,0 +1,115 @@
+import os
+from asyncio import gather, get_event_loop
+from typing import List, Dict, Tuple, Callable, Awaitable
+from hdwallet import BIP32HDWallet
+from hdwallet.cryptocurrencies import BitcoinMainnet, BitcoinTestnet, LitecoinMainnet, DogecoinMainnet, \
+    EthereumMainnet
+from ecashaddress.convert import Address as BCHAddress
+from entities import HeightPaginatedResponse, Transaction, WalletAddress
+
+GAP_LIMIT = int(os.getenv('DISCOVERY_GAP_LIMIT', '20'))  # consecutive unused addresses that end a chain
+WINDOWS = int(os.getenv('DISCOVERY_WINDOWS', '3'))  # gap-limit sized blocks of a chain scanned concurrently
+MAX_ADDRESSES = int(os.getenv('DISCOVERY_MAX_ADDRESSES', '1000'))  # most indexes scanned per chain
+
+# how each chain's wallets lay out and encode their addresses, as in tests/test_diff.py
+SCHEMES = {
+    'bitcoin-mainnet': {'crypto': BitcoinMainnet, 'formats': ['p2pkh', 'p2wpkh'], 'change': True},
+    'bitcoin-testnet': {'crypto': BitcoinTestnet, 'formats': ['p2pkh', 'p2wpkh'], 'change': True},
+    'bitcoincash-mainnet': {'crypto': BitcoinMainnet, 'formats': ['p2pkh'], 'change': True, 'cashaddr': 'bitcoincash'},
+    'litecoin-mainnet': {'crypto': LitecoinMainnet, 'formats': ['p2pkh', 'p2wpkh'], 'change': True},
+    'dogecoin-mainnet': {'crypto': DogecoinMainnet, 'formats': ['p2pkh'], 'change': True},
+    'ethereum-mainnet': {'crypto': EthereumMainnet, 'formats': ['p2pkh'], 'change': False, 'lower': True},
+}
+FORMATS = {'p2pkh', 'p2sh', 'p2wpkh', 'p2wpkh_in_p2sh'}
+
+Derive = Callable[[int, int], Awaitable[List[Tuple[int, WalletAddress]]]]
+Fetch = Callable[[List[str]], Awaitable[Dict[str, HeightPaginatedResponse[Transaction]]]]
+
+
+class AddressDeriver:
+    """Derives a wallet's addresses below an account-level extended public key, `{chain}/{index}` in each format"""
+
+    def __init__(self, blockchain_id: str, xpub: str, formats: List[str] = None):
+        if blockchain_id not in SCHEMES:
+            raise ValueError(f'Wallet discovery is not supported for {blockchain_id}')
+        self.scheme = SCHEMES[blockchain_id]
+        self.xpub = xpub
+        self.formats = formats or self.scheme['formats']
+        if not set(self.formats) <= FORMATS or (self.scheme.get('lower') and self.formats != ['p2pkh']):
+            raise ValueError(f'Unsupported address formats for {blockchain_id}: {",".join(self.formats)}')
+        # fails early for a key that doesn't parse
+        self._wallet()
+
+    @property
+    def chains(self) -> List[int]:
+        """The external chain, and the internal (change) chain where the scheme has one"""
+        return [0, 1] if self.scheme['change'] else [0]
+
+    def _wallet(self) -> BIP32HDWallet:
+        wallet = BIP32HDWallet(cryptocurrency=self.scheme['crypto'])
+        wallet.from_xpublic_key(self.xpub, strict=False)
+        return wallet
+
+    def derive(self, chain: int, start: int, count: int) -> List[Tuple[int, WalletAddress]]:
+        # a wallet per call, derivations run on executor threads and the wallet keeps its path as state
+        wallet = self._wallet()
+        derived = []
+        for index in range(start, start + count):
+            wallet.clean_derivation()
+            wallet.from_index(chain)
+            wallet.from_index(index)
+            for fmt in self.formats:
+                address = getattr(wallet, f'{fmt}_address')()
+                if self.scheme.get('lower'):
+                    address = address.lower()
+                if self.scheme.get('cashaddr'):
+                    address = BCHAddress.from_string(address).to_cash_address(self.scheme['cashaddr'])
+                derived.append((index, WalletAddress.trusted(address=address, path=f'{chain}/{index}', format=fmt)))
+        return derived
+
+    async def derive_async(self, chain: int, start: int, count: int) -> List[Tuple[int, WalletAddress]]:
+        """Elliptic curve math is CPU bound, so derivation stays off the event loop"""
+        return await get_event_loop().run_in_executor(None, self.derive, chain, start, count)
+
+
+async def scan_chain(derive: Derive, fetch: Fetch, gap_limit: int = GAP_LIMIT, windows: int = WINDOWS,
+                     max_addresses: int = MAX_ADDRESSES
+                     ) -> List[Tuple[WalletAddress, HeightPaginatedResponse[Transaction]]]:
+    """
+    Scans one chain of a wallet until `gap_limit` consecutive indexes are unused. Each wave derives and fetches
+    `windows` blocks of `gap_limit` indexes at once, so a wallet with a few hundred used addresses is found in a
+    handful of waves rather than one round trip per block.
+    """
+    last_used = -1
+    scanned = 0
+    found = []
+    while scanned < max_addresses and scanned - last_used - 1 < gap_limit:
+        starts = list(range(scanned, min(scanned + windows * gap_limit, max_addresses), gap_limit))
+        blocks = await gather(*(scan_block(derive, fetch, start, min(gap_limit, max_addresses - start))
+                                for start in starts))
+        for block in blocks:
+            for index, wallet_address, resp in block:
+                if resp.contents or resp.has_more:
+                    last_used = max(last_used, index)
+                    found.append((wallet_address, resp))
+        scanned = min(starts[-1] + gap_limit, max_addresses)
+    return found
+
+
+async def scan_block(derive: Derive, fetch: Fetch, start: int,
+                     count: int) -> List[Tuple[int, WalletAddress, HeightPaginatedResponse[Transaction]]]:
+    derived = await derive(start, count)
+    responses = await fetch([wallet_address.address for _, wallet_address in derived])
+    return [(index, wallet_address, responses[wallet_address.address]) for index, wallet_address in derived]
+
+
+async def discover(client, deriver: AddressDeriver, blockchain_id: str, end_height: int, gap_limit: int = GAP_LIMIT,
+                   windows: int = WINDOWS) -> List[Tuple[WalletAddress, HeightPaginatedResponse[Transaction]]]:
+    """The used addresses of every chain of the wallet, each with its first page of transactions"""
+
+    async def fetch(addresses: List[str]) -> Dict[str, HeightPaginatedResponse[Transaction]]:
+        return await client.get_transactions_by_address(addresses, blockchain_id, 0, end_height)
+
+    chains = await gather(*(scan_chain(lambda start, count, chain=chain: deriver.derive_async(chain, start, count),
+                                       fetch, gap_limit, windows) for chain in deriver.chains))
+    return [found for chain in chains for found in chain]
@@ -1,20 +1,51 @@
-import json
+import os
+from urllib.parse import urlencode
 from datetime import datetime, timedelta
-from pathlib import Path
-from typing import Optional, List
-from fastapi import FastAPI, Request, Query
-from entities import Collection, Link, Blockchain, Transaction, UserToken
-from client import Client
+from typing import Optional, List, Dict
+from fastapi import FastAPI, Request, Query, Depends, HTTPException
+from fastapi.responses import StreamingResponse, Response
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, CollectorRegistry, multiprocess
+from entities import Collection, Link, Blockchain, Transaction, UserToken, HeightPaginatedResponse, Amount, dumps, \
+    dumps_collection
+from client import Client, transaction_order
+from balances import compute_balances
+from currencies import CurrencyCatalog
+from cursors import encode_cursor, decode_cursor
+from discovery import AddressDeriver, discover, GAP_LIMIT
+from tips import TIPS
+from fees import FEES
+from metrics import MetricsMiddleware, FALLBACKS
+from providers.ratelimit import LIMITERS
+from providers.routing import RoutingProvider
 
 app = FastAPI()
+app.add_middleware(MetricsMiddleware)
+
+
+@app.on_event('startup')
+async def open_client():
+    app.state.client = Client()
+    app.state.currencies = CurrencyCatalog.load()
+    TIPS.start(app.state.client.fetch_blockchain, list(app.state.client.provider_map))
+
+
+@app.on_event('shutdown')
+async def close_client():
+    await TIPS.stop()
+    await FEES.stop()
+    await app.state.client.close()
+
+
+def get_client(request: Request) -> Client:
+    return request.app.state.client
 
 
 @app.get('/blockchains', response_model=Collection[Blockchain])
 async def get_blockchains(
         testnet: Optional[bool] = False,
-        include_experimental: Optional[bool] = False):
-    async with Client() as client:
-        chains = await client.get_blockchains(testnet=testnet)
+        include_experimental: Optional[bool] = False,
+        client: Client = Depends(get_client)):
+    chains = await client.get_blockchains(testnet=testnet)
     return Collection(
         _embedded={
             'blockchains': chains,
@@ -24,17 +55,31 @@ async def get_blockchains(
 
 
 @app.get('/blockchains/{blockchain_id}', response_model=Blockchain)
-async def get_blockchain(blockchain_id: str):
-    async with Client() as client:
-        chain = await client.get_blockchain(blockchain_id)
-    return chain
+async def get_blockchain(blockchain_id: str, client: Client = Depends(get_client)):
+    return await client.get_blockchain(blockchain_id)
 
 
 @app.get('/currencies')
-async def get_currencies():
-    path = Path(__file__).resolve().parent / 'resources' / 'currencies.json'
-    with path.open('r') as f:
-        return json.load(f)
+async def get_currencies(
+        request: Request,
+        blockchain_id: Optional[str] = None,
+        currency_id: Optional[str] = None,
+        verified: Optional[bool] = None):
+    body = request.app.state.currencies.encoded(blockchain_id, currency_id, verified)
+    encoding = body.negotiate(request.headers.get('accept-encoding', ''))
+    headers = {
+        'ETag': body.etags[encoding],
+        'Vary': 'Accept-Encoding',
+        'Cache-Control': 'public, max-age=300',
+    }
+    if body.matches(request.headers.get('if-none-match', '')):
+        return Response(status_code=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(content=body.variants[encoding], media_type='application/json', headers=headers)
+
+
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
 
 
 @app.get('/transactions', response_model=Collection[Transaction])
@@ -45,33 +90,153 @@ async def get_transactions(
         start_height: int = 0,
         end_height: Optional[int] = None,
         max_page_size: Optional[int] = 50,
-        include_raw: Optional[bool] = False):
-    async with Client() as client:
-        if end_height is None or end_height < 1:
-            blockchain = await client.get_blockchain(blockchain_id)
-            end_height = blockchain.verified_height
-        transactions = await client.get_transactions(
-            addresses=address,
-            blockchain_id=blockchain_id,
-            start_height=start_height,
-            end_height=end_height,
-            max_page_size=max_page_size,
-            include_raw=include_raw
-        )
+        include_raw: Optional[bool] = False,
+        stream: Optional[bool] = False,
+        cursor: Optional[str] = None,
+        client: Client = Depends(get_client)):
+    if end_height is None or end_height < 1:
+        blockchain = await client.get_blockchain(blockchain_id)
+        end_height = blockchain.verified_height
+    positions = None
+    if cursor is not None:
+        # the cursor from a `next` link resumes each unfinished address at its own height
+        try:
+            positions = decode_cursor(cursor, blockchain_id)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        if positions is None:
+            # signed elsewhere, the link's own heights still cover every unfinished address
+            FALLBACKS.labels('unverified_cursor').inc()
+        elif not set(positions) <= set(address or []):
+            raise HTTPException(status_code=400, detail='Cursor addresses are not part of the request')
+    query = dict(
+        addresses=address,
+        blockchain_id=blockchain_id,
+        start_height=start_height,
+        end_height=end_height,
+        max_page_size=max_page_size,
+        include_raw=include_raw,
+        positions=positions
+    )
+    if stream or NDJSON_MEDIA_TYPE in request.headers.get('accept', ''):
+        return StreamingResponse(stream_transactions(request, client, query), media_type=NDJSON_MEDIA_TYPE)
+    transactions = await client.get_transactions(**query)
+    # models are built trusted by the providers, skip re-validating them against the response model
+    return Response(
+        content=dumps_collection('transactions', transactions.contents, transaction_links(request, transactions)),
+        media_type='application/json'
+    )
+
+
+async def stream_transactions(request: Request, client: Client, query: dict):
+    """
+    Writes one transaction per line as each address's provider call completes, followed by a final record holding
+    only the pagination links. Each address's transactions are in order, but a transaction already written for
+    another address of the wallet is written again, with the transfers of both, whenever the later address adds
+    any; clients keep the last line per `transaction_id`.
+    """
+    continuations = []
+    written: Dict[str, Transaction] = {}
+    async for transactions in client.iter_transactions(**query):
+        for txn in sorted(transactions.contents, key=transaction_order):
+            seen = written.get(txn.transaction_id)
+            merged = txn if seen is None else seen.merge(txn)
+            if merged is not seen:
+                written[txn.transaction_id] = merged
+                yield dumps(merged) + b'\n'
+        continuations.append(HeightPaginatedResponse(
+            contents=[],
+            has_more=transactions.has_more,
+            next_start_height=transactions.next_start_height,
+            next_end_height=transactions.next_end_height,
+            continuations=transactions.continuations
+        ))
+    links = transaction_links(request, Client.combine(continuations))
+    yield dumps({'_links': links}) + b'\n'
+
+
+def transaction_links(request: Request, transactions: HeightPaginatedResponse[Transaction]) -> Dict[str, Link]:
     links = {}
     if transactions.next_start_height is not None:
+        # the heights span every unfinished address, the cursor holds each one's own position
         links['next'] = Link(href=str(request.url.include_query_params(
             start_height=transactions.next_start_height,
-            end_height=transactions.next_end_height
+            end_height=transactions.next_end_height,
+            cursor=encode_cursor(request.query_params['blockchain_id'], transactions.continuations)
         )))
-    return Collection(
-        _embedded={
-            'transactions': transactions.contents
-        },
-        _links=links
+    return links
+
+
+@app.get('/balances', response_model=Collection[Amount])
+async def get_balances(
+        blockchain_id: str,
+        address: List[str] = Query(None),
+        client: Client = Depends(get_client)):
+    balances = await compute_balances(client, blockchain_id, address or [])
+    return Response(content=dumps_collection('balances', balances, {}), media_type='application/json')
+
+
+@app.get('/wallets/discover')
+async def discover_wallet(
+        request: Request,
+        blockchain_id: str,
+        xpub: str,
+        formats: List[str] = Query(None, alias='format'),
+        gap_limit: int = Query(GAP_LIMIT, ge=1, le=100),
+        client: Client = Depends(get_client)):
+    """
+    Finds the used addresses below an account-level extended public key, scanning the external and change chains
+    until `gap_limit` unused addresses in a row, and returns them with their transactions. Addresses with more
+    history than one page hold are continued through the `next` link, which pages `/transactions` by cursor.
+    """
+    try:
+        deriver = AddressDeriver(blockchain_id, xpub, formats)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    blockchain = await client.get_blockchain(blockchain_id)
+    found = await discover(client, deriver, blockchain_id, blockchain.verified_height, gap_limit=gap_limit)
+    transactions = Client.combine([resp for _, resp in found])
+    links = {}
+    if transactions.continuations:
+        query = urlencode({
+            'blockchain_id': blockchain_id,
+            'address': [wallet_address.address for wallet_address, _ in found],
+            'start_height': transactions.next_start_height,
+            'end_height': transactions.next_end_height,
+            'cursor': encode_cursor(blockchain_id, transactions.continuations),
+        }, doseq=True)
+        links['next'] = Link(href=str(request.url.replace(path='/transactions', query=query)))
+    return Response(
+        content=dumps({
+            '_embedded': {'addresses': [wallet_address for wallet_address, _ in found],
+                          'transactions': transactions.contents},
+            '_links': links
+        }),
+        media_type='application/json'
     )
 
 
+@app.get('/rate-limits')
+async def get_rate_limits(client: Client = Depends(get_client)):
+    limits = {name: limiter.snapshot() for name, limiter in LIMITERS.items()}
+    # hedging, failover and circuit breaker statistics of each router's backends, several chains share one router
+    routers = {id(provider): provider for provider in client.provider_map.values()
+               if isinstance(provider, RoutingProvider)}
+    limits['routing'] = {','.join(name for name, _ in router.backends): router.snapshot()
+                         for router in routers.values()}
+    return limits
+
+
+@app.get('/metrics')
+async def get_metrics():
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        # every worker writes its samples to the directory, any one of them can report the node's totals
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.post('/users/token', response_model=UserToken)
 def post_user_token():
     now = datetime.utcnow().isoformat()
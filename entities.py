@@ -1,8 +1,12 @@
-from typing import TypeVar, Generic, List, Dict, Optional
+import json
+from collections import Counter
+from typing import TypeVar, Generic, List, Dict, Optional, Any, Tuple
+import orjson
 from pydantic import BaseModel
 from pydantic.generics import GenericModel
 
 Contents = TypeVar('Contents')
+Model = TypeVar('Model', bound='TrustedModel')
 
 
 class HeightPaginatedResponse(Generic[Contents]):
@@ -10,14 +14,39 @@ class HeightPaginatedResponse(Generic[Contents]):
     has_more: bool
     next_start_height: Optional[int]
     next_end_height: Optional[int]
+    continuations: Dict[str, Tuple[int, int]]  # {address: (next_start_height, next_end_height)}
 
     def __init__(self, contents: List[Contents], has_more: bool,
                  next_start_height: Optional[int] = None,
-                 next_end_height: Optional[int] = None):
+                 next_end_height: Optional[int] = None,
+                 continuations: Optional[Dict[str, Tuple[int, int]]] = None):
         self.contents = contents
         self.has_more = has_more
         self.next_start_height = next_start_height
         self.next_end_height = next_end_height
+        self.continuations = continuations or {}
+
+
+class TrustedModel(BaseModel):
+    @classmethod
+    def trusted(cls, **values) -> Model:
+        """
+        Builds an instance from values that are already of the declared types, skipping validation entirely. Fields
+        may be passed by name or alias and are stored in declaration order, so serialization matches a validated
+        instance.
+        """
+        fields = {}
+        for name, field in cls.__fields__.items():
+            if field.alias in values:
+                fields[name] = values[field.alias]
+            elif name in values:
+                fields[name] = values[name]
+            else:
+                fields[name] = field.get_default()
+        m = cls.__new__(cls)
+        object.__setattr__(m, '__dict__', fields)
+        object.__setattr__(m, '__fields_set__', set(fields))
+        return m
 
 
 class Link(BaseModel):
@@ -32,7 +61,7 @@ class Collection(GenericModel, Generic[Contents]):
         fields = {'embedded': '_embedded', 'links': '_links'}
 
 
-class Amount(BaseModel):
+class Amount(TrustedModel):
     amount: str
     currency_id: str
 
@@ -57,7 +86,7 @@ class Blockchain(BaseModel):
     native_currency_id: str
 
 
-class Transfer(BaseModel):
+class Transfer(TrustedModel):
     transfer_id: str
     blockchain_id: str
     from_address: str
@@ -67,8 +96,12 @@ class Transfer(BaseModel):
     amount: Amount
     meta: Dict[str, str]
 
+    def content_key(self) -> tuple:
+        """What the transfer moves, regardless of where it sits in its transaction"""
+        return self.from_address, self.to_address, self.amount.currency_id, self.amount.amount
 
-class Transaction(BaseModel):
+
+class Transaction(TrustedModel):
     transaction_id: str
     identifier: str
     hash: str
@@ -78,7 +111,7 @@ class Transaction(BaseModel):
     fee: Amount
     confirmations: int
     index: int
-    size: int
+    size: Optional[int]  # None where the backend does not report it, never a made-up 0
     block_hash: str
     block_height: int
     status: str
@@ -88,6 +121,53 @@ class Transaction(BaseModel):
     class Config:
         fields = {'embedded': '_embedded'}
 
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'Transaction':
+        """Trusted inverse of serializing a transaction, for data this service produced itself"""
+        transfers = [Transfer.trusted(**{**xfer, 'amount': Amount.trusted(**xfer['amount'])})
+                     for xfer in data['_embedded']['transfers']]
+        return cls.trusted(**{**data, '_embedded': {'transfers': transfers}, 'fee': Amount.trusted(**data['fee'])})
+
+    def merge(self, other: 'Transaction') -> 'Transaction':
+        """
+        Combines two views of the same transaction, as fetched for different addresses of a wallet. Transfers are
+        matched by content, so ones both views hold appear once; added transfers whose id is taken get the next free
+        one. Returns `self` unchanged when `other` adds nothing, neither instance is modified.
+        """
+        embedded = {}
+        added = False
+        for key, transfers in self.embedded.items():
+            unmatched = Counter(xfer.content_key() for xfer in transfers)
+            ids = {xfer.transfer_id for xfer in transfers}
+            merged = list(transfers)
+            for xfer in other.embedded.get(key, []):
+                if unmatched[xfer.content_key()] > 0:
+                    unmatched[xfer.content_key()] -= 1
+                    continue
+                if xfer.transfer_id in ids:
+                    index = len(merged)
+                    prefix = xfer.transfer_id.rsplit(':', 1)[0]
+                    while f'{prefix}:{index}' in ids:
+                        index += 1
+                    xfer = xfer.copy(update={'transfer_id': f'{prefix}:{index}', 'index': index})
+                ids.add(xfer.transfer_id)
+                merged.append(xfer)
+                added = True
+            embedded[key] = merged
+        for key, transfers in other.embedded.items():
+            if key not in embedded:
+                embedded[key] = transfers
+                added = True
+        if not added and (self.raw is not None or other.raw is None):
+            return self
+        return self.copy(update={'embedded': embedded, 'raw': self.raw if self.raw is not None else other.raw})
+
+
+class WalletAddress(TrustedModel):
+    address: str
+    path: str  # below the extended public key, `{chain}/{index}`
+    format: str
+
 
 class UserToken(BaseModel):
     user_id: str
@@ -98,3 +178,29 @@ class UserToken(BaseModel):
     pub_key: str
     created: str
     last_access: str
+
+
+def jsonable(value: Any) -> Any:
+    """Converts models to plain containers keyed by alias, in field order, exactly like FastAPI's encoder does"""
+    if isinstance(value, BaseModel):
+        return {field.alias: jsonable(value.__dict__[name]) for name, field in value.__fields__.items()}
+    if isinstance(value, dict):
+        return {k: jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    return value
+
+
+def dumps(value: Any) -> bytes:
+    """Serializes models straight to the same compact UTF-8 JSON bytes FastAPI's JSONResponse would produce"""
+    content = jsonable(value)
+    try:
+        return orjson.dumps(content)
+    except TypeError:
+        # orjson only handles 64 bit integers
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(',', ':')).encode('utf-8')
+
+
+def dumps_collection(name: str, contents: List[Any], links: Dict[str, Link]) -> bytes:
+    """Serializes what `Collection(_embedded={name: contents}, _links=links)` would"""
+    return dumps({'_embedded': {name: contents}, '_links': links})
@@ -0,0 +1,107 @@
+import os
+import random
+from asyncio import ensure_future, sleep, gather, CancelledError
+from datetime import datetime, timezone
+from time import time
+from typing import Dict, List, Optional
+from aiohttp import ClientSession
+from cache import CACHE, CacheBackend
+from entities import FeeEstimate
+from metrics import FEE_ESTIMATE_TIMESTAMP
+from providers.singleflight import SingleFlight
+
+REFRESH_INTERVAL = float(os.getenv('FEE_REFRESH_INTERVAL', '60'))  # seconds between fee lookups per chain
+REFRESH_JITTER = float(os.getenv('FEE_REFRESH_JITTER', '0.2'))  # +/- share of the interval, spreads chains apart
+STALE_AFTER = float(os.getenv('FEE_STALE_AFTER', str(5 * REFRESH_INTERVAL)))  # age at which estimates are reported
+RETAIN = 24 * 60 * 60  # seconds an estimate is kept to be served while refreshes fail
+
+
+class FeeQuote:
+    """A chain's fee estimates with the time they were fetched upstream"""
+
+    def __init__(self, fees: List[FeeEstimate], fetched_at: float):
+        self.fees = fees
+        self.fetched_at = fetched_at
+
+    @property
+    def age(self) -> float:
+        return time() - self.fetched_at
+
+    @property
+    def stale(self) -> bool:
+        return self.age > STALE_AFTER
+
+    @property
+    def timestamp(self) -> str:
+        return datetime.fromtimestamp(self.fetched_at, timezone.utc).isoformat(timespec='milliseconds')
+
+
+class FeeService:
+    """
+    Serves the last fee estimates of each chain while one background task per chain refreshes them every
+    `REFRESH_INTERVAL` seconds, give or take `REFRESH_JITTER`, so a caller only waits on the upstream for a chain's
+    very first lookup. Estimates live in the shared cache and only the worker holding a chain's lease refreshes it.
+    Estimates older than `STALE_AFTER` are still served, and reported as stale.
+    """
+
+    def __init__(self, cache: CacheBackend = CACHE):
+        self.cache = cache
+        self.quotes: Dict[str, FeeQuote] = {}
+        self._flights = SingleFlight()
+        self._tasks = {}
+
+    async def get(self, fee_provider, session: ClientSession, chain_id: str) -> FeeQuote:
+        if chain_id not in self._tasks:
+            self._tasks[chain_id] = ensure_future(self._poll(fee_provider, session, chain_id))
+        quote = self._load(chain_id)
+        if quote is None:
+            quote = await self.refresh(fee_provider, session, chain_id)
+        return quote
+
+    async def refresh(self, fee_provider, session: ClientSession, chain_id: str) -> FeeQuote:
+        return await self._flights.do(chain_id, self._refresh, fee_provider, session, chain_id)
+
+    async def stop(self):
+        tasks, self._tasks = list(self._tasks.values()), {}
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+
+    async def _refresh(self, fee_provider, session: ClientSession, chain_id: str) -> FeeQuote:
+        quote = FeeQuote(await fee_provider.get_fees(session, chain_id), time())
+        self._keep(chain_id, quote)
+        self.cache.set(f'fees:{chain_id}', quote, ttl=RETAIN)
+        return quote
+
+    def _load(self, chain_id: str) -> Optional[FeeQuote]:
+        """The newer of this worker's quote and the one in the shared cache"""
+        quote = self.quotes.get(chain_id)
+        if quote is None or quote.age > REFRESH_INTERVAL:
+            shared = self.cache.get(f'fees:{chain_id}')
+            if shared is not None and (quote is None or shared.fetched_at > quote.fetched_at):
+                self._keep(chain_id, shared)
+                quote = shared
+        return quote
+
+    def _keep(self, chain_id: str, quote: FeeQuote):
+        self.quotes[chain_id] = quote
+        FEE_ESTIMATE_TIMESTAMP.labels(chain_id).set(quote.fetched_at)
+
+    async def _poll(self, fee_provider, session: ClientSession, chain_id: str):
+        while True:
+            await sleep(REFRESH_INTERVAL * random.uniform(1 - REFRESH_JITTER, 1 + REFRESH_JITTER))
+            try:
+                if self.cache.lease(f'fees:{chain_id}', ttl=3 * REFRESH_INTERVAL):
+                    await self.refresh(fee_provider, session, chain_id)
+                else:
+                    self._load(chain_id)
+            except CancelledError:
+                raise
+            except Exception as e:
+                # reported once per refresh rather than per request, requests keep being served the last estimates
+                quote = self.quotes.get(chain_id)
+                served = f', serving estimates from {quote.timestamp}' if quote is not None and quote.stale else ''
+                print(f'FeeService failed to refresh {chain_id}: {e!r}{served}')
+
+
+FEES = FeeService()
@@ -0,0 +1,152 @@
+from time import monotonic
+from typing import Optional, Dict, Callable
+import re
+from urllib.parse import parse_qs
+from memoize.configuration import MutableCacheConfiguration
+from memoize.entry import CacheKey, CacheEntry
+from memoize.storage import CacheStorage
+from prometheus_client import Counter, Histogram, Gauge
+from yarl import URL
+from blockchains import BLOCKCHAIN_MAP
+
+# upstream calls range from a few milliseconds for a cached stats call to tens of seconds for a full history
+FIXED_SEGMENT = re.compile(r'^[a-z_-]+$')
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+UPSTREAM_LATENCY = Histogram('elysium_upstream_request_seconds', 'Upstream request latency, including the body',
+                             ['provider', 'endpoint'], buckets=LATENCY_BUCKETS)
+UPSTREAM_RESPONSES = Counter('elysium_upstream_responses_total', 'Upstream responses by status code',
+                             ['provider', 'endpoint', 'status'])
+UPSTREAM_RETRIES = Counter('elysium_upstream_retries_total', 'Upstream requests retried by backoff', ['provider'])
+LIMITER_WAIT = Histogram('elysium_rate_limiter_wait_seconds', 'Time spent waiting for a rate limiter token',
+                         ['limiter'], buckets=(0, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60))
+# gauges are set rather than computed at collection, which multiprocess mode can not do. There the queues of the
+# live workers are summed and the newest fee estimate timestamp of any worker is reported.
+LIMITER_QUEUED = Gauge('elysium_rate_limiter_queued', 'Calls currently waiting for a rate limiter token',
+                       ['limiter'], multiprocess_mode='livesum')
+CACHE_EVENTS = Counter('elysium_cache_events_total', 'Cache lookups and evictions', ['cache', 'event'])
+FALLBACKS = Counter('elysium_fallbacks_total', 'Work done the slower way because the fast one could not be used',
+                    ['reason'])
+FEE_ESTIMATE_TIMESTAMP = Gauge('elysium_fee_estimate_timestamp_seconds',
+                               'Unix time the fee estimates served were fetched, their age is time() minus this',
+                               ['blockchain_id'], multiprocess_mode='max')
+REQUEST_LATENCY = Histogram('elysium_request_seconds', 'Request latency until the last body chunk is sent',
+                            ['route', 'blockchain_id', 'status'], buckets=LATENCY_BUCKETS)
+
+
+class UpstreamCall:
+    """
+    Wraps an upstream request context manager, recording its status code and its latency until the response is
+    released:
+
+        async with UpstreamCall('etherscan', 'account.txlist', session.get(url)) as resp:
+            ...
+    """
+
+    def __init__(self, provider: str, endpoint: str, request):
+        self.provider = provider
+        self.endpoint = endpoint
+        self.request = request
+        self.started = 0.0
+
+    async def __aenter__(self):
+        self.started = monotonic()
+        try:
+            resp = await self.request.__aenter__()
+        except Exception:
+            UPSTREAM_RESPONSES.labels(self.provider, self.endpoint, 'error').inc()
+            raise
+        UPSTREAM_RESPONSES.labels(self.provider, self.endpoint, str(resp.status)).inc()
+        return resp
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            return await self.request.__aexit__(exc_type, exc, tb)
+        finally:
+            UPSTREAM_LATENCY.labels(self.provider, self.endpoint).observe(monotonic() - self.started)
+
+
+def endpoint_label(path: str) -> str:
+    """
+    Reduces an upstream URL or path to its fixed segments, leaving out addresses, hashes and heights, so that
+    `dashboards/address/bc1q...` is labelled `dashboards/address`
+    """
+    if '://' in path:
+        path = URL(path).path
+    return '/'.join(segment for segment in path.split('/') if FIXED_SEGMENT.match(segment)) or '/'
+
+
+def count_retry(provider: str) -> Callable[[dict], None]:
+    """An `on_backoff` handler for `backoff` decorators"""
+    def on_backoff(details: dict):
+        UPSTREAM_RETRIES.labels(provider).inc()
+    return on_backoff
+
+
+class InstrumentedStorage(CacheStorage):
+    """Counts hits, misses and evictions of a memoize cache storage. Memoize only releases entries to evict them."""
+
+    def __init__(self, name: str, storage: CacheStorage):
+        self.name = name
+        self.storage = storage
+
+    async def get(self, key: CacheKey) -> Optional[CacheEntry]:
+        entry = await self.storage.get(key)
+        CACHE_EVENTS.labels(self.name, 'miss' if entry is None else 'hit').inc()
+        return entry
+
+    async def offer(self, key: CacheKey, entry: CacheEntry) -> None:
+        await self.storage.offer(key, entry)
+
+    async def release(self, key: CacheKey) -> None:
+        CACHE_EVENTS.labels(self.name, 'eviction').inc()
+        await self.storage.release(key)
+
+
+def instrument_cache(name: str, configuration: MutableCacheConfiguration) -> MutableCacheConfiguration:
+    return configuration.set_storage(InstrumentedStorage(name, configuration.storage()))
+
+
+class MetricsMiddleware:
+    """
+    Times every HTTP request until its last body chunk has been sent, so streamed responses are measured in full,
+    labelled by route template, blockchain and status code.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.routes: Dict[Callable, str] = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        started = monotonic()
+        status = '500'
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = str(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            REQUEST_LATENCY.labels(self._route(scope), _blockchain_id(scope), status).observe(monotonic() - started)
+
+    def _route(self, scope) -> str:
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        if endpoint not in self.routes:
+            app = scope['app']
+            self.routes.update({route.endpoint: route.path for route in app.routes if hasattr(route, 'endpoint')})
+        return self.routes.get(endpoint, 'unmatched')
+
+
+def _blockchain_id(scope) -> str:
+    blockchain_id = scope.get('path_params', {}).get('blockchain_id')
+    if blockchain_id is None:
+        blockchain_id = parse_qs(scope.get('query_string', b'').decode('latin-1')).get('blockchain_id', [''])[0]
+    # unknown values are folded together, the label must not grow with whatever clients send
+    return blockchain_id if blockchain_id in BLOCKCHAIN_MAP or not blockchain_id else 'other'
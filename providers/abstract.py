@@ -1,21 +1,57 @@
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Dict
 from aiohttp import ClientSession
 from entities import Blockchain, FeeEstimate, Transaction, HeightPaginatedResponse
+from tips import TIPS
 
 
 class AbstractProvider(ABC):
+    # most addresses `get_addresses_transactions` accepts in one call, 1 when the provider has no batch endpoint
+    max_batch_size: int = 1
+    # whether transactions can carry their raw bytes, which callers only ask for with `include_raw`
+    provides_raw: bool = False
+
+    def supports_chain(self, chain_id: str) -> bool:
+        return True
+
+    def tip_height(self, chain_id: str) -> int:
+        """The chain's latest height from the tip registry, 0 before its head has been looked up"""
+        return TIPS.height(chain_id)
+
     @abstractmethod
     async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
         pass
 
     @abstractmethod
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str,
-                                       start_height: int, end_height: int) -> HeightPaginatedResponse[Transaction]:
+                                       start_height: int, end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
+        """
+        The address's transactions in the height range. Without `include_raw` the transactions are built from the
+        cheapest endpoints that describe them and `raw` is left empty, no raw bytes are downloaded or decoded.
+        """
         pass
 
+    async def get_addresses_transactions(self, session: ClientSession, chain_id: str, addresses: List[str],
+                                         start_height: int, end_height: int,
+                                         include_raw: bool = False) -> Dict[str, HeightPaginatedResponse[Transaction]]:
+        """
+        Optional batch version of `get_address_transactions` for up to `max_batch_size` addresses, keyed by address.
+        Only providers that raise `max_batch_size` need to implement it.
+        """
+        raise NotImplementedError
+
 
 class AbstractFeeProvider(ABC):
     @abstractmethod
     async def get_fees(self, session: ClientSession, chain_id: str) -> List[FeeEstimate]:
         pass
+
+
+def resume_height(cut_height: int, start_height: int) -> int:
+    """
+    Where the next page of an upwards listing that the upstream cut off inside block `cut_height` starts. The cut
+    block is left whole to the next page, unless the page began in it: a single block can not be split, so its
+    truncated transactions are accepted rather than asking for the same block forever.
+    """
+    return max(cut_height, start_height + 1)
@@ -1,18 +1,20 @@
-from datetime import timedelta, datetime
+import os
+from datetime import timedelta
 from math import ceil
 from typing import List
 from aiohttp import ClientSession
 from entities import FeeEstimate, Amount
 from providers.abstract import AbstractFeeProvider
+from metrics import UpstreamCall, endpoint_label
 
-
+BASE_URL = os.getenv('BITGO_URL', 'https://www.bitgo.com/api/v2')
 CONFIG_MAP = {
     'bitcoincash-mainnet': {
-        'url': 'https://www.bitgo.com/api/v2/bch/tx/fee',
+        'url': f'{BASE_URL}/bch/tx/fee',
         'block_time': timedelta(minutes=10),
     },
     'bitcoin-mainnet': {
-        'url': 'https://www.bitgo.com/api/v2/btc/tx/fee',
+        'url': f'{BASE_URL}/btc/tx/fee',
         'block_time': timedelta(minutes=10),
     },
     'bitcoin-testnet': {
@@ -26,7 +28,7 @@ CONFIG_MAP = {
         ]
     },
     'litecoin-mainnet': {
-        'url': 'https://www.bitgo.com/api/v2/ltc/tx/fee',
+        'url': f'{BASE_URL}/ltc/tx/fee',
         'block_time': timedelta(minutes=2.5),
     },
     'dogecoin-mainnet': {
@@ -41,9 +43,6 @@ CONFIG_MAP = {
     }
 }
 
-CACHE_TIMEOUT = timedelta(minutes=1)
-CACHE = {}  # {chain_id: {'ts': datetime, 'value': list}}
-
 
 class BitgoFeeProvider(AbstractFeeProvider):
     async def get_fees(self, session: ClientSession, chain_id: str) -> List[FeeEstimate]:
@@ -53,12 +52,7 @@ class BitgoFeeProvider(AbstractFeeProvider):
         if config.get('static', False):
             return config['fees']
 
-        # retrieve from cache
-        if cached_value := CACHE.get(chain_id, None):
-            if datetime.now() - cached_value['ts'] < CACHE_TIMEOUT:
-                return cached_value['value']
-
-        async with session.get(config['url']) as resp:
+        async with UpstreamCall('bitgo', endpoint_label(config['url']), session.get(config['url'])) as resp:
             body = await resp.json()
 
         if not body.get('feeByBlockTarget', None):
@@ -86,7 +80,4 @@ class BitgoFeeProvider(AbstractFeeProvider):
                     )
                 ))
 
-        # memoize
-        CACHE[chain_id] = {'ts': datetime.now(), 'value': results}
-
         return results
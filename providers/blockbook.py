@@ -1,12 +1,17 @@
-from asyncio import Semaphore
+from base64 import b64encode
+from binascii import unhexlify
 from datetime import datetime, timezone
 import backoff
 from aiohttp import ClientSession
 from entities import Blockchain, Transaction, Amount, Transfer
 from providers.abstract import AbstractProvider, AbstractFeeProvider, HeightPaginatedResponse
+from providers.ratelimit import RateLimiter
+from providers.singleflight import coalesce
+from fees import FEES
+from metrics import UpstreamCall, endpoint_label, count_retry
 from blockchains import BLOCKCHAIN_MAP
 
-SEM = Semaphore(value=1)
+RATE_LIMIT = RateLimiter.from_env('blockbook', rate=0.5, burst=1)
 CHAIN_MAP = {
     'bitcoin-mainnet': 'https://btc1.trezor.io',
     'bitcoincash-mainnet': 'https://bch1.trezor.io',
@@ -16,15 +21,20 @@ CHAIN_MAP = {
 
 
 class BlockbookProvider(AbstractProvider):
+    provides_raw = True
+
     def __init__(self, fee_provider: AbstractFeeProvider):
         self.fee_provider = fee_provider
 
+    def supports_chain(self, chain_id: str) -> bool:
+        return chain_id in CHAIN_MAP
+
     async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
         val = await self._get(chain_id, session, 'api/v2', params={})
-        fees = await self.fee_provider.get_fees(session, chain_id)
+        fees = await FEES.get(self.fee_provider, session, chain_id)
         return Blockchain(
-            fee_estimates=fees,
-            fee_estimates_timestamp=datetime.now().replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+            fee_estimates=fees.fees,
+            fee_estimates_timestamp=fees.timestamp,
             block_height=val['blockbook']['bestHeight'],
             verified_height=val['blockbook']['bestHeight'],
             verified_block_hash=val['backend']['bestBlockHash'],
@@ -32,9 +42,11 @@ class BlockbookProvider(AbstractProvider):
         )
 
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str,
-                                       start_height: int, end_height: int) -> HeightPaginatedResponse[Transaction]:
+                                       start_height: int, end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
         val = await self._get(chain_id, session, f'api/v2/address/{address}', params={
-            'details': 'txs',
+            # `txslight` is served from blockbook's own index, only `txs` asks the node for every transaction's hex
+            'details': 'txs' if include_raw else 'txslight',
             'pageSize': '50',
             'to': str(end_height),
             'from': str(start_height)
@@ -46,7 +58,7 @@ class BlockbookProvider(AbstractProvider):
             transfers = []
             counter = 0
             for txin in tx.get('vin', []):
-                transfers.append(Transfer(
+                transfers.append(Transfer.trusted(
                     transfer_id=f'{chain_id}:{tx["txid"]}:{counter}',
                     blockchain_id=chain_id,
                     from_address=txin['addresses'][0] if len(txin.get('addresses', [])) else '',
@@ -57,8 +69,8 @@ class BlockbookProvider(AbstractProvider):
                     meta={}
                 ))
                 counter += 1
-            for txout in tx.get('outputs', []):
-                transfers.append(Transfer(
+            for txout in tx.get('vout', []):
+                transfers.append(Transfer.trusted(
                     transfer_id=f'{chain_id}:{tx["txid"]}:{counter}',
                     blockchain_id=chain_id,
                     from_address='unknown',
@@ -69,7 +81,7 @@ class BlockbookProvider(AbstractProvider):
                     meta={}
                 ))
                 counter += 1
-            contents.append(Transaction(
+            contents.append(Transaction.trusted(
                 transaction_id=txid,
                 identifier=tx['txid'],
                 hash=tx['txid'],
@@ -78,13 +90,14 @@ class BlockbookProvider(AbstractProvider):
                 _embedded={'transfers': transfers},
                 fee=_to_amount(chain_id, tx['fees']),
                 confirmations=tx['confirmations'],
-                size=len(tx['hex'])//2,
+                # the light listing leaves the size out, unknown rather than 0
+                size=len(tx['hex']) // 2 if include_raw else tx.get('size'),
                 index=i,
                 block_hash=tx['blockHash'],
                 block_height=tx['blockHeight'],
                 status='confirmed',
                 meta={},
-                raw=tx['hex']
+                raw=b64encode(unhexlify(tx['hex'])).decode('ascii') if include_raw else None
             ))
             last_block_height = tx['blockHeight']
 
@@ -97,12 +110,13 @@ class BlockbookProvider(AbstractProvider):
 
         return resp
 
-    @backoff.on_exception(backoff.expo, ValueError, max_tries=3)
+    @coalesce
+    @backoff.on_exception(backoff.expo, ValueError, max_tries=3, on_backoff=count_retry('blockbook'))
     async def _get(self, chain_id, session, url, **kwargs):
         if chain_id not in CHAIN_MAP:
             raise ValueError(f'Chain not supported by blockbook backend: {chain_id}')
         full_url = f'{CHAIN_MAP[chain_id]}/{url}'
-        async with SEM, session.get(full_url, **kwargs) as resp:
+        async with RATE_LIMIT, UpstreamCall('blockbook', endpoint_label(url), session.get(full_url, **kwargs)) as resp:
             if resp.status != 200:
                 print(f'Got status code = {resp.status} from blockbook for {full_url}')
                 raise ValueError(f'Invalid status code {resp.status} for GET {full_url}')
@@ -110,7 +124,7 @@ class BlockbookProvider(AbstractProvider):
 
 
 def _to_amount(chain_id, num) -> Amount:
-    return Amount(
+    return Amount.trusted(
         currency_id=f'{chain_id}:__native__',
         amount=str(num)
     )
@@ -1,19 +1,22 @@
 import os
 import warnings
-from asyncio import gather, Semaphore
+from asyncio import gather
 from base64 import b64encode
 from binascii import unhexlify
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timezone
+from typing import Dict
 import backoff
 from aiohttp import ClientSession, ClientError
-from memoize.wrapper import memoize
-from memoize.configuration import MutableCacheConfiguration, DefaultInMemoryCacheConfiguration
-from memoize.key import EncodedMethodNameAndArgsKeyExtractor
 from blockchains import BLOCKCHAIN_MAP
 from entities import HeightPaginatedResponse, Transaction, Blockchain, Amount, Transfer
 from providers.abstract import AbstractProvider, AbstractFeeProvider
+from providers.ratelimit import RateLimiter
+from providers.singleflight import coalesce
+from fees import FEES
+from metrics import UpstreamCall, endpoint_label, count_retry
+from store import TransactionStore
 
-BASE_URL = 'https://api.blockchair.com'
+BASE_URL = os.getenv('BLOCKCHAIR_URL', 'https://api.blockchair.com')
 TOKEN = os.getenv('BLOCKCHAIR_TOKEN', None)
 if TOKEN is None:
     warnings.warn('No BlockChair token found in environment')
@@ -24,31 +27,26 @@ CHAIN_MAP = {
     'litecoin-mainnet': 'litecoin',
     'dogecoin-mainnet': 'dogecoin'
 }
-SEM = Semaphore(value=12)
-LAST_BLOCK_HEIGHT = 0
-
-
-def transaction_cache_config():
-    return MutableCacheConfiguration.initialized_with(DefaultInMemoryCacheConfiguration(
-        capacity=100_000,
-        method_timeout=timedelta(minutes=5),
-        update_after=timedelta(days=365),
-        expire_after=timedelta(days=365),
-    )).set_key_extractor(EncodedMethodNameAndArgsKeyExtractor(skip_first_arg_as_self=True))
+RATE_LIMIT = RateLimiter.from_env('blockchair', rate=10, burst=12)
+BATCH_SIZE = int(os.getenv('BLOCKCHAIR_BATCH_SIZE', '10'))  # most hashes accepted by one raw/transaction request
 
 
 class BlockChairProvider(AbstractProvider):
-    def __init__(self, fee_provider: AbstractFeeProvider):
+    provides_raw = True
+
+    def __init__(self, fee_provider: AbstractFeeProvider, store: TransactionStore):
         self.fee_provider = fee_provider
+        self.store = store
+
+    def supports_chain(self, chain_id: str) -> bool:
+        return chain_id in CHAIN_MAP
 
     async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
         val = await self._get(session, chain_id, 'stats')
-        global LAST_BLOCK_HEIGHT
-        LAST_BLOCK_HEIGHT = val['best_block_height']
-        fees = await self.fee_provider.get_fees(session, chain_id)
+        fees = await FEES.get(self.fee_provider, session, chain_id)
         return Blockchain(
-            fee_estimates=fees,
-            fee_estimates_timestamp=datetime.now().replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+            fee_estimates=fees.fees,
+            fee_estimates_timestamp=fees.timestamp,
             block_height=val['best_block_height'],
             verified_height=val['best_block_height'],
             verified_block_hash=val['best_block_hash'],
@@ -56,53 +54,117 @@ class BlockChairProvider(AbstractProvider):
         )
 
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str, start_height: int,
-                                       end_height: int) -> HeightPaginatedResponse[Transaction]:
+                                       end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
+        """
+        The dashboard cannot filter by height, but there is no need to look up transactions below the range. Raw
+        transactions are only downloaded for `include_raw`, otherwise the hash and size the dashboard does not report
+        come from the cheaper transaction summaries. There is deliberately no batch version: the multi-address
+        dashboard reports each transaction's balance change for the whole set, so it cannot say which address a
+        transaction belongs to or how much it moved for it.
+        """
         result = await self._get(session, chain_id, f'dashboards/address/{address}', params={
             'limit': '10000',
             'transaction_details': 'true'
         })
-        tasks = [self._get_transaction(session, chain_id, txdetails, i, address)
-                 for i, txdetails in enumerate(result.get(address, {}).get('transactions', []))]
-        txns = await gather(*tasks)
-        return HeightPaginatedResponse(contents=list(txns), has_more=False)
-
-    @memoize(configuration=transaction_cache_config())
-    async def _get_transaction(self, session, chain_id, txdetails, idx, address):
-        result = await self._get(session, chain_id, f'raw/transaction/{txdetails["hash"]}')
-        txn = result[txdetails['hash']]['decoded_raw_transaction']
-        raw = unhexlify(result[txdetails['hash']]['raw_transaction'])
-        txid = f'{chain_id}:{txn["txid"]}'
+        details = [(i, txdetails) for i, txdetails in enumerate(result.get(address, {}).get('transactions', []))
+                   if txdetails['block_id'] < 0 or txdetails['block_id'] >= start_height]
+        txdetails_list = [txdetails for _, txdetails in details]
+        if include_raw:
+            txns = await self._get_raw_transactions(session, chain_id, txdetails_list)
+        else:
+            txns = await self._get_summaries(session, chain_id, txdetails_list)
+        # a transaction left out would make the history look complete without it
+        unknown = [txdetails['hash'] for txdetails in txdetails_list if txdetails['hash'] not in txns]
+        if unknown:
+            raise ValueError(f'BlockChair did not describe {len(unknown)} transactions of {address} on {chain_id}')
+        contents = [self._to_transaction(chain_id, txdetails, i, address, txns[txdetails['hash']], include_raw)
+                    for i, txdetails in details]
+        return HeightPaginatedResponse(contents=contents, has_more=False)
+
+    def _to_transaction(self, chain_id, txdetails, idx, address, txn, include_raw) -> Transaction:
+        txid = f'{chain_id}:{txdetails["hash"]}'
         curid = f'{chain_id}:__native__'
         timestamp = datetime.strptime(txdetails['time'], '%Y-%m-%d %H:%M:%S').replace(tzinfo=timezone.utc)
-        transfer = Transfer(
+        transfer = Transfer.trusted(
             transfer_id=f'{txid}:0',
             blockchain_id=chain_id,
             from_address='unknown' if txdetails['balance_change'] > 0 else address,
             to_address='unknown' if txdetails['balance_change'] < 0 else address,
             index=0,
             transaction_id=txid,
-            amount=Amount(amount=str(abs(txdetails['balance_change'])), currency_id=curid),
+            amount=Amount.trusted(amount=str(abs(txdetails['balance_change'])), currency_id=curid),
             meta={}
         )
-        return Transaction(
+        return Transaction.trusted(
             transaction_id=txid,
-            identifier=txn['txid'],
+            identifier=txdetails['hash'],
             hash=txn['hash'],
             blockchain_id=chain_id,
             timestamp=timestamp.isoformat(timespec='milliseconds'),
             _embedded={'transfers': [transfer]},
-            fee=Amount(currency_id=curid, amount='0'),
-            confirmations=LAST_BLOCK_HEIGHT - txdetails['block_id'],
+            fee=Amount.trusted(currency_id=curid, amount='0'),
+            confirmations=self.tip_height(chain_id) - txdetails['block_id'],
             size=txn['size'],
             index=idx,
             block_hash='',
             block_height=txdetails['block_id'],
             status='confirmed',
             meta={},
-            raw=b64encode(raw).decode('ascii')
+            raw=b64encode(unhexlify(txn['raw_transaction'])).decode('ascii') if include_raw else None
         )
 
-    @backoff.on_exception(backoff.expo, ClientError, max_tries=3)
+    async def _get_raw_transactions(self, session, chain_id, txdetails_list) -> Dict[str, dict]:
+        """Decoded raw transactions by hash, see `_lookup`"""
+        return await self._lookup(session, chain_id, txdetails_list, 'raw/transaction', '', _from_raw)
+
+    async def _get_summaries(self, session, chain_id, txdetails_list) -> Dict[str, dict]:
+        """
+        The hash and size of each transaction by hash, see `_lookup`. A raw transaction already in the store has
+        them too, and its hash is the witness hash, which the summaries do not report.
+        """
+        found = {}
+        rest = []
+        for txdetails in txdetails_list:
+            if (cached := self.store.get(chain_id, txdetails['hash'])) is not None:
+                found[txdetails['hash']] = cached
+            else:
+                rest.append(txdetails)
+        found.update(await self._lookup(session, chain_id, rest, 'dashboards/transactions', ':summary', _from_summary))
+        return found
+
+    async def _lookup(self, session, chain_id, txdetails_list, endpoint, suffix, parse) -> Dict[str, dict]:
+        """
+        Looks every transaction up in the store first, under its hash plus `suffix`, then downloads the misses from
+        `endpoint` in batches of up to `BATCH_SIZE` hashes per request, with the batches fetched concurrently.
+        """
+        found = {}
+        missing = {}
+        for txdetails in txdetails_list:
+            if (cached := self.store.get(chain_id, txdetails['hash'] + suffix)) is not None:
+                found[txdetails['hash']] = cached
+            else:
+                missing[txdetails['hash']] = txdetails['block_id']
+        hashes = list(missing)
+        batches = [hashes[i:i + BATCH_SIZE] for i in range(0, len(hashes), BATCH_SIZE)]
+        results = await gather(*(self._get(session, chain_id, f'{endpoint}/{",".join(batch)}') for batch in batches))
+
+        confirmations_until_final = BLOCKCHAIN_MAP.get(chain_id, {}).get('confirmations_until_final')
+        tip_height = self.tip_height(chain_id)
+        for result in results:
+            for txhash, entry in result.items():
+                if not entry:
+                    continue
+                txn = parse(entry)
+                block_id = missing.get(txhash, -1)
+                final = confirmations_until_final is not None and block_id > 0 and \
+                    tip_height - block_id >= confirmations_until_final
+                self.store.put(chain_id, txhash + suffix, txn, final=final)
+                found[txhash] = txn
+        return found
+
+    @coalesce
+    @backoff.on_exception(backoff.expo, ClientError, max_tries=3, on_backoff=count_retry('blockchair'))
     async def _get(self, session, chain_id, endpoint, **kwargs):
         blockchair_chain = CHAIN_MAP.get(chain_id, None)
         if blockchair_chain is None:
@@ -110,8 +172,28 @@ class BlockChairProvider(AbstractProvider):
         params = kwargs.pop('params', {})
         params['key'] = TOKEN
         url = f'{BASE_URL}/{blockchair_chain}/{endpoint}'
-        async with SEM, session.get(url, params=params, **kwargs) as resp:
+        request = session.get(url, params=params, **kwargs)
+        async with RATE_LIMIT, UpstreamCall('blockchair', endpoint_label(endpoint), request) as resp:
             if resp.status != 200:
                 print(f'BlockChairProvider bad status code: {resp.status} url: {url}')
                 resp.raise_for_status()
             return (await resp.json()).get('data', {})
+
+
+def _from_raw(entry) -> dict:
+    decoded = entry['decoded_raw_transaction']
+    return {
+        'txid': decoded['txid'],
+        'hash': decoded['hash'],
+        'size': decoded['size'],
+        'raw_transaction': entry['raw_transaction']
+    }
+
+
+def _from_summary(entry) -> dict:
+    summary = entry['transaction']
+    return {
+        'txid': summary['hash'],
+        'hash': summary['hash'],
+        'size': summary['size']
+    }
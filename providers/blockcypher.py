@@ -1,18 +1,24 @@
 import os
 import warnings
-from asyncio import Semaphore
-from datetime import datetime, timezone
+from asyncio import gather
+from base64 import b64encode
+from binascii import unhexlify
+from datetime import timezone
+from typing import Dict, List
 import backoff
 from aiohttp import ClientSession
 from dateutil.parser import isoparse
 from entities import Blockchain, Transaction, Amount, Transfer
 from providers.abstract import AbstractProvider, AbstractFeeProvider, HeightPaginatedResponse
+from providers.ratelimit import RateLimiter
+from providers.singleflight import coalesce
+from fees import FEES
+from metrics import UpstreamCall, endpoint_label, count_retry, FALLBACKS
 from blockchains import BLOCKCHAIN_MAP
 
-BASE_URL = 'https://api.blockcypher.com/v1'
+BASE_URL = os.getenv('BLOCKCYPHER_URL', 'https://api.blockcypher.com/v1')
 TOKEN = os.getenv('BLOCKCYPHER_TOKEN', '')
-BLOCKCYPHER_RATE_LIMIT = int(os.getenv('BLOCKCYPHER_RATE_LIMIT', '5'))
-SEM = Semaphore(value=BLOCKCYPHER_RATE_LIMIT)
+RATE_LIMIT = RateLimiter.from_env('blockcypher', rate=3, burst=3)
 if not TOKEN:
     warnings.warn('BLOCKCYPHER_TOKEN not found in environment')
 CHAIN_MAP = {
@@ -21,19 +27,27 @@ CHAIN_MAP = {
     'litecoin-mainnet': 'ltc/main',
     'dogecoin-mainnet': 'doge/main'
 }
+ADDRESS_BATCH_SIZE = int(os.getenv('BLOCKCYPHER_ADDRESS_BATCH_SIZE', '20'))  # most addresses in one batched call
 
 
 class BlockCypherProvider(AbstractProvider):
+    max_batch_size = ADDRESS_BATCH_SIZE
+
+    provides_raw = True
+
     def __init__(self, fee_provider: AbstractFeeProvider):
         self.fee_provider = fee_provider
 
+    def supports_chain(self, chain_id: str) -> bool:
+        return chain_id in CHAIN_MAP
+
     async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
         blockcypher_id = _blockcypher_id(chain_id)
         val = await self._get(session, f'{blockcypher_id}', params={})
-        fees = await self.fee_provider.get_fees(session, chain_id)
+        fees = await FEES.get(self.fee_provider, session, chain_id)
         return Blockchain(
-            fee_estimates=fees,
-            fee_estimates_timestamp=datetime.now().replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+            fee_estimates=fees.fees,
+            fee_estimates_timestamp=fees.timestamp,
             block_height=val['height'],
             verified_height=val['height'],
             verified_block_hash=val['hash'],
@@ -41,77 +55,46 @@ class BlockCypherProvider(AbstractProvider):
         )
 
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str,
-                                       start_height: int, end_height: int) -> HeightPaginatedResponse[Transaction]:
+                                       start_height: int, end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
         blockcypher_id = _blockcypher_id(chain_id)
-        val = await self._get(session, f'{blockcypher_id}/addrs/{address}/full', params={
-            'includeHex': 'true',
-            'limit': '50',
-            'before': str(end_height),
-            'after': str(start_height)
-        })
-        contents = []
-        last_block_height = None
-        for i, tx in enumerate(val.get('txs', [])):
-            txid = f'{chain_id}:{tx["hash"]}'
-            transfers = []
-            counter = 0
-            for txin in tx.get('inputs', []):
-                transfers.append(Transfer(
-                    transfer_id=f'{chain_id}:{tx["hash"]}:{counter}',
-                    blockchain_id=chain_id,
-                    from_address=txin['addresses'][0] if len(txin.get('addresses', [])) else '',
-                    to_address='unknown',
-                    index=counter,
-                    transaction_id=txid,
-                    amount=_to_amount(chain_id, txin.get('output_value', 0)),
-                    meta={}
-                ))
-                counter += 1
-            for txout in tx.get('outputs', []):
-                transfers.append(Transfer(
-                    transfer_id=f'{chain_id}:{tx["hash"]}:{counter}',
-                    blockchain_id=chain_id,
-                    from_address='unknown',
-                    to_address=txout['addresses'][0] if len(txout.get('addresses', [])) else '',
-                    index=counter,
-                    transaction_id=txid,
-                    amount=_to_amount(chain_id, txout.get('value', 0)),
-                    meta={}
-                ))
-                counter += 1
-            contents.append(Transaction(
-                transaction_id=txid,
-                identifier=tx['hash'],
-                hash=tx['hash'],
-                blockchain_id=chain_id,
-                timestamp=isoparse(tx['received']).replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
-                _embedded={'transfers': transfers},
-                fee=_to_amount(chain_id, tx['fees']),
-                confirmations=tx['confirmations'],
-                size=tx['size'],
-                index=i,
-                block_hash=tx['block_hash'],
-                block_height=tx['block_height'],
-                status='confirmed',
-                meta={},
-                raw=tx['hex']
-            ))
-            last_block_height = tx['block_height']
+        val = await self._get(session, f'{blockcypher_id}/addrs/{address}/full',
+                              params=_full_params(start_height, end_height, include_raw))
+        return _to_response(chain_id, val, start_height, include_raw)
 
-        resp = HeightPaginatedResponse(contents=contents, has_more=False)
-
-        if val.get('hasMore', False):
-            resp.has_more = True
-            resp.next_start_height = start_height
-            resp.next_end_height = last_block_height
-
-        return resp
+    async def get_addresses_transactions(self, session: ClientSession, chain_id: str, addresses: List[str],
+                                         start_height: int, end_height: int,
+                                         include_raw: bool = False) -> Dict[str, HeightPaginatedResponse[Transaction]]:
+        """
+        Fetches the addresses with one semicolon-joined request, which BlockCypher bills as one request per address.
+        An address the batch answers with an error for, or leaves out, is fetched again on its own rather than taken
+        to have no transactions.
+        """
+        blockcypher_id = _blockcypher_id(chain_id)
+        val = await self._get(session, f'{blockcypher_id}/addrs/{";".join(addresses)}/full',
+                              params=_full_params(start_height, end_height, include_raw), cost=len(addresses))
+        # a batch answers with one address object per address, a batch of one with the bare object
+        if isinstance(val, dict):
+            val = [val]
+        responses = {addr['address']: _to_response(chain_id, addr, start_height, include_raw)
+                     for addr in val if 'address' in addr and 'error' not in addr}
+        missing = [address for address in addresses if address not in responses]
+        if missing:
+            FALLBACKS.labels('blockcypher_batch_address_refetched').inc(len(missing))
+            responses.update(zip(missing, await gather(*(
+                self.get_address_transactions(session, chain_id, address, start_height, end_height, include_raw)
+                for address in missing))))
+        return {address: responses[address] for address in addresses}
 
-    @backoff.on_exception(backoff.expo, ValueError, max_tries=3)
-    async def _get(self, session, url, **kwargs):
+    @coalesce
+    @backoff.on_exception(backoff.expo, ValueError, max_tries=3, on_backoff=count_retry('blockcypher'))
+    async def _get(self, session, url, cost=1, **kwargs):
         params = kwargs.pop('params', {})
         params['token'] = TOKEN
-        async with SEM, session.get(f'{BASE_URL}/{url}', params=params, **kwargs) as resp:
+        # batched addresses are billed one request each
+        await RATE_LIMIT.acquire(cost)
+        request = session.get(f'{BASE_URL}/{url}', params=params, **kwargs)
+        async with UpstreamCall('blockcypher', endpoint_label(url), request) as resp:
             if resp.status != 200:
                 print(f'Got status code = {resp.status} from BlockCypher for {url}')
                 raise ValueError(f'Invalid status code {resp.status} for GET {url}')
@@ -124,8 +107,80 @@ def _blockcypher_id(chain_id):
     return CHAIN_MAP[chain_id]
 
 
+def _full_params(start_height, end_height, include_raw) -> Dict[str, str]:
+    params = {
+        'limit': '50',
+        'before': str(end_height),
+        'after': str(start_height)
+    }
+    # the hex roughly doubles the size of every transaction in the response, only ask for it when it is returned
+    if include_raw:
+        params['includeHex'] = 'true'
+    return params
+
+
+def _to_response(chain_id, val, start_height, include_raw) -> HeightPaginatedResponse[Transaction]:
+    contents = []
+    last_block_height = None
+    for i, tx in enumerate(val.get('txs', [])):
+        txid = f'{chain_id}:{tx["hash"]}'
+        transfers = []
+        counter = 0
+        for txin in tx.get('inputs', []):
+            transfers.append(Transfer.trusted(
+                transfer_id=f'{chain_id}:{tx["hash"]}:{counter}',
+                blockchain_id=chain_id,
+                from_address=txin['addresses'][0] if len(txin.get('addresses', [])) else '',
+                to_address='unknown',
+                index=counter,
+                transaction_id=txid,
+                amount=_to_amount(chain_id, txin.get('output_value', 0)),
+                meta={}
+            ))
+            counter += 1
+        for txout in tx.get('outputs', []):
+            transfers.append(Transfer.trusted(
+                transfer_id=f'{chain_id}:{tx["hash"]}:{counter}',
+                blockchain_id=chain_id,
+                from_address='unknown',
+                to_address=txout['addresses'][0] if len(txout.get('addresses', [])) else '',
+                index=counter,
+                transaction_id=txid,
+                amount=_to_amount(chain_id, txout.get('value', 0)),
+                meta={}
+            ))
+            counter += 1
+        contents.append(Transaction.trusted(
+            transaction_id=txid,
+            identifier=tx['hash'],
+            hash=tx['hash'],
+            blockchain_id=chain_id,
+            timestamp=isoparse(tx['received']).replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+            _embedded={'transfers': transfers},
+            fee=_to_amount(chain_id, tx['fees']),
+            confirmations=tx['confirmations'],
+            size=tx['size'],
+            index=i,
+            block_hash=tx['block_hash'],
+            block_height=tx['block_height'],
+            status='confirmed',
+            meta={},
+            raw=b64encode(unhexlify(tx['hex'])).decode('ascii') if include_raw else None
+        ))
+        last_block_height = tx['block_height']
+
+    resp = HeightPaginatedResponse(contents=contents, has_more=False)
+
+    if val.get('hasMore', False):
+        resp.has_more = True
+        resp.next_start_height = start_height
+        resp.next_end_height = last_block_height
+
+    return resp
+
+
 def _to_amount(chain_id, num) -> Amount:
-    return Amount(
+    return Amount.trusted(
         currency_id=f'{chain_id}:__native__',
         amount=str(num)
     )
@@ -1,22 +1,24 @@
 import os
 import warnings
-from asyncio import gather, Semaphore
-from datetime import datetime, timezone, timedelta
+from asyncio import gather
+from datetime import datetime, timezone
 from typing import List
 import backoff
 from aiohttp import ClientSession
 from entities import HeightPaginatedResponse, Transaction, Blockchain, FeeEstimate, Amount, Transfer
-from providers.abstract import AbstractProvider, AbstractFeeProvider
+from providers.abstract import AbstractProvider, AbstractFeeProvider, resume_height
+from providers.ratelimit import RateLimiter
+from providers.singleflight import coalesce
+from fees import FEES
+from metrics import UpstreamCall, count_retry
 from blockchains import BLOCKCHAIN_MAP
 
-BASE_URL = 'https://api.etherscan.io/api'
+BASE_URL = os.getenv('ETHERSCAN_URL', 'https://api.etherscan.io/api')
 TOKEN = os.getenv('ETHERSCAN_TOKEN', '')
 if not TOKEN:
     warnings.warn('ETHERSCAN_TOKEN not found in environment')
-ETHERSCAN_RATE_LIMIT = int(os.getenv('ETHERSCAN_RATE_LIMIT', '3'))
-SEM = Semaphore(ETHERSCAN_RATE_LIMIT)
-FEE_CACHE = {}  # {chain_id: {'ts': datetime, 'value': fees}
-FEE_CACHE_EXPIRY = timedelta(minutes=1)
+RATE_LIMIT = RateLimiter.from_env('etherscan', rate=5, burst=5)
+MAX_RESULTS = 10_000  # account lists are silently truncated at this many rows
 
 
 class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
@@ -28,10 +30,10 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
             'tag': block_num_hex,
             'boolean': 'true'
         })
-        fees = await self.get_fees(session, chain_id)
+        fees = await FEES.get(self, session, chain_id)
         return Blockchain(
-            fee_estimates=fees,
-            fee_estimates_timestamp=datetime.now().replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+            fee_estimates=fees.fees,
+            fee_estimates_timestamp=fees.timestamp,
             block_height=int(block['number'], 16),
             verified_height=int(block['number'], 16),
             verified_block_hash=block['hash'],
@@ -39,14 +41,37 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
         )
 
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str, start_height: int,
-                                       end_height: int) -> HeightPaginatedResponse[Transaction]:
-        params = {'address': address, 'startblock': start_height, 'endblock': end_height}
+                                       end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
+        params = {
+            'address': address,
+            'startblock': start_height,
+            'endblock': end_height,
+            'sort': 'asc',
+            'page': 1,
+            'offset': MAX_RESULTS
+        }
         transactions, token_transactions, internal_transactions = await gather(
             self._get(session, params={'module': 'account', 'action': 'txlist', **params}),
             self._get(session, params={'module': 'account', 'action': 'tokentx', **params}),
             self._get(session, params={'module': 'account', 'action': 'txlistinternal', **params})
         )
 
+        # a full list was cut off somewhere inside its last block, so only the blocks below the lowest cut off point
+        # are complete in all three lists. Return those and continue from that block on the next page.
+        next_start_height = None
+        for rows in (transactions, token_transactions, internal_transactions):
+            if len(rows) >= MAX_RESULTS:
+                last_block = int(rows[-1]['blockNumber'])
+                if next_start_height is None or last_block < next_start_height:
+                    next_start_height = last_block
+        if next_start_height is not None:
+            next_start_height = resume_height(next_start_height, start_height)
+            transactions, token_transactions, internal_transactions = (
+                [row for row in rows if int(row['blockNumber']) < next_start_height]
+                for rows in (transactions, token_transactions, internal_transactions)
+            )
+
         tx_map = {}
         default = lambda: {'tx': None, 'tok': [], 'int': []}
         native_cur_id = f'{chain_id}:__native__'
@@ -87,14 +112,14 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
                 block_hash = txn['tx']['blockHash']
                 block_height = int(txn['tx']['blockNumber'])
                 confirmations = int(txn['tx']['confirmations'])
-                fee = Amount(currency_id=native_cur_id, amount=total_fee)
+                fee = Amount.trusted(currency_id=native_cur_id, amount=total_fee)
                 meta = {
                     'gasLimit': f'0x{int(txn["tx"]["gas"]):x}',
                     'gasUsed': f'0x{int(txn["tx"]["gasUsed"]):x}',
                     'gasPrice': f'0x{int(txn["tx"]["gasPrice"]):x}',
                     'nonce': f'0x{int(txn["tx"]["nonce"]):x}'
                 }
-                transfers.append(Transfer(
+                transfers.append(Transfer.trusted(
                     transfer_id=f'{chain_id}:{txid}:{xfer_counter}',
                     blockchain_id=chain_id,
                     from_address=txn['tx']['from'],
@@ -106,14 +131,14 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
                 ))
                 xfer_counter += 1
                 if txn['tx'].get('value', '0') != '0':
-                    transfers.append(Transfer(
+                    transfers.append(Transfer.trusted(
                         transfer_id=f'{chain_id}:{txid}:{xfer_counter}',
                         blockchain_id=chain_id,
                         from_address=txn['tx']['from'],
                         to_address=txn['tx']['to'],
                         index=xfer_counter,
                         transaction_id=transaction_id,
-                        amount=Amount(currency_id=native_cur_id, amount=txn['tx']['value']),
+                        amount=Amount.trusted(currency_id=native_cur_id, amount=txn['tx']['value']),
                         meta={}
                     ))
                     xfer_counter += 1
@@ -122,8 +147,8 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
                     timestamp = datetime.utcfromtimestamp(int(tok_tx['timeStamp']))
                 if fee is None:
                     total_fee = str(int(tok_tx['gasUsed']) * int(tok_tx['gasPrice']))
-                    fee = Amount(currency_id=native_cur_id, amount=total_fee)
-                    transfers.append(Transfer(
+                    fee = Amount.trusted(currency_id=native_cur_id, amount=total_fee)
+                    transfers.append(Transfer.trusted(
                         transfer_id=f'{chain_id}:{txid}:{xfer_counter}',
                         blockchain_id=chain_id,
                         from_address=tok_tx['from'],
@@ -147,14 +172,15 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
                         'gasPrice': f'0x{int(tok_tx["gasPrice"]):x}',
                         'nonce': f'0x{int(tok_tx["nonce"]):x}'
                     }
-                transfers.append(Transfer(
+                transfers.append(Transfer.trusted(
                     transfer_id=f'{chain_id}:{txid}:{xfer_counter}',
                     blockchain_id=chain_id,
                     from_address=tok_tx['from'],
                     to_address=tok_tx['to'],
                     index=xfer_counter,
                     transaction_id=transaction_id,
-                    amount=Amount(currency_id=f'{chain_id}:{tok_tx["contractAddress"]}', amount=tok_tx['value']),
+                    amount=Amount.trusted(currency_id=f'{chain_id}:{tok_tx["contractAddress"]}',
+                                          amount=tok_tx['value']),
                     meta={}
                 ))
                 xfer_counter += 1
@@ -165,23 +191,23 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
                 if block_height is None:
                     block_height = int(int_tx['blockNumber'])
                 if fee is None:
-                    fee = Amount(currency_id=native_cur_id, amount='0')
+                    fee = Amount.trusted(currency_id=native_cur_id, amount='0')
                 if confirmations is None:
                     confirmations = 0
                 if block_hash is None:
                     block_hash = ''
-                transfers.append(Transfer(
+                transfers.append(Transfer.trusted(
                     transfer_id=f'{chain_id}:{txid}:{xfer_counter}',
                     blockchain_id=chain_id,
                     from_address=int_tx['from'],
                     to_address=int_tx['to'],
                     index=xfer_counter,
                     transaction_id=transaction_id,
-                    amount=Amount(currency_id=native_cur_id, amount=int_tx['value']),
+                    amount=Amount.trusted(currency_id=native_cur_id, amount=int_tx['value']),
                     meta={}
                 ))
                 xfer_counter += 1
-            contents.append(Transaction(
+            contents.append(Transaction.trusted(
                 transaction_id=transaction_id,
                 identifier=txid,
                 hash=txid,
@@ -198,13 +224,12 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
                 meta={'input': '0x', **meta},
             ))
 
+        if next_start_height is not None and next_start_height <= end_height:
+            return HeightPaginatedResponse(contents=contents, has_more=True, next_start_height=next_start_height,
+                                           next_end_height=end_height)
         return HeightPaginatedResponse(contents=contents, has_more=False)
 
     async def get_fees(self, session: ClientSession, chain_id: str) -> List[FeeEstimate]:
-        if cached_fees := FEE_CACHE.get(chain_id):
-            if datetime.now() - cached_fees['ts'] < FEE_CACHE_EXPIRY:
-                return cached_fees['value']
-
         oracle = await self._get(session, params={'module': 'gastracker', 'action': 'gasoracle'})
 
         fees = []
@@ -225,8 +250,6 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
             fee.tier = f'{int(duration/1000/60)}m'
             fee.estimated_confirmation_in = duration
 
-        FEE_CACHE[chain_id] = {'ts': datetime.now(), 'value': fees}
-
         return fees
 
     async def _get_fee_duration(self, session, wei):
@@ -237,16 +260,17 @@ class EtherscanProvider(AbstractProvider, AbstractFeeProvider):
         })
         return int(result) * 1000
 
-    @backoff.on_exception(backoff.expo, ValueError, max_tries=3, factor=2)
+    @coalesce
+    @backoff.on_exception(backoff.expo, ValueError, max_tries=3, factor=2, on_backoff=count_retry('etherscan'))
     async def _get(self, session, **kwargs):
         params = kwargs.pop('params', {})
         params['apikey'] = TOKEN
-        async with SEM, session.get(BASE_URL, params=params, **kwargs) as resp:
+        endpoint = f'{params.get("module")}.{params.get("action")}'
+        request = session.get(BASE_URL, params=params, **kwargs)
+        async with RATE_LIMIT, UpstreamCall('etherscan', endpoint, request) as resp:
             if resp.status != 200:
                 if resp.status != 200:
                     print(f'Got status code = {resp.status} from Etherscan')
                     raise ValueError(f'Invalid status code {resp.status} for GET')
             data = await resp.json()
-            print(f'etherscan request: module={params.get("module", None)} action={params.get("action", None)} '
-                  f'status={data.get("status", "1")} message={data.get("message", "")}')
         return data['result']
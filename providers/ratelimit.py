@@ -0,0 +1,164 @@
+import os
+from asyncio import CancelledError, Future, Task, get_running_loop, sleep
+from collections import deque
+from contextvars import ContextVar
+from time import monotonic
+from typing import Deque, Dict, Hashable, Optional, Tuple
+from metrics import LIMITER_WAIT, LIMITER_QUEUED
+
+# identifies who is waiting for a token, queued callers are served round robin so one large request can not starve
+# the others. Tasks spawned while handling a request inherit it.
+CALLER: ContextVar[Hashable] = ContextVar('rate_limit_caller', default=None)
+LIMITERS: Dict[str, 'RateLimiter'] = {}
+# upstream quotas are per API key, so each of the node's workers gets an equal share of every limit. The Procfile
+# exports the worker count it starts uvicorn with, which like uvicorn defaults to 1 when run without it.
+WORKERS = max(int(os.getenv('WEB_CONCURRENCY', '1')), 1)
+
+
+class RateLimiterStats:
+    def __init__(self, window: int = 1000):
+        self.acquired = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.recent_waits: Deque[float] = deque(maxlen=window)
+
+    def record(self, wait: float):
+        self.acquired += 1
+        if wait > 0:
+            self.waited += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        self.recent_waits.append(wait)
+
+    def percentile(self, pct: float) -> float:
+        if not self.recent_waits:
+            return 0.0
+        ordered = sorted(self.recent_waits)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every request to one upstream. Tokens refill at `rate` per second up to `burst`; callers
+    that find the bucket empty are queued and served fairly across callers as tokens become available.
+
+        async with RATE_LIMIT:
+            ...
+
+    A call the upstream bills as several requests, such as a batch it charges per element, acquires that many tokens
+    at once with `await RATE_LIMIT.acquire(cost)`. A cost above `burst` is granted once the bucket is full and leaves
+    it in debt, so the calls after it wait until the whole cost has been refilled.
+    """
+
+    def __init__(self, name: str, rate: float, burst: int = 1):
+        if rate <= 0 or burst < 1:
+            raise ValueError(f'Invalid rate limit for {name}: rate={rate} burst={burst}')
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.stats = RateLimiterStats()
+        self._tokens = float(burst)
+        self._updated = monotonic()
+        self._waiters: Dict[Hashable, Deque[Tuple[Future, float]]] = {}
+        self._dispatcher: Optional[Task] = None
+        LIMITERS[name] = self
+
+    @classmethod
+    def from_env(cls, name: str, rate: float, burst: int = 1) -> 'RateLimiter':
+        """
+        Reads `{NAME}_RATE_LIMIT` (requests per second) and `{NAME}_RATE_BURST` overrides from the environment, both
+        for the whole node, and divides them between the `WEB_CONCURRENCY` workers
+        """
+        prefix = name.upper()
+        return cls(
+            name=name,
+            rate=float(os.getenv(f'{prefix}_RATE_LIMIT', str(rate))) / WORKERS,
+            burst=max(int(os.getenv(f'{prefix}_RATE_BURST', str(burst))) // WORKERS, 1)
+        )
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    async def acquire(self, cost: float = 1):
+        start = monotonic()
+        self._refill(start)
+        if not self._waiters and self._tokens >= min(cost, self.burst):
+            self._tokens -= cost
+            self._record(0.0)
+            return
+        loop = get_running_loop()
+        waiter = loop.create_future()
+        self._waiters.setdefault(CALLER.get(), deque()).append((waiter, cost))
+        LIMITER_QUEUED.labels(self.name).set(self.queued)
+        if self._dispatcher is None or self._dispatcher.done() or self._dispatcher.get_loop() is not loop:
+            self._dispatcher = loop.create_task(self._dispatch())
+        try:
+            await waiter
+        except CancelledError:
+            # the dispatcher skips cancelled waiters, but a token granted just before cancellation is handed back
+            if waiter.done() and not waiter.cancelled():
+                self._tokens = min(self.burst, self._tokens + cost)
+            raise
+        self._record(monotonic() - start)
+
+    def _record(self, wait: float):
+        self.stats.record(wait)
+        LIMITER_WAIT.labels(self.name).observe(wait)
+
+    async def _dispatch(self):
+        while self._waiters:
+            self._refill(monotonic())
+            cost = self._next_cost()
+            if cost is None:
+                break
+            if self._tokens < min(cost, self.burst):
+                await sleep((min(cost, self.burst) - self._tokens) / self.rate)
+                continue
+            caller = next(iter(self._waiters))
+            waiters = self._waiters.pop(caller)
+            waiter, _ = waiters.popleft()
+            if waiters:
+                # rotate the caller to the back of the queue
+                self._waiters[caller] = waiters
+            self._tokens -= cost
+            waiter.set_result(None)
+            LIMITER_QUEUED.labels(self.name).set(self.queued)
+
+    def _next_cost(self) -> Optional[float]:
+        """The cost of the waiter whose turn it is, which stays queued until granted, dropping cancelled waiters"""
+        while self._waiters:
+            caller = next(iter(self._waiters))
+            waiters = self._waiters[caller]
+            while waiters and waiters[0][0].done():
+                waiters.popleft()
+            if waiters:
+                return waiters[0][1]
+            del self._waiters[caller]
+        LIMITER_QUEUED.labels(self.name).set(0)
+        return None
+
+    def _refill(self, now: float):
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def snapshot(self) -> dict:
+        return {
+            'rate': self.rate,
+            'burst': self.burst,
+            'queued': self.queued,
+            'acquired': self.stats.acquired,
+            'waited': self.stats.waited,
+            'total_wait_seconds': self.stats.total_wait,
+            'max_wait_seconds': self.stats.max_wait,
+            'p50_wait_seconds': self.stats.percentile(0.5),
+            'p95_wait_seconds': self.stats.percentile(0.95),
+            'p99_wait_seconds': self.stats.percentile(0.99),
+        }
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
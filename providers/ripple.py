@@ -1,21 +1,37 @@
-from asyncio import Semaphore
-from datetime import datetime, timezone
+import os
+from datetime import datetime, timezone, timedelta
 from aiohttp import ClientSession
 from dateutil.parser import isoparse
+from memoize.wrapper import memoize
+from memoize.configuration import MutableCacheConfiguration, DefaultInMemoryCacheConfiguration
 from blockchains import BLOCKCHAIN_MAP
 from entities import HeightPaginatedResponse, Transaction, Blockchain, FeeEstimate, Amount, Transfer
 from providers.abstract import AbstractProvider
+from providers.ratelimit import RateLimiter
+from providers.singleflight import coalesce
+from metrics import UpstreamCall, endpoint_label, instrument_cache
+from cache import shared
 
-BASE_URL = 'https://data.ripple.com/v2'
-SEM = Semaphore(10)
-LAST_BLOCK_HEIGHT = 0
+BASE_URL = os.getenv('RIPPLE_URL', 'https://data.ripple.com/v2')
+RATE_LIMIT = RateLimiter.from_env('ripple', rate=10, burst=10)
+PAGE_SIZE = 1000  # most transactions the Data API returns per page
+MAX_PAGES = int(os.getenv('RIPPLE_MAX_PAGES', '10'))
+
+
+def ledger_time_cache_config():
+    configuration = MutableCacheConfiguration.initialized_with(DefaultInMemoryCacheConfiguration(
+        capacity=10_000,
+        method_timeout=timedelta(seconds=30),
+        update_after=timedelta(days=365),
+        expire_after=timedelta(days=365),
+    ))
+    # a ledger's close time never changes, so every worker can use the others' lookups
+    return instrument_cache('ripple_ledger_time', shared('ripple_ledger_time', configuration))
 
 
 class RippleProvider(AbstractProvider):
     async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
         val = await self._get(session, 'ledgers')
-        global LAST_BLOCK_HEIGHT
-        LAST_BLOCK_HEIGHT = val['ledger']['ledger_index']
         return Blockchain(
             fee_estimates=[FeeEstimate(
                 fee=Amount(currency_id='ripple-mainnet:__native__', amount='10'),
@@ -30,62 +46,119 @@ class RippleProvider(AbstractProvider):
         )
 
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str, start_height: int,
-                                       end_height: int) -> HeightPaginatedResponse[Transaction]:
-        val = await self._get(session, f'accounts/{address}/transactions', params={
+                                       end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
+        """
+        Walks the account's payments from `end_height` down to `start_height`, newest first, one marker page at a time.
+        The height range is pushed upstream as the close times of its first and last ledgers. At most `MAX_PAGES`
+        pages are read per call, after which the next page continues below the lowest complete ledger.
+        """
+        params = {
             'type': 'Payment',
-            'descending': 'false',
-            'limit': '10000'
-        })
+            'descending': 'true',
+            'limit': str(PAGE_SIZE)
+        }
+        if start_height > 0:
+            params['start'] = await self._get_ledger_time(session, start_height)
+        tip_height = self.tip_height(chain_id)
+        if not 0 < tip_height <= end_height:
+            params['end'] = await self._get_ledger_time(session, end_height)
+
         txns = []
-        for i, tx in enumerate(val['transactions']):
-            txid = f'{chain_id}:{tx["hash"]}'
-            fee = Amount(currency_id='ripple-mainnet:__native__', amount=tx['tx']['Fee'])
-            total_amount = tx['tx']['Amount']
-            if tx['meta']['TransactionResult'] != 'tesSUCCESS':
-                total_amount = '0'
-            xfers = [
-                Transfer(
-                    transfer_id=f'{txid}:0',
-                    blockchain_id=chain_id,
-                    from_address=tx['tx']['Account'],
-                    to_address='__fee__',
-                    index=0,
-                    transaction_id=txid,
-                    amount=fee,
-                    meta={}
-                ),
-                Transfer(
-                    transfer_id=f'{txid}:1',
-                    blockchain_id=chain_id,
-                    from_address=tx['tx']['Account'],
-                    to_address=tx['tx']['Destination'],
-                    index=1,
-                    transaction_id=txid,
-                    amount=Amount(currency_id='ripple-mainnet:__native__', amount=total_amount),
-                    meta={}
-                )
-            ]
-            txns.append(Transaction(
+        has_more = False
+        pages = 0
+        # how far down the walk got, rows outside the range included
+        lowest_ledger = end_height + 1
+        while True:
+            val = await self._get(session, f'accounts/{address}/transactions', params=params)
+            rows = val.get('transactions', [])
+            txns.extend(tx for tx in rows if start_height <= tx['ledger_index'] <= end_height)
+            if rows:
+                lowest_ledger = rows[-1]['ledger_index']
+            pages += 1
+            marker = val.get('marker')
+            if not marker:
+                break
+            if pages >= MAX_PAGES:
+                has_more = True
+                break
+            params = {**params, 'marker': marker}
+
+        resp = HeightPaginatedResponse(contents=[], has_more=False)
+        # once the walk is below the range every ledger in it has been read
+        if has_more and lowest_ledger >= start_height:
+            resp.has_more = True
+            resp.next_start_height = start_height
+            if lowest_ledger > end_height:
+                # the close time pushdown is approximate, every page so far was above the range
+                resp.next_end_height = end_height
+            elif any(tx['ledger_index'] > lowest_ledger for tx in txns):
+                # the last page may have stopped part way through a ledger, leave that ledger for the next page
+                txns = [tx for tx in txns if tx['ledger_index'] > lowest_ledger]
+                resp.next_end_height = lowest_ledger
+            else:
+                # a single ledger filled every page, accept the truncation rather than never making progress
+                resp.next_end_height = lowest_ledger - 1
+                resp.has_more = resp.next_end_height >= start_height
+
+        resp.contents = [self._to_transaction(chain_id, tx, i) for i, tx in enumerate(reversed(txns))]
+        return resp
+
+    def _to_transaction(self, chain_id: str, tx: dict, i: int) -> Transaction:
+        txid = f'{chain_id}:{tx["hash"]}'
+        fee = Amount.trusted(currency_id='ripple-mainnet:__native__', amount=tx['tx']['Fee'])
+        total_amount = tx['tx']['Amount']
+        # issued currency payments carry an object here and move no XRP
+        if tx['meta']['TransactionResult'] != 'tesSUCCESS' or not isinstance(total_amount, str):
+            total_amount = '0'
+        xfers = [
+            Transfer.trusted(
+                transfer_id=f'{txid}:0',
+                blockchain_id=chain_id,
+                from_address=tx['tx']['Account'],
+                to_address='__fee__',
+                index=0,
                 transaction_id=txid,
-                identifier=tx['hash'],
-                hash=tx['hash'],
+                amount=fee,
+                meta={}
+            ),
+            Transfer.trusted(
+                transfer_id=f'{txid}:1',
                 blockchain_id=chain_id,
-                timestamp=isoparse(tx['date']).replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
-                _embedded={'transfers': xfers},
-                fee=fee,
-                confirmations=LAST_BLOCK_HEIGHT - tx['ledger_index'],
-                index=i,
-                size=1,
-                block_hash='',
-                block_height=tx['ledger_index'],
-                status='confirmed' if tx['meta']['TransactionResult'] == 'tesSUCCESS' else 'failed',
-                meta={'DestinationTag': tx['tx'].get('DestinationTag', 0)},
-            ))
-        return HeightPaginatedResponse(contents=txns, has_more=False)
+                from_address=tx['tx']['Account'],
+                to_address=tx['tx']['Destination'],
+                index=1,
+                transaction_id=txid,
+                amount=Amount.trusted(currency_id='ripple-mainnet:__native__', amount=total_amount),
+                meta={}
+            )
+        ]
+        return Transaction.trusted(
+            transaction_id=txid,
+            identifier=tx['hash'],
+            hash=tx['hash'],
+            blockchain_id=chain_id,
+            timestamp=isoparse(tx['date']).replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+            _embedded={'transfers': xfers},
+            fee=fee,
+            confirmations=self.tip_height(chain_id) - tx['ledger_index'],
+            index=i,
+            size=1,
+            block_hash='',
+            block_height=tx['ledger_index'],
+            status='confirmed' if tx['meta']['TransactionResult'] == 'tesSUCCESS' else 'failed',
+            meta={'DestinationTag': str(tx['tx'].get('DestinationTag', 0))},
+        )
+
+    @memoize(configuration=ledger_time_cache_config())
+    async def _get_ledger_time(self, session, ledger_index: int) -> str:
+        val = await self._get(session, f'ledgers/{ledger_index}')
+        return datetime.utcfromtimestamp(val['ledger']['close_time']).replace(tzinfo=timezone.utc).isoformat()
 
+    @coalesce
     async def _get(self, session, endpoint, **kwargs):
         url = f'{BASE_URL}/{endpoint}'
-        async with SEM, session.get(url, **kwargs) as resp:
+        async with RATE_LIMIT, UpstreamCall('ripple', endpoint_label(endpoint), session.get(url, **kwargs)) as resp:
             if resp.status != 200:
                 print(f'RippleProvider invalid status code: {resp.status} for url: {url}')
                 resp.raise_for_status()
@@ -0,0 +1,187 @@
+import os
+from asyncio import ensure_future, gather, wait, FIRST_COMPLETED
+from collections import deque
+from time import monotonic
+from typing import Deque, List, Dict, Tuple, Callable, Awaitable, Optional, TypeVar
+from aiohttp import ClientSession
+from entities import Blockchain, Transaction, HeightPaginatedResponse
+from providers.abstract import AbstractProvider
+
+WINDOW = int(os.getenv('ROUTING_WINDOW', '200'))  # calls per backend the statistics are computed over
+MIN_SAMPLES = int(os.getenv('ROUTING_MIN_SAMPLES', '20'))
+ERROR_THRESHOLD = float(os.getenv('ROUTING_ERROR_THRESHOLD', '0.5'))
+COOLDOWN = float(os.getenv('ROUTING_COOLDOWN', '30'))  # seconds a failing backend is skipped for
+HEDGE_DELAY = float(os.getenv('ROUTING_HEDGE_DELAY', '2'))  # used until a backend has MIN_SAMPLES latencies
+MIN_HEDGE_DELAY = float(os.getenv('ROUTING_MIN_HEDGE_DELAY', '0.05'))
+MAX_HEDGE_DELAY = float(os.getenv('ROUTING_MAX_HEDGE_DELAY', '10'))
+
+T = TypeVar('T')
+
+
+class BackendStats:
+    """
+    Rolling latency and error statistics for one backend, with a simple circuit breaker on the error rate. Latencies
+    are kept per kind of call (`head`, `address` and `batch`), a tip lookup says nothing about how long a full history
+    takes.
+    """
+
+    def __init__(self):
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.outcomes = deque(maxlen=WINDOW)  # True for every failed call
+        self.calls = 0
+        self.errors = 0
+        self.hedges = 0
+        self.failovers = 0
+        self.open_until = 0.0
+
+    def record(self, kind: str, latency: float, failed: bool):
+        self.calls += 1
+        self.outcomes.append(failed)
+        if failed:
+            self.errors += 1
+            if len(self.outcomes) >= MIN_SAMPLES and self.error_rate() >= ERROR_THRESHOLD:
+                self.open_until = monotonic() + COOLDOWN
+                # the backend has to fail again on fresh calls to be skipped again after the cooldown
+                self.outcomes.clear()
+        else:
+            self.latencies.setdefault(kind, deque(maxlen=WINDOW)).append(latency)
+
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def healthy(self) -> bool:
+        return monotonic() >= self.open_until
+
+    def hedge_delay(self, kind: str) -> float:
+        latencies = self.latencies.get(kind, ())
+        if len(latencies) < MIN_SAMPLES:
+            return HEDGE_DELAY
+        ordered = sorted(latencies)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        return min(max(p95, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def snapshot(self) -> dict:
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'hedges': self.hedges,
+            'failovers': self.failovers,
+            'error_rate': round(self.error_rate(), 3),
+            'hedge_delays': {kind: round(self.hedge_delay(kind), 3) for kind in sorted(self.latencies)},
+            'healthy': self.healthy(),
+        }
+
+
+class RoutingProvider(AbstractProvider):
+    """
+    Serves a chain from several interchangeable backends, in order of preference. A call goes to the first healthy
+    backend; if it has not answered within that backend's p95 latency a duplicate goes to the next one and whichever
+    answers first wins. A failed call moves on to the next backend straight away, and a backend whose error rate
+    crosses `ERROR_THRESHOLD` is skipped for `COOLDOWN` seconds.
+    """
+
+    def __init__(self, backends: List[Tuple[str, AbstractProvider]]):
+        self.backends = backends
+        self.stats: Dict[str, BackendStats] = {name: BackendStats() for name, _ in backends}
+        self.max_batch_size = max(backend.max_batch_size for _, backend in backends)
+        self.provides_raw = any(backend.provides_raw for _, backend in backends)
+
+    def supports_chain(self, chain_id: str) -> bool:
+        return any(backend.supports_chain(chain_id) for _, backend in self.backends)
+
+    async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
+        return await self._route(chain_id, 'head', lambda backend: backend.get_blockchain_data(session, chain_id))
+
+    async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str,
+                                       start_height: int, end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
+        return await self._route(chain_id, 'address', lambda backend: backend.get_address_transactions(
+            session=session, chain_id=chain_id, address=address, start_height=start_height, end_height=end_height,
+            include_raw=include_raw))
+
+    async def get_addresses_transactions(self, session: ClientSession, chain_id: str, addresses: List[str],
+                                         start_height: int, end_height: int,
+                                         include_raw: bool = False) -> Dict[str, HeightPaginatedResponse[Transaction]]:
+        async def fetch(backend: AbstractProvider, batch: List[str]) -> Dict[str, HeightPaginatedResponse[Transaction]]:
+            if len(batch) > 1:
+                return await backend.get_addresses_transactions(
+                    session=session, chain_id=chain_id, addresses=batch, start_height=start_height,
+                    end_height=end_height, include_raw=include_raw)
+            return {batch[0]: await backend.get_address_transactions(
+                session=session, chain_id=chain_id, address=batch[0], start_height=start_height,
+                end_height=end_height, include_raw=include_raw)}
+
+        async def call(backend: AbstractProvider):
+            # backends batch differently, so each one splits the addresses up to its own batch size. The batches are
+            # fetched together and queue on the backend's rate limiter.
+            size = backend.max_batch_size
+            responses = {}
+            for batch_responses in await gather(*(fetch(backend, addresses[i:i + size])
+                                                  for i in range(0, len(addresses), size))):
+                responses.update(batch_responses)
+            return responses
+        return await self._route(chain_id, 'batch', call)
+
+    def snapshot(self) -> dict:
+        return {name: stats.snapshot() for name, stats in self.stats.items()}
+
+    def _candidates(self, chain_id: str) -> List[Tuple[str, AbstractProvider]]:
+        supported = [(name, backend) for name, backend in self.backends if backend.supports_chain(chain_id)]
+        if not supported:
+            raise ValueError(f'Unsupported chain: {chain_id}')
+        healthy = [(name, backend) for name, backend in supported if self.stats[name].healthy()]
+        # when every backend is failing there is nothing better to do than keep trying them
+        return healthy or supported
+
+    async def _timed(self, name: str, backend: AbstractProvider, kind: str,
+                     call: Callable[[AbstractProvider], Awaitable[T]]) -> T:
+        started = monotonic()
+        try:
+            result = await call(backend)
+        except Exception:
+            self.stats[name].record(kind, monotonic() - started, failed=True)
+            raise
+        self.stats[name].record(kind, monotonic() - started, failed=False)
+        return result
+
+    async def _route(self, chain_id: str, kind: str, call: Callable[[AbstractProvider], Awaitable[T]]) -> T:
+        """Runs `call` against the backends, hedging against the p95 latency of the same `kind` of call"""
+        remaining = iter(self._candidates(chain_id))
+        pending = {}
+        error: Optional[Exception] = None
+
+        def launch() -> bool:
+            name, backend = next(remaining, (None, None))
+            if backend is None:
+                return False
+            pending[ensure_future(self._timed(name, backend, kind, call))] = name
+            return True
+
+        hedge_delay = self._launch_next(launch, pending, kind)
+        try:
+            while pending:
+                done, _ = await wait(pending, timeout=hedge_delay, return_when=FIRST_COMPLETED)
+                if not done:
+                    # the latest backend is slower than usual, race it against the next one
+                    self.stats[list(pending.values())[-1]].hedges += 1
+                    hedge_delay = self._launch_next(launch, pending, kind)
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                    print(f'RoutingProvider backend {name} failed for {chain_id}: {error!r}')
+                    if not pending and launch():
+                        self.stats[name].failovers += 1
+                        hedge_delay = self.stats[list(pending.values())[-1]].hedge_delay(kind)
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _launch_next(self, launch: Callable[[], bool], pending: dict, kind: str) -> Optional[float]:
+        """Starts the next backend and returns how long to give it before hedging, None once none are left"""
+        if not launch():
+            return None
+        return self.stats[list(pending.values())[-1]].hedge_delay(kind)
@@ -0,0 +1,62 @@
+from asyncio import Future, ensure_future, shield
+from functools import wraps
+from typing import Any, Dict, Hashable
+from aiohttp import ClientSession
+
+# query parameters carrying credentials, never part of a request's identity
+SECRET_PARAMS = {'apikey', 'key', 'token'}
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call for a key is in flight every other caller with the same key
+    waits on it and receives the same result (or exception) instead of starting its own.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, Future] = {}
+        self.started = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn, *args, **kwargs) -> Any:
+        call = self._calls.get(key)
+        if call is None:
+            call = ensure_future(fn(*args, **kwargs))
+            self._calls[key] = call
+            call.add_done_callback(lambda done: self._forget(key, done))
+            self.started += 1
+        else:
+            self.shared += 1
+        # one caller being cancelled must not cancel the call for everyone else
+        return await shield(call)
+
+    def _forget(self, key: Hashable, call: Future):
+        if self._calls.get(key) is call:
+            del self._calls[key]
+        if not call.cancelled():
+            # mark the exception as retrieved in case every waiter was cancelled
+            call.exception()
+
+
+FLIGHTS = SingleFlight()
+
+
+def coalesce(fn):
+    """Decorates a provider's `_get` so concurrent identical upstream requests share one call and one parsed result"""
+    @wraps(fn)
+    async def wrapper(self, *args, **kwargs):
+        key = (
+            fn.__qualname__,
+            tuple(_freeze(arg) for arg in args if not isinstance(arg, ClientSession)),
+            tuple(sorted((k, _freeze(v)) for k, v in kwargs.items()))
+        )
+        return await FLIGHTS.do(key, fn, self, *args, **kwargs)
+    return wrapper
+
+
+def _freeze(value) -> Hashable:
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items() if k not in SECRET_PARAMS))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
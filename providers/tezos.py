@@ -1,19 +1,30 @@
+import os
+from asyncio import gather, Semaphore
 from datetime import datetime, timezone
+from typing import List, Tuple
 from aiohttp import ClientSession
-from dateutil.parser import isoparse
 from blockchains import BLOCKCHAIN_MAP
 from entities import Blockchain, HeightPaginatedResponse, Transaction, FeeEstimate, Amount, Transfer
-from providers.abstract import AbstractProvider
+from providers.abstract import AbstractProvider, resume_height
+from providers.ratelimit import RateLimiter
+from providers.singleflight import coalesce
+from metrics import UpstreamCall, endpoint_label
 
-API_URL = 'https://api.tzstats.com/explorer'
-RPC_URL = 'https://mainnet-tezos.giganode.io'
+TABLE_URL = os.getenv('TEZOS_TABLE_URL', 'https://api.tzstats.com/tables')
+RPC_URL = os.getenv('TEZOS_RPC_URL', 'https://mainnet-tezos.giganode.io')
 MUTEZ = 1_000_000
+OP_TYPES = 'transaction,delegation,reveal,bake,airdrop'
+OP_COLUMNS = ['row_id', 'time', 'height', 'hash', 'type', 'status', 'volume', 'fee', 'burned', 'storage_size',
+              'block', 'sender', 'receiver']
+PAGE_SIZE = int(os.getenv('TEZOS_PAGE_SIZE', '1000'))
+MAX_PAGES = int(os.getenv('TEZOS_MAX_PAGES', '10'))
+SEM = Semaphore(int(os.getenv('TEZOS_CONCURRENCY', '4')))
+RATE_LIMIT = RateLimiter.from_env('tezos', rate=10, burst=10)
 
 
 class TezosProvider(AbstractProvider):
     async def get_blockchain_data(self, session: ClientSession, chain_id: str) -> Blockchain:
-        async with session.get(f'{RPC_URL}/chains/main/blocks/head/header') as resp:
-            val = await resp.json()
+        val = await self._get(session, f'{RPC_URL}/chains/main/blocks/head/header')
         return Blockchain(
             fee_estimates=[FeeEstimate(
                 fee=Amount(currency_id='tezos-mainnet:__native__', amount='1'),
@@ -28,28 +39,37 @@ class TezosProvider(AbstractProvider):
         )
 
     async def get_address_transactions(self, session: ClientSession, chain_id: str, address: str, start_height: int,
-                                       end_height: int) -> HeightPaginatedResponse[Transaction]:
-        params = {
-            'order': 'asc',
-            'limit': '10000',
-            'types': 'transaction,delegation,reveal,bake,airdrop,'
-        }
-        async with session.get(f'{API_URL}/account/{address}/op', params=params) as resp:
-            val = await resp.json()
+                                       end_height: int,
+                                       include_raw: bool = False) -> HeightPaginatedResponse[Transaction]:
+        tip_height = self.tip_height(chain_id)
+        # an operation can involve the account on either side, and the table can only be filtered by one column
+        (sent, sent_more), (received, received_more) = await gather(
+            self._get_ops(session, 'sender', address, start_height, end_height),
+            self._get_ops(session, 'receiver', address, start_height, end_height)
+        )
+
+        # a stream that stopped early is only complete below the height of its last row
+        next_start_height = None
+        for rows, more in ((sent, sent_more), (received, received_more)):
+            if more and rows and (next_start_height is None or rows[-1]['height'] < next_start_height):
+                next_start_height = rows[-1]['height']
+        ops = {op['row_id']: op for op in sent + received}
+        if next_start_height is not None:
+            next_start_height = resume_height(next_start_height, start_height)
+            ops = {row_id: op for row_id, op in ops.items() if op['height'] < next_start_height}
 
         txns = []
         by_hash = {}
-        for op in val['ops']:
-            ops = by_hash.setdefault(op['hash'], [])
-            ops.append(op)
+        for _, op in sorted(ops.items()):
+            by_hash.setdefault(op['hash'], []).append(op)
 
         for i, (hsh, oplist) in enumerate(by_hash.items()):
             txid = f'{chain_id}:{hsh}'
             combined_fee = round(sum(op['fee'] * MUTEZ for op in oplist))
-            fee = Amount(currency_id='tezos-mainnet:__native__', amount=str(int(combined_fee)))
+            fee = Amount.trusted(currency_id='tezos-mainnet:__native__', amount=str(int(combined_fee)))
             op = oplist[0]
             xfers = [
-                Transfer(
+                Transfer.trusted(
                     transfer_id=f'{txid}:0',
                     blockchain_id=chain_id,
                     from_address=oplist[0]['sender'],
@@ -65,38 +85,40 @@ class TezosProvider(AbstractProvider):
                 if op['status'] == 'failed' or op['status'] == 'backtracked':
                     total_amount = '0'
                 xfers.append(
-                    Transfer(
+                    Transfer.trusted(
                         transfer_id=f'{txid}:1',
                         blockchain_id=chain_id,
                         from_address=op['sender'],
                         to_address=op.get('receiver', 'unknown'),
                         index=1,
                         transaction_id=txid,
-                        amount=Amount(currency_id='tezos-mainnet:__native__', amount=str(total_amount)),
+                        amount=Amount.trusted(currency_id='tezos-mainnet:__native__', amount=str(total_amount)),
                         meta={'status': op['status'], 'type': op['type'].upper()}
                     ))
             if op.get('burned', 0):
                 xfers.append(
-                    Transfer(
+                    Transfer.trusted(
                         transfer_id=f'{txid}:3',
                         blockchain_id=chain_id,
                         from_address=oplist[0]['sender'],
                         to_address='__fee__',
                         index=0,
                         transaction_id=txid,
-                        amount=Amount(currency_id='tezos-mainnet:__native__', amount=(str(round(op['burned'] * MUTEZ)))),
+                        amount=Amount.trusted(currency_id='tezos-mainnet:__native__',
+                                              amount=str(round(op['burned'] * MUTEZ))),
                         meta={'status': op['status'], 'type': op['type'].upper()}
                     )
                 )
-            txns.append(Transaction(
+            txns.append(Transaction.trusted(
                 transaction_id=txid,
                 identifier=hsh,
                 hash=hsh,
                 blockchain_id=chain_id,
-                timestamp=isoparse(op['time']).replace(tzinfo=timezone.utc).isoformat(timespec='milliseconds'),
+                timestamp=datetime.utcfromtimestamp(op['time'] / 1000).replace(tzinfo=timezone.utc).isoformat(
+                    timespec='milliseconds'),
                 _embedded={'transfers': xfers},
                 fee=fee,
-                confirmations=op['confirmations'],
+                confirmations=tip_height - op['height'],
                 index=i,
                 size=op['storage_size'],
                 block_hash=op['block'],
@@ -105,4 +127,39 @@ class TezosProvider(AbstractProvider):
                 meta={},
             ))
 
+        if next_start_height is not None and next_start_height <= end_height:
+            return HeightPaginatedResponse(contents=txns, has_more=True, next_start_height=next_start_height,
+                                           next_end_height=end_height)
         return HeightPaginatedResponse(contents=txns, has_more=False)
+
+    async def _get_ops(self, session, column: str, address: str, start_height: int,
+                       end_height: int) -> Tuple[List[dict], bool]:
+        """
+        Pages through the operation table in row order for operations where `column` is the address, requesting only
+        the columns used here in the compact table format. Returns the rows and whether `MAX_PAGES` ran out first.
+        """
+        params = {
+            column: address,
+            'type.in': OP_TYPES,
+            'height.gte': str(start_height),
+            'height.lte': str(end_height),
+            'columns': ','.join(OP_COLUMNS),
+            'order': 'asc',
+            'limit': str(PAGE_SIZE)
+        }
+        ops = []
+        for _ in range(MAX_PAGES):
+            rows = await self._get(session, f'{TABLE_URL}/op', params=params)
+            ops.extend(dict(zip(OP_COLUMNS, row)) for row in rows)
+            if len(rows) < PAGE_SIZE:
+                return ops, False
+            params = {**params, 'cursor': str(ops[-1]['row_id'])}
+        return ops, True
+
+    @coalesce
+    async def _get(self, session, url, **kwargs):
+        async with SEM, RATE_LIMIT, UpstreamCall('tezos', endpoint_label(url), session.get(url, **kwargs)) as resp:
+            if resp.status != 200:
+                print(f'TezosProvider invalid status code: {resp.status} for url: {url}')
+                resp.raise_for_status()
+            return await resp.json()
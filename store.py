@@ -0,0 +1,153 @@
+import json
+import os
+import sqlite3
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, List, Dict, Tuple
+import orjson
+from entities import Transaction, dumps
+from metrics import CACHE_EVENTS
+from cache import CACHE, CACHE_DIR
+
+TRANSACTION_STORE_PATH = os.getenv('TRANSACTION_STORE_PATH', str(CACHE_DIR / 'transactions.sqlite3'))
+PENDING_TRANSACTION_TTL = int(os.getenv('PENDING_TRANSACTION_TTL', '300'))
+ADDRESS_INDEX_PATH = os.getenv('ADDRESS_INDEX_PATH', str(CACHE_DIR / 'addresses.sqlite3'))
+
+
+class TransactionStore:
+    """
+    Decoded raw transactions keyed by `chain_id:txid`. Everything fetched is kept in a bounded in-memory LRU, and
+    transactions that are final are also written to SQLite so the cache is warm again after a restart. Transactions
+    that are not final yet go to the shared cache for `PENDING_TRANSACTION_TTL` seconds, so the other workers on the
+    node find them too.
+    """
+
+    def __init__(self, path: str = TRANSACTION_STORE_PATH, capacity: int = 100_000):
+        self.capacity = capacity
+        self._memory = OrderedDict()
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS transactions (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+
+    def get(self, chain_id: str, txid: str) -> Optional[dict]:
+        key = f'{chain_id}:{txid}'
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            CACHE_EVENTS.labels('transaction_store', 'hit').inc()
+            return self._memory[key]
+        row = self._db.execute('SELECT value FROM transactions WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            CACHE_EVENTS.labels('transaction_store', 'disk_hit').inc()
+            value = json.loads(row[0])
+        elif (value := CACHE.get(f'pending_transaction:{key}')) is not None:
+            CACHE_EVENTS.labels('transaction_store', 'shared_hit').inc()
+        else:
+            CACHE_EVENTS.labels('transaction_store', 'miss').inc()
+            return None
+        self._remember(key, value)
+        return value
+
+    def put(self, chain_id: str, txid: str, value: dict, final: bool):
+        key = f'{chain_id}:{txid}'
+        self._remember(key, value)
+        if final:
+            self._db.execute('INSERT OR REPLACE INTO transactions (key, value) VALUES (?, ?)',
+                             (key, json.dumps(value, separators=(',', ':'))))
+        else:
+            CACHE.set(f'pending_transaction:{key}', value, ttl=PENDING_TRANSACTION_TTL)
+
+    def close(self):
+        self._db.close()
+
+    def _remember(self, key: str, value: dict):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+            CACHE_EVENTS.labels('transaction_store', 'eviction').inc()
+
+
+class AddressHistory:
+    """
+    Final transactions of one address within the requested heights, the index is complete for every height up to
+    and including `scanned_height`.
+    """
+
+    def __init__(self, scanned_height: int, transactions: List[Transaction]):
+        self.scanned_height = scanned_height
+        self.transactions = transactions
+
+
+class AddressIndex:
+    """
+    Per `(blockchain_id, address)` index of final transactions already fetched from a provider, along with the highest
+    final height that has been scanned, so repeat queries only need to fetch the delta above it.
+    """
+
+    def __init__(self, path: str = ADDRESS_INDEX_PATH):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS address_scans ('
+                         'key TEXT PRIMARY KEY, scanned_height INTEGER NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS address_transactions ('
+                         'key TEXT NOT NULL, transaction_id TEXT NOT NULL, block_height INTEGER NOT NULL, '
+                         'tip_height INTEGER NOT NULL, value TEXT NOT NULL, PRIMARY KEY (key, transaction_id))')
+        self._db.execute('CREATE INDEX IF NOT EXISTS address_transactions_height '
+                         'ON address_transactions (key, block_height)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS address_balances ('
+                         'key TEXT PRIMARY KEY, height INTEGER NOT NULL, amounts TEXT NOT NULL)')
+
+    def get(self, blockchain_id: str, address: str, tip_height: int, start_height: int,
+            end_height: int) -> Optional[AddressHistory]:
+        key = f'{blockchain_id}:{address}'
+        row = self._db.execute('SELECT scanned_height FROM address_scans WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            CACHE_EVENTS.labels('address_index', 'miss').inc()
+            return None
+        CACHE_EVENTS.labels('address_index', 'hit').inc()
+        transactions = []
+        for stored_tip_height, value in self._db.execute(
+                'SELECT tip_height, value FROM address_transactions WHERE key = ? AND block_height BETWEEN ? AND ? '
+                'ORDER BY block_height', (key, start_height, end_height)):
+            txn = Transaction.from_dict(orjson.loads(value))
+            # confirmations were correct against the tip at the time the transaction was stored
+            txn.confirmations += tip_height - stored_tip_height
+            transactions.append(txn)
+        return AddressHistory(scanned_height=row[0], transactions=transactions)
+
+    def extend(self, blockchain_id: str, address: str, transactions: List[Transaction], tip_height: int,
+               scanned_height: int):
+        key = f'{blockchain_id}:{address}'
+        with self._db:
+            self._db.execute('BEGIN')
+            self._db.executemany(
+                'INSERT OR REPLACE INTO address_transactions (key, transaction_id, block_height, tip_height, value) '
+                'VALUES (?, ?, ?, ?, ?)',
+                [(key, txn.transaction_id, txn.block_height, tip_height, dumps(txn).decode('utf-8'))
+                 for txn in transactions]
+            )
+            self._db.execute('INSERT OR REPLACE INTO address_scans (key, scanned_height) VALUES (?, ?)',
+                             (key, scanned_height))
+
+    def get_balance(self, blockchain_id: str, address: str) -> Optional[Tuple[int, Dict[str, int]]]:
+        """The address's `(height, {currency_id: amount})` as of a final height, None before one was stored"""
+        row = self._db.execute('SELECT height, amounts FROM address_balances WHERE key = ?',
+                               (f'{blockchain_id}:{address}',)).fetchone()
+        if row is None:
+            CACHE_EVENTS.labels('address_balance', 'miss').inc()
+            return None
+        CACHE_EVENTS.labels('address_balance', 'hit').inc()
+        return row[0], {currency_id: int(amount) for currency_id, amount in json.loads(row[1]).items()}
+
+    def set_balance(self, blockchain_id: str, address: str, height: int, amounts: Dict[str, int]):
+        # amounts are stored as strings, token balances don't fit in SQLite's 64 bit integers
+        self._db.execute('INSERT OR REPLACE INTO address_balances (key, height, amounts) VALUES (?, ?, ?)',
+                         (f'{blockchain_id}:{address}', height,
+                          json.dumps({currency_id: str(amount) for currency_id, amount in amounts.items()})))
+
+    def close(self):
+        self._db.close()
@@ -66,6 +66,8 @@ class BlocksetApiMixin:
             if len(parsed_qs.get('start_height', [])):
                 new_params = dict(params)
                 new_params['start_height'] = parsed_qs['start_height'][0]
+                if len(parsed_qs.get('cursor', [])):
+                    new_params['cursor'] = parsed_qs['cursor'][0]
                 results.extend(self.paginate_fully(resource, new_params))
         return results
 
@@ -0,0 +1,53 @@
+from asyncio import run
+from balances import compute_balances, fold
+from entities import HeightPaginatedResponse
+from store import AddressIndex
+from tests.test_entities import make_transaction
+from tests.test_client import with_transfer
+
+
+class FakeHead:
+    def __init__(self, height):
+        self.verified_height = height
+
+
+class FakeClient:
+    """Serves a fixed history, remembering the positions each call asked for"""
+
+    def __init__(self, index, transactions):
+        self.address_index = index
+        self.transactions = transactions
+        self.tip_height = 100
+        self.calls = []
+
+    async def get_blockchain(self, blockchain_id):
+        return FakeHead(self.tip_height)
+
+    async def get_transactions_by_address(self, addresses, blockchain_id, start_height, end_height, positions):
+        self.calls.append(positions)
+        return {address: HeightPaginatedResponse(
+            contents=[txn for txn in self.transactions if positions[address][0] <= txn.block_height or
+                      txn.block_height <= 0], has_more=False) for address in addresses}
+
+
+def test_final_balances_are_kept_and_only_the_delta_is_folded(tmp_path):
+    # every test transaction sends a 226 fee from bc1qsender
+    client = FakeClient(AddressIndex(str(tmp_path / 'addresses.sqlite3')),
+                        [make_transaction(True, height) for height in (10, 50, 99)])
+    assert [(b.currency_id, b.amount) for b in run(compute_balances(client, 'bitcoin-mainnet', ['bc1qsender']))] \
+        == [('bitcoin-mainnet:__native__', '-678')]
+    assert client.address_index.get_balance('bitcoin-mainnet', 'bc1qsender') == \
+        (96, {'bitcoin-mainnet:__native__': -452})
+
+    client.tip_height = 120
+    client.transactions.append(make_transaction(True, 110))
+    balances = run(compute_balances(client, 'bitcoin-mainnet', ['bc1qsender']))
+    assert [b.amount for b in balances] == ['-904'] and client.calls[-1] == {'bc1qsender': (97, 120)}
+
+
+def test_sending_to_itself_only_costs_the_fee():
+    txn = make_transaction(True, 10)
+    fee = txn.embedded['transfers'][0]
+    to_self = with_transfer(txn, 'bc1qsender', 'bc1qsender', '5000')
+    txn = txn.copy(update={'embedded': {'transfers': [fee, *to_self.embedded['transfers']]}})
+    assert fold([txn], 'bc1qsender') == {'bitcoin-mainnet:__native__': -226}
@@ -0,0 +1,60 @@
+from asyncio import run
+from providers.blockchair import BlockChairProvider
+from tests.test_client import batch_fetcher
+
+DASHBOARD = {'bc1qsender': {'transactions': [
+    {'block_id': 20, 'hash': 'aa' * 32, 'time': '2021-11-09 00:00:00', 'balance_change': -5000},
+    {'block_id': 10, 'hash': 'bb' * 32, 'time': '2021-11-08 00:00:00', 'balance_change': 7000},
+]}}
+
+
+class EmptyStore:
+    def get(self, chain_id, txid):
+        return None
+
+    def put(self, chain_id, txid, value, final):
+        pass
+
+
+class FakeBlockChair(BlockChairProvider):
+    def __init__(self):
+        super().__init__(None, EmptyStore())
+        self.endpoints = []
+
+    async def _get(self, session, chain_id, endpoint, **kwargs):
+        endpoint, _, hashes = endpoint.rpartition('/')
+        self.endpoints.append(endpoint)
+        if endpoint == 'dashboards/address':
+            return DASHBOARD
+        if endpoint == 'dashboards/transactions':
+            return {txhash: {'transaction': {'hash': txhash, 'size': 3}} for txhash in hashes.split(',')}
+        return {txhash: {'raw_transaction': '0100', 'decoded_raw_transaction': {
+            'txid': txhash, 'hash': txhash[::-1], 'size': 2}} for txhash in hashes.split(',')}
+
+
+def test_transactions_without_raw_are_described_by_the_summaries():
+    provider = FakeBlockChair()
+
+    resp = run(provider.get_address_transactions(None, 'bitcoin-mainnet', 'bc1qsender', 0, 100))
+    # one summary request for the whole page, rather than downloading the raw transactions
+    assert provider.endpoints == ['dashboards/address', 'dashboards/transactions']
+    assert [(txn.identifier, txn.hash, txn.size, txn.raw) for txn in resp.contents] == \
+        [('aa' * 32, 'aa' * 32, 3, None), ('bb' * 32, 'bb' * 32, 3, None)]
+
+    with_raw = run(provider.get_address_transactions(None, 'bitcoin-mainnet', 'bc1qsender', 0, 100, include_raw=True))
+    assert provider.endpoints[2:] == ['dashboards/address', 'raw/transaction']
+    assert [(txn.transaction_id, txn.size, txn.raw) for txn in with_raw.contents] == \
+        [(txn.transaction_id, 2, 'AQA=') for txn in resp.contents]
+
+
+def test_default_requests_are_indexed_and_served_from_the_index(tmp_path):
+    provider = FakeBlockChair()
+    fetch = batch_fetcher(tmp_path, provider)
+
+    first = fetch(0, 100)
+    assert [(txn.block_height, txn.size) for txn in first.contents] == [(20, 3), (10, 3)]
+    assert len(provider.endpoints) == 2
+    # both transactions are final at tip 100, only the heights above the scanned range are asked for again
+    second = fetch(0, 100)
+    assert [(txn.block_height, txn.size) for txn in second.contents] == [(10, 3), (20, 3)]
+    assert provider.endpoints[2:] == ['dashboards/address']
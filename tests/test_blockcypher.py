@@ -0,0 +1,52 @@
+from asyncio import run
+from providers.blockcypher import BlockCypherProvider
+
+
+def address_object(address, heights):
+    return {'address': address, 'txs': [{
+        'hash': f'{address}-{height}', 'received': '2021-11-09T00:00:00Z', 'fees': 226, 'confirmations': 6,
+        'size': 225, 'block_hash': f'{height:064x}', 'block_height': height,
+        'inputs': [{'addresses': [address], 'output_value': 1000}],
+        'outputs': [{'addresses': ['1receiver'], 'value': 774}],
+    } for height in heights]}
+
+
+class FakeBlockCypher(BlockCypherProvider):
+    """Answers `addrs` with each address's own history, except for addresses listed in `errors` or `dropped`"""
+
+    def __init__(self, histories, errors=(), dropped=()):
+        super().__init__(None)
+        self.histories = histories
+        self.errors = set(errors)
+        self.dropped = set(dropped)
+        self.calls = []
+
+    async def _get(self, session, url, cost=1, **kwargs):
+        addresses = url.split('/')[3].split(';')
+        self.calls.append((addresses, cost))
+        if len(addresses) == 1:
+            return address_object(addresses[0], self.histories[addresses[0]])
+        return [{'error': 'Rate limited, try again later'} if address in self.errors
+                else address_object(address, self.histories[address])
+                for address in addresses if address not in self.dropped]
+
+
+def heights(resp):
+    return [txn.block_height for txn in resp.contents]
+
+
+def test_batch_is_attributed_per_address_and_billed_per_address():
+    provider = FakeBlockCypher({'1a': [10, 20], '1b': [30], '1c': []})
+
+    responses = run(provider.get_addresses_transactions(None, 'bitcoin-mainnet', ['1a', '1b', '1c'], 0, 100))
+    assert {address: heights(resp) for address, resp in responses.items()} == {'1a': [10, 20], '1b': [30], '1c': []}
+    assert all(txn.embedded['transfers'][0].from_address == '1a' for txn in responses['1a'].contents)
+    assert provider.calls == [(['1a', '1b', '1c'], 3)]
+
+
+def test_errors_and_left_out_addresses_are_fetched_on_their_own():
+    provider = FakeBlockCypher({'1a': [10], '1b': [30], '1c': [40]}, errors=['1b'], dropped=['1c'])
+
+    responses = run(provider.get_addresses_transactions(None, 'bitcoin-mainnet', ['1a', '1b', '1c'], 0, 100))
+    assert {address: heights(resp) for address, resp in responses.items()} == {'1a': [10], '1b': [30], '1c': [40]}
+    assert sorted(provider.calls) == [(['1a', '1b', '1c'], 3), (['1b'], 1), (['1c'], 1)]
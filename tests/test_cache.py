@@ -0,0 +1,30 @@
+import sqlite3
+from time import monotonic
+from cache import LazyBackend, SQLiteBackend
+
+
+def test_backend_is_only_opened_on_first_use(tmp_path):
+    path = tmp_path / 'shared.sqlite3'
+    cache = LazyBackend(lambda: SQLiteBackend(str(path)))
+    assert not path.exists()
+    cache.set('key', 'value', ttl=60)
+    assert cache.get('key') == 'value'
+    cache.close()
+
+
+def test_a_locked_cache_gives_up_instead_of_blocking(tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    cache = SQLiteBackend(path, lock_timeout=0.05)
+    cache.set('key', 'old', ttl=60)
+    # another worker in the middle of a write
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+
+    started = monotonic()
+    cache.set('key', 'new', ttl=60)
+    assert not cache.lease('tips', ttl=60)
+    assert monotonic() - started < 1
+    # readers are not blocked by a writer in WAL mode
+    assert cache.get('key') == 'old'
+    other.execute('ROLLBACK')
+    assert cache.lease('tips', ttl=60)
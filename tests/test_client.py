@@ -0,0 +1,163 @@
+from asyncio import run
+from types import SimpleNamespace
+import pytest
+from client import Client
+from entities import HeightPaginatedResponse
+from providers.abstract import AbstractProvider
+from store import AddressIndex
+from tests.test_entities import make_transaction
+
+
+def with_transfer(txn, from_address, to_address, amount):
+    transfer = txn.embedded['transfers'][0]
+    transfer = transfer.copy(update={
+        'from_address': from_address,
+        'to_address': to_address,
+        'amount': transfer.amount.copy(update={'amount': amount}),
+    })
+    return txn.copy(update={'embedded': {'transfers': [transfer]}})
+
+
+def test_wallet_transactions_are_merged_in_order():
+    pending = make_transaction(True, 0).copy(update={'transaction_id': 'pending'})
+    # one address sent to the other in block 20, each address's view of it holds only its own side
+    sent = with_transfer(make_transaction(True, 20), 'bc1qa', 'bc1qb', '5000')
+    received = with_transfer(make_transaction(True, 20), 'unknown', 'bc1qb', '5000')
+    first = HeightPaginatedResponse(contents=[sent, make_transaction(True, 10)], has_more=True,
+                                    next_start_height=30, next_end_height=40)
+    second = HeightPaginatedResponse(contents=[pending, received, make_transaction(True, 30),
+                                               make_transaction(True, 10)], has_more=False)
+
+    resp = Client.combine([first, second])
+
+    assert [txn.block_height for txn in resp.contents] == [10, 20, 30, 0]
+    merged = resp.contents[1]
+    assert [(x.transfer_id.rsplit(':', 1)[1], x.from_address) for x in merged.embedded['transfers']] == \
+        [('0', 'bc1qa'), ('1', 'unknown')]
+    assert len(sent.embedded['transfers']) == 1
+    assert resp.contents[0].merge(make_transaction(True, 10)) is resp.contents[0]
+    assert resp.has_more and resp.next_start_height == 30
+
+
+def test_order_within_a_block_does_not_depend_on_the_address_listing_it():
+    def at_20(txid, index):
+        return make_transaction(True, 20).copy(update={'transaction_id': txid, 'index': index})
+
+    # each provider numbers the transactions by their place in its own listing of the address
+    first = HeightPaginatedResponse(contents=[at_20('b', 0), at_20('c', 1)], has_more=False)
+    second = HeightPaginatedResponse(contents=[at_20('a', 0), at_20('b', 1)], has_more=False)
+
+    for results in ([first, second], [second, first]):
+        assert [txn.transaction_id for txn in Client.combine(results).contents] == ['a', 'b', 'c']
+
+
+class HistoryProvider(AbstractProvider):
+    """
+    Serves a fixed final history from `start_height` upwards, `page_size` transactions at a time when set, with raw
+    bytes only when asked for them
+    """
+    provides_raw = True
+
+    def __init__(self, heights, page_size=None):
+        self.heights = heights
+        self.page_size = page_size
+        self.calls = []
+
+    async def get_blockchain_data(self, session, chain_id):
+        raise NotImplementedError
+
+    async def get_address_transactions(self, session, chain_id, address, start_height, end_height,
+                                       include_raw=False):
+        self.calls.append((start_height, include_raw))
+        heights = [height for height in self.heights if start_height <= height <= end_height]
+        rest = heights[self.page_size:] if self.page_size else []
+        contents = [make_transaction(True, height).copy(update={'raw': 'AQ==' if include_raw else None})
+                    for height in heights[:self.page_size or None]]
+        if rest:
+            return HeightPaginatedResponse(contents=contents, has_more=True, next_start_height=rest[0],
+                                           next_end_height=end_height)
+        return HeightPaginatedResponse(contents=contents, has_more=False)
+
+
+def batch_fetcher(tmp_path, provider):
+    client = SimpleNamespace(address_index=AddressIndex(str(tmp_path / 'addresses.sqlite3')))
+
+    def fetch(start_height, end_height, include_raw=False):
+        # the tip is at 100, bitcoin-mainnet transactions are final below 97
+        return run(Client._get_batch_transactions(client, provider, 'bitcoin-mainnet', ['bc1qsender'], start_height,
+                                                  end_height, 100, include_raw, object()))[0]
+    return fetch
+
+
+def test_index_serves_the_range_and_fetches_only_the_delta(tmp_path):
+    provider = HistoryProvider([10, 50, 90, 99])
+    fetch = batch_fetcher(tmp_path, provider)
+
+    assert [txn.block_height for txn in fetch(0, 100).contents] == [10, 50, 90, 99]
+    # covered by the index, the provider is not asked at all
+    assert [txn.block_height for txn in fetch(20, 95).contents] == [50, 90]
+    assert [txn.block_height for txn in fetch(0, 100).contents] == [10, 50, 90, 99]
+    assert provider.calls == [(0, False), (97, False)]
+
+
+def test_upward_pages_are_indexed_as_they_complete(tmp_path):
+    provider = HistoryProvider([10, 20, 30, 40, 50], page_size=2)
+    fetch = batch_fetcher(tmp_path, provider)
+
+    first = fetch(0, 100)
+    assert (first.has_more, first.next_start_height) == (True, 30)
+    second = fetch(30, 100)
+    assert [txn.block_height for txn in second.contents] == [30, 40]
+    # the first two pages are indexed, a fresh scan starts from the third
+    again = fetch(0, 100)
+    assert [txn.block_height for txn in again.contents] == [10, 20, 30, 40, 50]
+    assert provider.calls == [(0, False), (30, False), (50, False)]
+
+
+def test_index_serves_raw_bytes_only_once_fetched_with_them(tmp_path):
+    provider = HistoryProvider([10, 50])
+    fetch = batch_fetcher(tmp_path, provider)
+
+    assert [txn.raw for txn in fetch(0, 100).contents] == [None, None]
+    # indexed without raw bytes, so the whole range is fetched again with them
+    assert [txn.raw for txn in fetch(0, 100, include_raw=True).contents] == ['AQ==', 'AQ==']
+    assert [txn.raw for txn in fetch(0, 100, include_raw=True).contents] == ['AQ==', 'AQ==']
+    assert [txn.raw for txn in fetch(0, 100).contents] == [None, None]
+    assert provider.calls == [(0, False), (0, True), (97, True), (97, False)]
+
+
+class BatchProvider(HistoryProvider):
+    """Serves each address the same history through batches of two, leaving out the addresses in `dropped`"""
+    max_batch_size = 2
+
+    def __init__(self, heights, dropped=()):
+        super().__init__(heights)
+        self.dropped = set(dropped)
+        self.batches = []
+
+    async def get_addresses_transactions(self, session, chain_id, addresses, start_height, end_height,
+                                         include_raw=False):
+        self.batches.append(addresses)
+        return {address: await self.get_address_transactions(session, chain_id, address, start_height, end_height)
+                for address in addresses if address not in self.dropped}
+
+
+def test_addresses_are_split_into_batches_and_kept_apart(tmp_path):
+    provider = BatchProvider([10, 50])
+    assert Client.plan(provider, ['1a', '1b', '1c'], 0, 100, None) == [(['1a', '1b'], 0, 100), (['1c'], 0, 100)]
+
+    client = SimpleNamespace(address_index=AddressIndex(str(tmp_path / 'addresses.sqlite3')))
+    results = run(Client._get_batch_transactions(client, provider, 'bitcoin-mainnet', ['1a', '1b'], 0, 100, 100,
+                                                 False, object()))
+    assert provider.batches == [['1a', '1b']]
+    assert [[txn.block_height for txn in resp.contents] for resp in results] == [[10, 50], [10, 50]]
+
+
+def test_address_left_out_of_a_batch_is_an_error_not_an_empty_history(tmp_path):
+    provider = BatchProvider([10, 50], dropped=['1b'])
+    client = SimpleNamespace(address_index=AddressIndex(str(tmp_path / 'addresses.sqlite3')))
+
+    with pytest.raises(ValueError):
+        run(Client._get_batch_transactions(client, provider, 'bitcoin-mainnet', ['1a', '1b'], 0, 100, 100, False,
+                                           object()))
+    assert client.address_index.get('bitcoin-mainnet', '1b', 100, 0, 100) is None
@@ -0,0 +1,49 @@
+import pytest
+import cursors
+from client import Client
+from cursors import encode_cursor, decode_cursor
+from entities import HeightPaginatedResponse
+
+
+def test_cursor_round_trips_and_rejects_tampering():
+    cursor = encode_cursor('bitcoin-mainnet', {'bc1qa': (120, 500), 'bc1qb': (300, 500)})
+    assert decode_cursor(cursor, 'bitcoin-mainnet') == {'bc1qa': (120, 500), 'bc1qb': (300, 500)}
+
+    payload, signature = cursor.split('.')
+    forged = encode_cursor('bitcoin-mainnet', {'bc1qc': (0, 500)}).split('.')[0]
+    for bad in (f'{forged}.{signature}', f'{payload}.{signature[:-1]}', 'not-a-cursor'):
+        assert decode_cursor(bad, 'bitcoin-mainnet') is None
+    with pytest.raises(ValueError):
+        decode_cursor(cursor, 'litecoin-mainnet')
+
+
+def test_secret_is_generated_on_first_use_and_cursors_of_another_node_are_not_trusted(monkeypatch, tmp_path):
+    monkeypatch.delenv('CURSOR_SECRET', raising=False)
+    monkeypatch.setattr(cursors, 'CURSOR_SECRET_PATH', tmp_path / 'cursor_secret')
+    cursors.cursor_secret.cache_clear()
+    try:
+        assert not (tmp_path / 'cursor_secret').exists()
+        cursor = encode_cursor('bitcoin-mainnet', {'bc1qa': (120, 500)})
+        assert (tmp_path / 'cursor_secret').exists()
+
+        # another node, generating its own secret
+        monkeypatch.setattr(cursors, 'CURSOR_SECRET_PATH', tmp_path / 'other_secret')
+        cursors.cursor_secret.cache_clear()
+        assert decode_cursor(cursor, 'bitcoin-mainnet') is None
+    finally:
+        cursors.cursor_secret.cache_clear()
+
+
+def test_only_unfinished_addresses_are_resumed():
+    finished = HeightPaginatedResponse(contents=[], has_more=False)
+    truncated = HeightPaginatedResponse(contents=[], has_more=True, next_start_height=120, next_end_height=500,
+                                        continuations={'bc1qa': (120, 500)})
+    resp = Client.combine([finished, truncated])
+    assert resp.continuations == {'bc1qa': (120, 500)}
+
+    class Provider:
+        max_batch_size = 2
+
+    positions = {'bc1qa': (120, 500), 'bc1qb': (300, 500), 'bc1qc': (120, 500)}
+    assert Client.plan(Provider(), ['bc1qa', 'bc1qb', 'bc1qc', 'bc1qd'], 0, 500, positions) == \
+        [(['bc1qa', 'bc1qc'], 120, 500), (['bc1qb'], 300, 500)]
@@ -1,4 +1,5 @@
 import os
+import pytest
 from tests.blockset import Blockset, TestClient
 from elysium import app
 from hdwallet import BIP44HDWallet, BIP32HDWallet
@@ -55,6 +56,13 @@ elysium = TestClient(app)
 blockset = Blockset()
 
 
+@pytest.fixture(scope='module', autouse=True)
+def elysium_lifespan():
+    # run the app's startup and shutdown handlers so the shared upstream client exists
+    with elysium:
+        yield
+
+
 def get_wallet_balance(mnemonic, blockchain_id, client):
     opts = WALLET_CURRENCIES[blockchain_id]
     if opts['type'] == 'bip44':
@@ -0,0 +1,25 @@
+from asyncio import run
+import pytest
+from entities import HeightPaginatedResponse, WalletAddress
+
+pytest.importorskip('hdwallet')
+from discovery import scan_chain  # noqa: E402
+
+
+def test_scan_stops_at_the_gap_in_concurrent_waves():
+    used = {0, 3, 7, 40}
+    waves = []
+
+    async def derive(start, count):
+        return [(i, WalletAddress.trusted(address=f'addr{i}', path=f'0/{i}', format='p2pkh'))
+                for i in range(start, start + count)]
+
+    async def fetch(addresses):
+        waves.append(addresses)
+        return {a: HeightPaginatedResponse(contents=['txn'] if int(a[4:]) in used else [], has_more=False)
+                for a in addresses}
+
+    found = run(scan_chain(derive, fetch, gap_limit=5, windows=2, max_addresses=100))
+    # the first wave finds 7, which needs a second wave to rule out 8 to 12; the gap ends the scan before 40
+    assert [wallet_address.path for wallet_address, _ in found] == ['0/0', '0/3', '0/7']
+    assert len(waves) == 4 and waves[-1][-1] == 'addr19'
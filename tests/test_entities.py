@@ -0,0 +1,55 @@
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from entities import Collection, Link, Transaction, Transfer, Amount, dumps, dumps_collection
+
+
+def make_transaction(trusted: bool, height: int) -> Transaction:
+    transaction, transfer, amount = (Transaction.trusted, Transfer.trusted, Amount.trusted) if trusted else \
+        (Transaction, Transfer, Amount)
+    txid = f'bitcoin-mainnet:{height:064x}'
+    fee = amount(currency_id='bitcoin-mainnet:__native__', amount='226')
+    # keyword order deliberately differs from the field declaration order
+    return transaction(
+        transaction_id=txid,
+        identifier=f'{height:064x}',
+        hash=f'{height:064x}',
+        blockchain_id='bitcoin-mainnet',
+        timestamp='2021-11-09T00:00:00.000+00:00',
+        _embedded={'transfers': [transfer(
+            transfer_id=f'{txid}:0',
+            blockchain_id='bitcoin-mainnet',
+            from_address='bc1qsender',
+            to_address='__fee__',
+            index=0,
+            transaction_id=txid,
+            amount=fee,
+            meta={'note': 'ünïcödé   "quoted"\n'}
+        )]},
+        fee=fee,
+        confirmations=12,
+        size=225,
+        index=3,
+        block_hash='00ab',
+        block_height=height,
+        status='confirmed',
+        meta={},
+    )
+
+
+def test_trusted_serialization_is_byte_identical_to_fastapi():
+    links = {'next': Link(href='http://testserver/transactions?start_height=10')}
+    validated = Collection[Transaction](
+        _embedded={'transactions': [make_transaction(False, h) for h in range(3)]},
+        _links=links
+    )
+    expected = JSONResponse(jsonable_encoder(validated, by_alias=True)).body
+
+    trusted = [make_transaction(True, h) for h in range(3)]
+    assert dumps_collection('transactions', trusted, links) == expected
+
+
+def test_from_dict_round_trips():
+    txn = make_transaction(True, 7)
+    restored = Transaction.from_dict(Transaction.parse_raw(dumps(txn)).dict(by_alias=True))
+    assert dumps(restored) == dumps(txn)
+    assert restored.embedded['transfers'][0].amount.amount == '226'
@@ -0,0 +1,68 @@
+from asyncio import run
+import providers.etherscan as etherscan
+from providers.etherscan import EtherscanProvider
+
+ADDRESS = '0xabc'
+
+
+def row(action, block, n):
+    txhash = f'0x{action}{block}{n}'
+    common = {'hash': txhash, 'blockNumber': str(block), 'timeStamp': '1636416000', 'from': ADDRESS, 'to': '0xdef',
+              'value': '1'}
+    if action == 'txlistinternal':
+        return common
+    return {**common, 'blockHash': f'0x{block}', 'confirmations': '100', 'gas': '21000', 'gasUsed': '21000',
+            'gasPrice': '1', 'nonce': str(n), 'contractAddress': '0xtoken'}
+
+
+class FakeEtherscan(EtherscanProvider):
+    """Serves the rows of each account list at the given blocks, truncated to `MAX_RESULTS` like Etherscan"""
+
+    def __init__(self, **blocks):
+        self.blocks = blocks
+
+    async def _get(self, session, **kwargs):
+        params = kwargs['params']
+        action = params['action']
+        rows = [row(action, block, n) for n, block in enumerate(self.blocks.get(action, []))
+                if params['startblock'] <= block <= params['endblock']]
+        return rows[:params['offset']]
+
+
+def heights(resp):
+    return sorted(txn.block_height for txn in resp.contents)
+
+
+def test_list_cut_off_inside_a_block_continues_from_that_block(monkeypatch):
+    monkeypatch.setattr(etherscan, 'MAX_RESULTS', 3)
+    provider = FakeEtherscan(txlist=[10, 20, 20, 30, 40])
+
+    resp = run(provider.get_address_transactions(None, 'ethereum-mainnet', ADDRESS, 0, 100))
+    # block 20 may be incomplete, so it is left entirely to the next page
+    assert heights(resp) == [10]
+    assert (resp.has_more, resp.next_start_height, resp.next_end_height) == (True, 20, 100)
+
+    resp = run(provider.get_address_transactions(None, 'ethereum-mainnet', ADDRESS, 20, 100))
+    assert heights(resp) == [20, 20]
+    assert (resp.has_more, resp.next_start_height) == (True, 30)
+
+
+def test_single_block_over_the_cap_is_accepted_truncated(monkeypatch):
+    monkeypatch.setattr(etherscan, 'MAX_RESULTS', 3)
+    provider = FakeEtherscan(txlist=[20, 20, 20, 20, 30])
+
+    resp = run(provider.get_address_transactions(None, 'ethereum-mainnet', ADDRESS, 20, 100))
+    # block 20 can not be split any further, the page moves on past it rather than asking for it forever
+    assert heights(resp) == [20, 20, 20]
+    assert (resp.has_more, resp.next_start_height) == (True, 21)
+
+
+def test_cut_off_in_one_list_holds_back_the_others(monkeypatch):
+    monkeypatch.setattr(etherscan, 'MAX_RESULTS', 3)
+    for action in ('tokentx', 'txlistinternal'):
+        provider = FakeEtherscan(txlist=[10, 25, 40], **{action: [10, 20, 20, 20]})
+
+        resp = run(provider.get_address_transactions(None, 'ethereum-mainnet', ADDRESS, 0, 100))
+        # the complete transaction list stops where the truncated one does
+        assert heights(resp) == [10, 10]
+        assert (resp.has_more, resp.next_start_height) == (True, 20)
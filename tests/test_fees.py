@@ -0,0 +1,31 @@
+from asyncio import run, gather, sleep
+from cache import MemoryBackend
+from fees import FeeService
+
+
+class FakeFeeProvider:
+    def __init__(self):
+        self.calls = 0
+
+    async def get_fees(self, session, chain_id):
+        self.calls += 1
+        await sleep(0.01)
+        return [f'estimate {self.calls}']
+
+
+def test_callers_share_the_first_lookup_then_read_the_last_quote():
+    provider = FakeFeeProvider()
+
+    async def scenario():
+        service = FeeService(MemoryBackend())
+        first = await gather(*[service.get(provider, None, 'bitcoin-mainnet') for _ in range(5)])
+        # an old quote is still served immediately, the refresh is left to the background task
+        service.quotes['bitcoin-mainnet'].fetched_at -= 3600
+        later = await service.get(provider, None, 'bitcoin-mainnet')
+        await service.stop()
+        return first, later
+
+    first, later = run(scenario())
+    assert provider.calls == 1
+    assert all(quote is first[0] for quote in first) and later is first[0]
+    assert later.fees == ['estimate 1'] and later.stale
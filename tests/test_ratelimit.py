@@ -0,0 +1,61 @@
+from asyncio import run, gather
+from time import monotonic
+from providers.ratelimit import RateLimiter, CALLER
+
+
+def test_burst_is_immediate_then_rate_limited():
+    async def scenario():
+        limiter = RateLimiter('test-burst', rate=20, burst=5)
+        start = monotonic()
+        for _ in range(5):
+            await limiter.acquire()
+        burst_elapsed = monotonic() - start
+        for _ in range(5):
+            await limiter.acquire()
+        return burst_elapsed, monotonic() - start, limiter.snapshot()
+
+    burst_elapsed, total_elapsed, stats = run(scenario())
+    assert burst_elapsed < 0.05
+    assert total_elapsed >= 0.2
+    assert stats['acquired'] == 10
+    assert stats['waited'] == 5
+
+
+def test_queued_callers_are_served_round_robin():
+    async def scenario():
+        limiter = RateLimiter('test-fair', rate=100, burst=1)
+        await limiter.acquire()
+        order = []
+
+        async def call(caller, i):
+            CALLER.set(caller)
+            async with limiter:
+                order.append((caller, i))
+
+        # caller "a" queues all of its requests before "b" arrives
+        await gather(*[call('a', i) for i in range(4)], *[call('b', i) for i in range(2)])
+        return order
+
+    order = run(scenario())
+    assert [caller for caller, _ in order[:4]] == ['a', 'b', 'a', 'b']
+
+
+def test_a_call_billed_per_element_takes_that_many_tokens():
+    async def scenario():
+        limiter = RateLimiter('test-cost', rate=20, burst=5)
+        await limiter.acquire(4)
+        start = monotonic()
+        # one token is left, the next 4 take another 3 refills of 50ms
+        await limiter.acquire(4)
+        waited = monotonic() - start
+        # more than the bucket holds is granted from a full bucket and charged in full
+        await limiter.acquire(12)
+        granted = monotonic() - start
+        # the 7 tokens of debt and the next one are refilled before anything else goes out
+        await limiter.acquire()
+        return waited, granted, monotonic() - start
+
+    waited, granted, total = run(scenario())
+    assert 0.12 <= waited < 0.3
+    assert granted >= waited + 0.2
+    assert total >= granted + 0.38
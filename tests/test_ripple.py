@@ -0,0 +1,72 @@
+from asyncio import run
+import providers.ripple as ripple
+from providers.ripple import RippleProvider
+
+
+def payment(ledger_index, n):
+    return {'hash': f'{ledger_index:08X}{n:04X}', 'ledger_index': ledger_index, 'date': '2021-11-09T00:00:00Z',
+            'tx': {'Account': 'rSender', 'Destination': 'rReceiver', 'Amount': '1000', 'Fee': '10'},
+            'meta': {'TransactionResult': 'tesSUCCESS'}}
+
+
+class FakeRipple(RippleProvider):
+    """Serves an account's payments newest first, a `limit` at a time, with the offset of the next page as marker"""
+
+    def __init__(self, ledgers):
+        self.payments = [payment(ledger_index, n) for n, ledger_index in enumerate(sorted(ledgers, reverse=True))]
+        self.requests = []
+
+    async def _get_ledger_time(self, session, ledger_index):
+        return f'close-time-{ledger_index}'
+
+    async def _get(self, session, endpoint, **kwargs):
+        params = kwargs['params']
+        self.requests.append(params)
+        offset, limit = int(params.get('marker', 0)), int(params['limit'])
+        val = {'transactions': self.payments[offset:offset + limit]}
+        if offset + limit < len(self.payments):
+            val['marker'] = str(offset + limit)
+        return val
+
+
+def fetch(provider, start_height, end_height):
+    return run(provider.get_address_transactions(None, 'ripple-mainnet', 'rSender', start_height, end_height))
+
+
+def test_marker_pages_are_followed_within_the_pushed_down_range(monkeypatch):
+    monkeypatch.setattr(ripple, 'PAGE_SIZE', 2)
+    provider = FakeRipple([50, 40, 30, 20, 10])
+
+    resp = fetch(provider, 15, 45)
+    assert [txn.block_height for txn in resp.contents] == [20, 30, 40]
+    assert not resp.has_more
+    assert (provider.requests[0]['start'], provider.requests[0]['end']) == ('close-time-15', 'close-time-45')
+    assert [request.get('marker') for request in provider.requests] == [None, '2', '4']
+
+
+def test_max_pages_continues_at_the_last_partial_ledger(monkeypatch):
+    monkeypatch.setattr(ripple, 'PAGE_SIZE', 2)
+    monkeypatch.setattr(ripple, 'MAX_PAGES', 2)
+
+    resp = fetch(FakeRipple([50, 40, 30, 30, 30, 20]), 0, 100)
+    assert [txn.block_height for txn in resp.contents] == [40, 50]
+    assert (resp.has_more, resp.next_start_height, resp.next_end_height) == (True, 0, 30)
+
+    # a ledger that fills every page can not be split, it is returned truncated
+    resp = fetch(FakeRipple([30, 30, 30, 30, 20]), 0, 100)
+    assert [txn.block_height for txn in resp.contents] == [30, 30, 30, 30]
+    assert (resp.has_more, resp.next_end_height) == (True, 29)
+
+
+def test_pages_entirely_outside_the_range_still_continue(monkeypatch):
+    monkeypatch.setattr(ripple, 'PAGE_SIZE', 2)
+    monkeypatch.setattr(ripple, 'MAX_PAGES', 2)
+
+    resp = fetch(FakeRipple([120, 115, 110, 105, 90, 80]), 0, 100)
+    assert resp.contents == []
+    assert (resp.has_more, resp.next_end_height) == (True, 100)
+
+    # once the walk is below the range there is nothing left to continue
+    resp = fetch(FakeRipple([60, 55, 50, 45, 40, 30]), 56, 100)
+    assert [txn.block_height for txn in resp.contents] == [60]
+    assert not resp.has_more
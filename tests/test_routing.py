@@ -0,0 +1,140 @@
+from asyncio import run, sleep
+from time import monotonic
+from orjson import loads
+from entities import dumps
+from providers.abstract import AbstractProvider
+from providers.blockbook import BlockbookProvider
+from providers.blockcypher import BlockCypherProvider
+from providers.routing import RoutingProvider
+
+
+class FakeBackend(AbstractProvider):
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.finished = 0
+
+    async def get_blockchain_data(self, session, chain_id):
+        self.calls += 1
+        await sleep(self.delay)
+        if self.fail:
+            raise ValueError('upstream error')
+        self.finished += 1
+        return self
+
+    async def get_address_transactions(self, session, chain_id, address, start_height, end_height):
+        raise NotImplementedError
+
+
+def test_slow_primary_is_hedged():
+    primary, secondary = FakeBackend(delay=1), FakeBackend(delay=0.01)
+    router = RoutingProvider([('primary', primary), ('secondary', secondary)])
+    for _ in range(50):
+        router.stats['primary'].record('head', 0.02, failed=False)
+
+    winner = run(router.get_blockchain_data(None, 'bitcoin-mainnet'))
+    assert winner is secondary
+    # the losing request was cancelled rather than left running
+    assert primary.calls == 1 and primary.finished == 0
+    assert router.snapshot()['primary']['hedges'] == 1
+
+
+def test_failing_backend_fails_over_and_is_skipped():
+    primary, secondary = FakeBackend(fail=True), FakeBackend()
+    router = RoutingProvider([('primary', primary), ('secondary', secondary)])
+
+    async def scenario():
+        return [await router.get_blockchain_data(None, 'bitcoin-mainnet') for _ in range(30)]
+
+    assert all(winner is secondary for winner in run(scenario()))
+    # once the error rate crossed the threshold the primary stopped being tried first
+    assert primary.calls == 20
+    assert not router.snapshot()['primary']['healthy']
+
+
+class HistoryBackend(AbstractProvider):
+    def __init__(self, delay):
+        self.delay = delay
+        self.addresses = []
+
+    async def get_blockchain_data(self, session, chain_id):
+        raise NotImplementedError
+
+    async def get_address_transactions(self, session, chain_id, address, start_height, end_height,
+                                       include_raw=False):
+        self.addresses.append(address)
+        await sleep(self.delay)
+        return address
+
+
+def test_history_calls_are_not_hedged_against_tip_latency():
+    primary, secondary = HistoryBackend(delay=0.2), HistoryBackend(delay=0.01)
+    router = RoutingProvider([('primary', primary), ('secondary', secondary)])
+    # tip lookups are fast, which says nothing about how long a history takes
+    for _ in range(50):
+        router.stats['primary'].record('head', 0.02, failed=False)
+
+    assert run(router.get_address_transactions(None, 'bitcoin-mainnet', '1a', 0, 100)) == '1a'
+    assert secondary.addresses == []
+    assert router.snapshot()['primary']['hedge_delays'] == {'address': 2.0, 'head': 0.05}
+
+
+def test_batch_on_a_single_address_backend_is_fetched_concurrently():
+    backend = HistoryBackend(delay=0.1)
+    router = RoutingProvider([('single', backend)])
+    addresses = [f'1{i}' for i in range(5)]
+
+    started = monotonic()
+    responses = run(router.get_addresses_transactions(None, 'bitcoin-mainnet', addresses, 0, 100))
+    assert responses == {address: address for address in addresses}
+    # one after another would take 0.5s
+    assert monotonic() - started < 0.3
+
+
+TXID = 'ab' * 32
+BLOCKCYPHER_TX = {
+    'hash': TXID, 'received': '2021-11-09T00:00:00Z', 'fees': 2000, 'confirmations': 6, 'size': 2, 'hex': '0100',
+    'block_hash': '20' * 32, 'block_height': 20,
+    'inputs': [{'addresses': ['bc1qsender'], 'output_value': 7000}],
+    'outputs': [{'addresses': ['bc1qreceiver'], 'value': 5000}],
+}
+BLOCKBOOK_TX = {
+    'txid': TXID, 'blockTime': 1636416000, 'fees': '2000', 'confirmations': 6, 'size': 2, 'hex': '0100',
+    'blockHash': '20' * 32, 'blockHeight': 20,
+    'vin': [{'addresses': ['bc1qsender'], 'value': '7000'}],
+    'vout': [{'addresses': ['bc1qreceiver'], 'value': '5000'}],
+}
+
+
+class FixtureBlockCypher(BlockCypherProvider):
+    def __init__(self):
+        super().__init__(None)
+
+    async def _get(self, session, url, cost=1, **kwargs):
+        return {'address': 'bc1qsender', 'txs': [BLOCKCYPHER_TX]}
+
+
+class FixtureBlockbook(BlockbookProvider):
+    def __init__(self, light=False):
+        super().__init__(None)
+        self.light = light
+
+    async def _get(self, chain_id, session, url, **kwargs):
+        tx = {key: value for key, value in BLOCKBOOK_TX.items() if key not in ('size', 'hex')} if self.light \
+            else BLOCKBOOK_TX
+        return {'transactions': [tx], 'txs': 1, 'itemsOnPage': 50}
+
+
+def test_backends_of_a_chain_describe_a_transaction_the_same_way():
+    def fetch(backend):
+        router = RoutingProvider([('backend', backend)])
+        resp = run(router.get_address_transactions(None, 'bitcoin-mainnet', 'bc1qsender', 0, 100, include_raw=True))
+        return [dumps(txn) for txn in resp.contents]
+
+    # a hedge or failover mid-pagination must not change what the client is served, raw bytes included
+    assert fetch(FixtureBlockCypher()) == fetch(FixtureBlockbook())
+    assert loads(fetch(FixtureBlockbook())[0])['raw'] == 'AQA='
+
+    light = run(FixtureBlockbook(light=True).get_address_transactions(None, 'bitcoin-mainnet', 'bc1qsender', 0, 100))
+    assert light.contents[0].size is None
@@ -0,0 +1,36 @@
+from asyncio import run, gather, sleep
+from providers.singleflight import coalesce
+
+
+class FakeProvider:
+    def __init__(self):
+        self.calls = 0
+
+    @coalesce
+    async def _get(self, session, endpoint, **kwargs):
+        self.calls += 1
+        await sleep(0.01)
+        return {'endpoint': endpoint, 'params': dict(kwargs.get('params', {}))}
+
+
+def test_identical_concurrent_calls_share_one_request():
+    provider = FakeProvider()
+
+    async def scenario():
+        return await gather(*[provider._get(None, 'stats', params={'a': '1', 'key': str(i)}) for i in range(10)])
+
+    results = run(scenario())
+    assert provider.calls == 1
+    assert all(result is results[0] for result in results)
+
+
+def test_different_calls_are_not_coalesced():
+    provider = FakeProvider()
+
+    async def scenario():
+        await gather(provider._get(None, 'stats'), provider._get(None, 'stats', params={'a': '1'}))
+        # once the first call has finished the next one goes upstream again
+        await provider._get(None, 'stats')
+
+    run(scenario())
+    assert provider.calls == 3
@@ -0,0 +1,57 @@
+from asyncio import run
+import providers.tezos as tezos
+from providers.tezos import TezosProvider, OP_COLUMNS
+
+ADDRESS = 'tz1account'
+
+
+class FakeTezos(TezosProvider):
+    """Serves the operation table, with row ids in height order, filtered and paged like tzstats"""
+
+    def __init__(self, sent, received):
+        ops = [(height, ADDRESS, 'tz1other') for height in sent] + \
+            [(height, 'tz1other', ADDRESS) for height in received]
+        self.rows = [{
+            'row_id': row_id, 'time': 1636416000000, 'height': height, 'hash': f'op{row_id}', 'type': 'transaction',
+            'status': 'applied', 'volume': 1.0, 'fee': 0.001, 'burned': 0, 'storage_size': 0, 'block': f'B{height}',
+            'sender': sender, 'receiver': receiver
+        } for row_id, (height, sender, receiver) in enumerate(sorted(ops), start=1)]
+        self.requests = []
+
+    async def _get(self, session, url, **kwargs):
+        params = kwargs['params']
+        self.requests.append(params)
+        column = 'sender' if 'sender' in params else 'receiver'
+        rows = [row for row in self.rows if row[column] == params[column]
+                and int(params['height.gte']) <= row['height'] <= int(params['height.lte'])
+                and row['row_id'] > int(params.get('cursor', 0))]
+        return [[row[name] for name in OP_COLUMNS] for row in rows[:int(params['limit'])]]
+
+
+def fetch(provider, start_height, end_height):
+    return run(provider.get_address_transactions(None, 'tezos-mainnet', ADDRESS, start_height, end_height))
+
+
+def test_streams_truncated_at_different_heights_continue_from_the_lower(monkeypatch):
+    monkeypatch.setattr(tezos, 'PAGE_SIZE', 2)
+    monkeypatch.setattr(tezos, 'MAX_PAGES', 1)
+    provider = FakeTezos(sent=[10, 20, 30], received=[15, 40, 50])
+
+    resp = fetch(provider, 0, 100)
+    # the sender stream stopped at 20 and the receiver stream at 40, only below 20 are both complete
+    assert [txn.block_height for txn in resp.contents] == [10, 15]
+    assert (resp.has_more, resp.next_start_height, resp.next_end_height) == (True, 20, 100)
+
+    resp = fetch(provider, 20, 100)
+    assert [txn.block_height for txn in resp.contents] == [20]
+    assert (resp.has_more, resp.next_start_height) == (True, 30)
+
+
+def test_pages_resume_from_the_last_row_id(monkeypatch):
+    monkeypatch.setattr(tezos, 'PAGE_SIZE', 2)
+    provider = FakeTezos(sent=[10, 20, 30, 40, 50], received=[])
+
+    resp = fetch(provider, 0, 100)
+    assert [txn.block_height for txn in resp.contents] == [10, 20, 30, 40, 50]
+    assert not resp.has_more
+    assert [request.get('cursor') for request in provider.requests if 'sender' in request] == [None, '2', '4']
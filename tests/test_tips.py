@@ -0,0 +1,31 @@
+from asyncio import run, gather, sleep
+from cache import MemoryBackend
+from tips import TipRegistry
+
+
+class FakeHead:
+    def __init__(self, height):
+        self.verified_height = height
+
+
+def test_requests_read_the_polled_tip():
+    calls = []
+
+    async def fetch(chain_id):
+        calls.append(chain_id)
+        await sleep(0.01)
+        return FakeHead(len(calls))
+
+    async def scenario():
+        registry = TipRegistry(MemoryBackend())
+        registry.start(fetch, ['bitcoin-mainnet', 'ethereum-mainnet'])
+        # requests arriving before the first poll finishes share its lookup
+        first = await gather(*[registry.blockchain('bitcoin-mainnet') for _ in range(5)])
+        later = await registry.blockchain('bitcoin-mainnet')
+        await registry.stop()
+        return first, later, registry.height('ethereum-mainnet'), registry.height('litecoin-mainnet')
+
+    first, later, ethereum_height, unknown_height = run(scenario())
+    assert all(head is first[0] for head in first) and later is first[0]
+    assert sorted(calls) == ['bitcoin-mainnet', 'ethereum-mainnet']
+    assert ethereum_height > 0 and unknown_height == 0
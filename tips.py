@@ -0,0 +1,108 @@
+import os
+from asyncio import ensure_future, sleep, gather, CancelledError
+from time import monotonic
+from typing import Dict, Optional, Callable, Awaitable, List, Tuple
+from cache import CACHE, CacheBackend
+from entities import Blockchain
+from providers.singleflight import SingleFlight
+
+# seconds between head lookups, roughly a fraction of each chain's block time
+DEFAULT_INTERVALS = {
+    'bitcoin-mainnet': 30,
+    'bitcoin-testnet': 60,
+    'bitcoincash-mainnet': 30,
+    'litecoin-mainnet': 15,
+    'dogecoin-mainnet': 15,
+    'ethereum-mainnet': 5,
+    'ripple-mainnet': 4,
+    'tezos-mainnet': 15,
+}
+STALE_AFTER = int(os.getenv('TIP_STALE_AFTER', '10'))  # missed polls before a request refreshes the tip itself
+
+
+def poll_interval(chain_id: str) -> float:
+    """Read from `TIP_INTERVAL_{CHAIN_ID}`, for example `TIP_INTERVAL_BITCOIN_MAINNET`"""
+    env_name = f'TIP_INTERVAL_{chain_id.upper().replace("-", "_")}'
+    return float(os.getenv(env_name, str(DEFAULT_INTERVALS.get(chain_id, 30))))
+
+
+class TipRegistry:
+    """
+    The latest head (height, hash and fees) of every chain, kept current by one background poller per chain so
+    requests read it from memory. A request only goes upstream itself before the first poll has finished, or when
+    polling has been failing long enough for the head to be stale; concurrent refreshes of a chain share one call.
+
+    With several workers only the holder of a chain's lease polls upstream, the others pick its result up from the
+    shared cache. The lease lapses, and another worker takes over, when its holder stops renewing it.
+    """
+
+    def __init__(self, cache: CacheBackend = CACHE):
+        self.cache = cache
+        self.blockchains: Dict[str, Tuple[float, Blockchain]] = {}  # {chain_id: (monotonic time, blockchain)}
+        self.fetch: Optional[Callable[[str], Awaitable[Blockchain]]] = None
+        self._flights = SingleFlight()
+        self._tasks = []
+
+    def get(self, chain_id: str) -> Optional[Blockchain]:
+        entry = self.blockchains.get(chain_id)
+        if entry is None or monotonic() - entry[0] > STALE_AFTER * poll_interval(chain_id):
+            return None
+        return entry[1]
+
+    def height(self, chain_id: str) -> int:
+        """The chain's last known verified height, 0 before it has been looked up"""
+        entry = self.blockchains.get(chain_id)
+        return entry[1].verified_height if entry is not None else 0
+
+    def update(self, chain_id: str, blockchain: Blockchain):
+        self.blockchains[chain_id] = (monotonic(), blockchain)
+
+    async def blockchain(self, chain_id: str) -> Blockchain:
+        if (blockchain := self.get(chain_id) or self._load(chain_id)) is not None:
+            return blockchain
+        return await self.refresh(chain_id)
+
+    async def refresh(self, chain_id: str) -> Blockchain:
+        return await self._flights.do(chain_id, self._refresh, chain_id)
+
+    def start(self, fetch: Callable[[str], Awaitable[Blockchain]], chain_ids: List[str]):
+        self.fetch = fetch
+        self._tasks = [ensure_future(self._poll(chain_id)) for chain_id in chain_ids]
+
+    async def stop(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await gather(*tasks, return_exceptions=True)
+
+    async def _refresh(self, chain_id: str) -> Blockchain:
+        if self.fetch is None:
+            raise RuntimeError('TipRegistry has not been started')
+        blockchain = await self.fetch(chain_id)
+        self.update(chain_id, blockchain)
+        self.cache.set(f'tip:{chain_id}', blockchain, ttl=STALE_AFTER * poll_interval(chain_id))
+        return blockchain
+
+    def _load(self, chain_id: str) -> Optional[Blockchain]:
+        """Takes the head another worker has polled from the shared cache"""
+        blockchain = self.cache.get(f'tip:{chain_id}')
+        if blockchain is not None:
+            self.update(chain_id, blockchain)
+        return blockchain
+
+    async def _poll(self, chain_id: str):
+        interval = poll_interval(chain_id)
+        while True:
+            try:
+                if self.cache.lease(f'tip:{chain_id}', ttl=3 * interval):
+                    await self.refresh(chain_id)
+                else:
+                    self._load(chain_id)
+            except CancelledError:
+                raise
+            except Exception as e:
+                print(f'TipRegistry failed to refresh {chain_id}: {e!r}')
+            await sleep(interval)
+
+
+TIPS = TipRegistry()